@@ -0,0 +1,34 @@
+"""
+API Client - pooled HTTP sessions and the request helper shared by the API stages
+
+query_wikipedia.py, search_wikidata.py and enrich_wikidata.py all talk to the
+MediaWiki or Wikidata APIs through these, so none of the stage scripts has to
+import another one.
+"""
+import requests
+
+from instrumentation import instrument_session
+
+WIKIPEDIA_API_URL = "https://en.wikipedia.org/w/api.php"
+
+# Default size of a session's keep-alive connection pool
+POOL_SIZE = 8
+
+
+def make_session(pool_size=POOL_SIZE):
+    """Create a requests session whose keep-alive connection pool fits pool_size workers"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # Response latencies and status codes go to the run report, if there is one
+    return instrument_session(session)
+
+
+def api_get(http, url, params, scheduler=None):
+    """Send an API request, through the adaptive scheduler when one is given"""
+    if scheduler is not None:
+        return scheduler.get(http, url, params=params, timeout=30, mediawiki=True)
+    r = http.get(url, params=params, timeout=30)
+    r.raise_for_status()
+    return r
@@ -0,0 +1,121 @@
+"""
+Artifacts - typed columnar (Feather/Parquet) copies of the stage outputs
+
+Every stage hands its result to the next one as a CSV. With a declared schema
+per artifact, the CSV can also be stored as a Feather or Parquet file next to
+it: dtypes no longer need to be inferred, repeated strings such as query_string,
+category and itemLabel are stored once as categoricals, and Feather files are
+read memory-mapped. Group by those columns with observed=True, so unobserved
+categories do not add empty groups. The CSV stays the export format; the
+columnar copy is only used when it is at least as new as the CSV. Requires pyarrow, which is optional.
+"""
+import argparse
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+FORMATS = ('csv', 'feather', 'parquet')
+
+# Declared column types per artifact; columns not listed are inferred
+SCHEMAS = {
+    "1_theoriesof_complete.csv": {
+        'normalized_string': 'string',
+    },
+    "1_theoriesof_complete_rerun.csv": {
+        'normalized_string': 'string',
+    },
+    "2_wikipediacategoriesfromquery.csv": {
+        'ns': 'Int64', 'title': 'string', 'pageid': 'Int64', 'size': 'Int64', 'wordcount': 'Int64',
+        'snippet': 'string', 'timestamp': 'string', 'query_string': 'category', 'category': 'category',
+    },
+    "3_wikicategories_distances_filtered.csv": {
+        'ns': 'Int64', 'title': 'string', 'pageid': 'Int64', 'size': 'Int64', 'wordcount': 'Int64',
+        'snippet': 'string', 'timestamp': 'string', 'query_string': 'category', 'category': 'category',
+        'jac': 'float64', 'lev': 'Int64',
+    },
+    "3_wikicategories_distances_filtered_rerun.csv": {
+        'ns': 'Int64', 'title': 'string', 'pageid': 'Int64', 'size': 'Int64', 'wordcount': 'Int64',
+        'snippet': 'string', 'timestamp': 'string', 'query_string': 'category', 'category': 'category',
+        'jac': 'float64', 'lev': 'Int64',
+    },
+    "4_theorystrings_categories_humans.csv": {
+        'item': 'string', 'itemLabel': 'category', 'category': 'category',
+    },
+}
+
+
+def schema_for(path):
+    """Return the declared schema of an artifact (empty if it has none)"""
+    return SCHEMAS.get(os.path.basename(path), {})
+
+
+def columnar_path(csv_path, fmt):
+    """Path of the columnar copy of a CSV artifact"""
+    return os.path.splitext(csv_path)[0] + '.' + fmt
+
+
+def apply_schema(df, path):
+    """Cast the columns of a frame to the declared types of its artifact"""
+    schema = {col: dtype for col, dtype in schema_for(path).items() if col in df.columns}
+    return df.astype(schema) if schema else df
+
+
+def read_artifact(csv_path, columns=None):
+    """Read an artifact, preferring an up-to-date Feather or Parquet copy of the CSV"""
+    csv_mtime = os.path.getmtime(csv_path) if os.path.exists(csv_path) else None
+    for fmt in ('feather', 'parquet'):
+        path = columnar_path(csv_path, fmt)
+        if feather is None or not os.path.exists(path):
+            continue
+        if csv_mtime is not None and os.path.getmtime(path) < csv_mtime:
+            continue
+        if fmt == 'feather':
+            return feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+        return pd.read_parquet(path, columns=columns, memory_map=True)
+
+    dtype = schema_for(csv_path)
+    if columns is not None:
+        dtype = {col: t for col, t in dtype.items() if col in columns}
+    return pd.read_csv(csv_path, usecols=columns, dtype=dtype or None)
+
+
+def write_artifact(df, csv_path, fmt='csv'):
+    """Write an artifact as CSV, plus a typed Feather or Parquet copy when fmt asks for one"""
+    df.to_csv(csv_path, index=False)
+    if fmt != 'csv':
+        write_columnar(apply_schema(df, csv_path), csv_path, fmt)
+
+
+def write_columnar(df, csv_path, fmt):
+    if fmt not in FORMATS[1:]:
+        raise ValueError(f"Unknown artifact format '{fmt}', expected one of {FORMATS}")
+    if feather is None:
+        raise ImportError("pyarrow is required for Feather/Parquet artifacts (pip install pyarrow)")
+    path = columnar_path(csv_path, fmt)
+    df = df.reset_index(drop=True)
+    if fmt == 'feather':
+        feather.write_feather(df, path)
+    else:
+        df.to_parquet(path, index=False)
+    print(f"Saved {fmt} copy to {path}")
+
+
+def convert_artifact(csv_path, fmt='feather'):
+    """Write a typed columnar copy of an existing CSV artifact"""
+    if fmt == 'csv':
+        return
+    write_columnar(pd.read_csv(csv_path, dtype=schema_for(csv_path) or None), csv_path, fmt)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write typed Feather/Parquet copies of CSV artifacts")
+    parser.add_argument('files', nargs='+', help="CSV artifacts to convert")
+    parser.add_argument('--format', choices=FORMATS[1:], default='feather')
+    args = parser.parse_args()
+    for csv_file in args.files:
+        convert_artifact(csv_file, args.format)
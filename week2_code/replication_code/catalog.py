@@ -0,0 +1,162 @@
+"""
+Catalog - shared file resolution and memoized DataFrame loads for the pipeline stages
+
+get_file_path resolves an artifact name to its location (rerun files in
+replication_code/data, the others in original_project/data when present).
+load() reads an artifact once per process and hands out the cached frame on
+later calls, so stages run in one kernel (e.g. ReplicatingStudy.ipynb) hit the
+disk once per artifact. A cached frame is re-read when its file changes (size
+and mtime, then content hash); frames are evicted least recently used first
+once the cache exceeds its memory budget.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from artifacts import read_artifact
+
+# Memory the cached frames may use before the least recently used ones are dropped
+DEFAULT_MEMORY_BUDGET = 1024 * 1024 * 1024
+
+# With copy-on-write, a shallow copy cannot modify the cached frame. The option only
+# exists from pandas 1.5; older versions raise OptionError, a KeyError, for it
+try:
+    COPY_ON_WRITE = int(pd.__version__.split('.')[0]) >= 3 or pd.get_option('mode.copy_on_write') is True
+except KeyError:
+    COPY_ON_WRITE = False
+
+
+def get_file_path(filename):
+    """Get path to data file. Rerun files stay in replication_code/data, others prefer original_project/data"""
+    original_data = os.path.join(os.path.dirname(__file__), "original_project", "data")
+    rerun_data = os.path.join(os.path.dirname(__file__), "data")
+
+    # If filename contains "rerun", use replication_code/data
+    if "rerun" in filename.lower():
+        return os.path.join(rerun_data, filename)
+
+    # Otherwise, prefer original_project/data, fall back to replication_code/data
+    original_path = os.path.join(original_data, filename)
+    if os.path.exists(original_path):
+        return original_path
+    return os.path.join(rerun_data, filename)
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def file_hash(path, memo):
+    """Hash a file's content; unchanged files (same size and mtime) reuse the memoized hash"""
+    if not os.path.exists(path):
+        return None
+    signature = file_signature(path)
+    cached = memo.get(path)
+    if cached is not None and cached['signature'] == signature:
+        return cached['hash']
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    memo[path] = {'signature': signature, 'hash': digest.hexdigest()}
+    return memo[path]['hash']
+
+
+class Catalog:
+    """Process-wide cache of artifact DataFrames, invalidated when the file changes"""
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+        self.frames = OrderedDict()
+        self.hashes = {}
+        self.counts = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._lock = threading.Lock()
+
+    def load(self, path, columns=None):
+        """Return the artifact at path (optionally only some columns), reading it only if it changed.
+
+        Only the requested columns are read from disk. A cached frame answers any
+        request for a subset of its columns; a request for other columns reads the
+        union of both sets and replaces it.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            entry = self.frames.get(path)
+            if entry is not None and entry['signature'] != file_signature(path):
+                # Touched but identical files keep their cached frame
+                if file_hash(path, self.hashes) != entry['hash']:
+                    self._drop(path)
+                    entry = None
+                else:
+                    entry['signature'] = file_signature(path)
+
+            wanted = None if columns is None else list(dict.fromkeys(columns))
+            if entry is not None and entry['columns'] is not None and (
+                    wanted is None or not set(wanted) <= set(entry['columns'])):
+                # Cached with too few columns: read what it had plus what is asked for now
+                if wanted is not None:
+                    wanted = list(dict.fromkeys(entry['columns'] + wanted))
+                self._drop(path)
+                entry = None
+
+            if entry is None:
+                self.counts['misses'] += 1
+                df = read_artifact(path, columns=wanted)
+                entry = {
+                    'frame': df,
+                    'columns': wanted,
+                    'signature': file_signature(path),
+                    'hash': file_hash(path, self.hashes),
+                    'bytes': int(df.memory_usage(deep=True).sum()),
+                }
+                self.frames[path] = entry
+                self._evict(keep=path)
+            else:
+                self.counts['hits'] += 1
+            self.frames.move_to_end(path)
+            df = entry['frame']
+
+        if columns is not None:
+            return df[list(columns)].copy(deep=not COPY_ON_WRITE)
+        return df.copy(deep=not COPY_ON_WRITE)
+
+    def _drop(self, path):
+        self.frames.pop(path, None)
+
+    def _evict(self, keep):
+        """Drop least recently used frames until the cache fits its memory budget"""
+        while self.nbytes() > self.memory_budget and len(self.frames) > 1:
+            oldest = next(iter(self.frames))
+            if oldest == keep:
+                break
+            self._drop(oldest)
+            self.counts['evictions'] += 1
+
+    def invalidate(self, path=None):
+        """Forget one cached artifact, or all of them"""
+        with self._lock:
+            if path is None:
+                self.frames.clear()
+            else:
+                self._drop(os.path.abspath(path))
+
+    def nbytes(self):
+        return sum(entry['bytes'] for entry in self.frames.values())
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts, frames=len(self.frames), bytes=self.nbytes())
+
+
+# Shared by every stage imported into the same process
+CATALOG = Catalog()
+
+
+def load(path, columns=None):
+    """Load an artifact through the shared catalog"""
+    return CATALOG.load(path, columns=columns)
@@ -0,0 +1,134 @@
+"""
+Category Search Index - offline Wikipedia category search backed by SQLite FTS5
+
+Ingests a local dump of category pages (title, pageid, size, description text)
+and answers the same search as query_wikipedia_categories, with the same result
+schema, without going over the network.
+"""
+import argparse
+import os
+import re
+import sqlite3
+import threading
+
+import pandas as pd
+
+from instrumentation import add_arguments, from_args, record
+
+# Default index file, used by query_wikipedia.py --offline-index
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(__file__), "data", "category_index.sqlite")
+
+# Same highlighting markup as the snippets returned by the Wikipedia API
+SNIPPET_START = '<span class="searchmatch">'
+SNIPPET_END = '</span>'
+
+
+def fts_query(query_string):
+    """Turn a free-text query into an FTS5 query requiring every word, like the wiki search"""
+    words = re.findall(r"\w+", query_string)
+    return " ".join('"' + word + '"' for word in words)
+
+
+class LocalCategoryIndex:
+    """FTS5 index over category titles and descriptions, searchable like the Wikipedia API"""
+
+    def __init__(self, path=DEFAULT_INDEX_PATH, create=True):
+        """Open the index at path; with create=False the file must already exist"""
+        self.path = path
+        self._lock = threading.Lock()
+        if not create and (path == ":memory:" or not os.path.exists(path)):
+            raise FileNotFoundError(f"No category index at {path} (build one with category_search_index.py)")
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS categories USING fts5("
+            "title, description, pageid UNINDEXED, size UNINDEXED, wordcount UNINDEXED, timestamp UNINDEXED)"
+        )
+
+    def ingest(self, dump, chunksize=50000):
+        """Add categories from a dump CSV (or DataFrame) with title, pageid, size and description columns.
+
+        Rows are keyed on pageid, so a category already in the index is replaced rather than added twice.
+        """
+        chunks = pd.read_csv(dump, chunksize=chunksize) if isinstance(dump, str) else [dump]
+        n = 0
+        with self._lock:
+            for chunk in chunks:
+                titles = chunk['title'].astype(str).str.replace('Category:', '', regex=False)
+                descriptions = chunk['description'].fillna('').astype(str)
+                timestamps = chunk['timestamp'] if 'timestamp' in chunk.columns else pd.Series('', index=chunk.index)
+                pageids = chunk['pageid'].astype('Int64').tolist()
+                rows = zip(
+                    pageids,
+                    titles.tolist(),
+                    descriptions.tolist(),
+                    pageids,
+                    chunk['size'].astype('Int64').tolist(),
+                    descriptions.str.split().str.len().tolist(),
+                    timestamps.fillna('').astype(str).tolist(),
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO categories (rowid, title, description, pageid, size, wordcount, timestamp) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [tuple(None if v is pd.NA else v for v in row) for row in rows]
+                )
+                n += len(chunk)
+            self._conn.commit()
+        return n
+
+    def search(self, query_string, limit=10):
+        """Return the best matching categories in the Wikipedia API search result schema"""
+        match = fts_query(query_string)
+        if not match:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT title, pageid, size, wordcount, "
+                "snippet(categories, 1, ?, ?, '', 32), timestamp "
+                "FROM categories WHERE categories MATCH ? ORDER BY bm25(categories) LIMIT ?",
+                (SNIPPET_START, SNIPPET_END, match, limit)
+            ).fetchall()
+        return [{
+            'ns': 14,
+            'title': f"Category:{title}",
+            'pageid': pageid,
+            'size': size,
+            'wordcount': wordcount,
+            'snippet': snippet,
+            'timestamp': timestamp,
+        } for title, pageid, size, wordcount, snippet, timestamp in rows]
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM categories").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_index(path):
+    """Open an existing, non-empty index for searching; a wrong path must not silently search nothing"""
+    index = LocalCategoryIndex(path, create=False)
+    if index.count() == 0:
+        index.close()
+        raise ValueError(f"Category index {path} is empty (build it with category_search_index.py)")
+    return index
+
+
+def main(dump_file, index_path=DEFAULT_INDEX_PATH):
+    index = LocalCategoryIndex(index_path)
+    n = index.ingest(dump_file)
+    record(rows_in=n, rows_out=index.count())
+    print(f"Indexed {n} categories from {dump_file} ({index.count()} in {index_path})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a local full-text index of Wikipedia categories")
+    parser.add_argument('dump', help="CSV with title, pageid, size, description (and optional timestamp) columns")
+    parser.add_argument('--index', default=DEFAULT_INDEX_PATH, help="SQLite index file to create or extend")
+    add_arguments(parser)
+    args = parser.parse_args()
+    with from_args('category_search_index', args):
+        main(args.dump, index_path=args.index)
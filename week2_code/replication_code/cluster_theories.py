@@ -0,0 +1,205 @@
+"""
+Cluster Theories - group near-duplicate "theor* of" strings with MinHash and LSH
+
+Strings that only differ in case, punctuation, spacing or plural endings share
+a fingerprint and are grouped directly. The remaining fingerprints get a
+MinHash signature over their character q-grams; LSH banding puts strings whose
+signatures agree on a whole band in the same bucket, so only strings sharing a
+bucket are compared. Starting from the most frequent, each string not yet
+clustered becomes a cluster center and takes in the candidates that are
+spelling variants of the center itself (see near_duplicate; no chaining through
+intermediate strings). Clusters are written as OpenRefine mass edits on
+normalized_string, like 1_theoryof_transformations.json, mapping every variant
+to the cluster's most frequent string.
+"""
+import argparse
+import json
+import re
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from catalog import get_file_path
+from instrumentation import add_arguments, from_args, record, stage
+from jac_distance_categories import bounded_levenshtein, qgram_set
+from preprocessingdata import load_sources, merge_sources
+
+# Signature length and banding: bands of NUM_PERM // BANDS rows each.
+# Pairs become candidates around similarity (1 / BANDS) ** (BANDS / NUM_PERM) ~ 0.45,
+# low enough for a one-letter typo in a short string
+NUM_PERM = 100
+BANDS = 25
+
+# A word with a one-letter typo must be at least this long; shorter words one
+# letter apart are mostly other words (mind / kind, strong / string, phonetic / phonemic)
+TYPO_MIN_LENGTH = 9
+
+# Mersenne prime for the universal hash functions (a * h + b) mod PRIME
+PRIME = (1 << 31) - 1
+
+# Strings in a signature block, to bound the (num_perm x q-grams) work array
+SIGNATURE_BLOCK = 2000
+
+
+def singular(word):
+    """Crude plural folding: theories -> theory, sciences -> science"""
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+
+def fingerprint(s):
+    """Lowercase a string, drop punctuation and extra whitespace, and fold plurals"""
+    return " ".join(singular(word) for word in re.findall(r"\w+", s.lower()))
+
+
+def near_duplicate(a, b):
+    """Whether two fingerprints spell the same string: the same words up to spacing and
+    hyphens (post-structuralist / poststructuralist), or a one-letter typo in a single
+    word (relativity / relativty). The misspelled word must be TYPO_MIN_LENGTH letters
+    long and keep its first letter, so theory of mind / kind and evolution / revolution
+    stay apart."""
+    if a.replace(" ", "") == b.replace(" ", ""):
+        return True
+    words_a, words_b = a.split(), b.split()
+    if len(words_a) != len(words_b):
+        return False
+    different = [(x, y) for x, y in zip(words_a, words_b) if x != y]
+    if len(different) != 1:
+        return False
+    x, y = different[0]
+    return (min(len(x), len(y)) >= TYPO_MIN_LENGTH and x[0] == y[0]
+            and bounded_levenshtein(x, y, max_distance=1) <= 1)
+
+
+def gram_hashes(s, q=3):
+    """Stable 31-bit hashes of the q-grams of a string (the string itself if shorter than q)"""
+    grams = qgram_set(s, q) or {s}
+    return [zlib.crc32(gram.encode('utf-8')) % PRIME for gram in grams]
+
+
+def minhash_signatures(strings, q=3, num_perm=NUM_PERM, seed=1):
+    """Return a (len(strings), num_perm) array of MinHash signatures over character q-grams"""
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, PRIME, num_perm, dtype=np.uint64)[:, None]
+    b = rng.integers(0, PRIME, num_perm, dtype=np.uint64)[:, None]
+
+    signatures = np.empty((len(strings), num_perm), dtype=np.uint32)
+    for start in range(0, len(strings), SIGNATURE_BLOCK):
+        block = [gram_hashes(s, q) for s in strings[start:start + SIGNATURE_BLOCK]]
+        lengths = np.fromiter((len(h) for h in block), dtype=np.int64, count=len(block))
+        hashes = np.fromiter((h for hs in block for h in hs), dtype=np.uint64, count=int(lengths.sum()))
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        # Minimum of every hash function over each string's q-grams
+        values = (a * hashes[None, :] + b) % PRIME
+        signatures[start:start + len(block)] = np.minimum.reduceat(values, offsets, axis=1).T
+    return signatures
+
+
+def lsh_buckets(signatures, bands=BANDS):
+    """Bucket the rows by band: per band, the bucket of every row and the rows of every bucket"""
+    rows = signatures.shape[1] // bands
+    buckets = []
+    for band in range(bands):
+        keys = signatures[:, band * rows:(band + 1) * rows]
+        _, bucket = np.unique(keys, axis=0, return_inverse=True)
+        bucket = bucket.ravel()
+        order = np.argsort(bucket, kind='stable')
+        boundaries = np.flatnonzero(np.diff(bucket[order])) + 1
+        buckets.append((bucket, np.split(order, boundaries)))
+    return buckets
+
+
+def lsh_candidates(buckets, i):
+    """Rows sharing at least one band bucket with row i"""
+    candidates = set()
+    for bucket, members in buckets:
+        candidates.update(members[bucket[i]].tolist())
+    candidates.discard(i)
+    return candidates
+
+
+def cluster_strings(strings, freqs=None, q=3, num_perm=NUM_PERM, bands=BANDS):
+    """Group near-duplicate strings; returns a list of clusters, each a list of strings with the
+    representative (most frequent, then shortest) first"""
+    strings = list(dict.fromkeys(strings))
+    freqs = freqs or {}
+
+    # Exact grouping by fingerprint, then MinHash-LSH over the distinct fingerprints
+    keys, fingerprints = pd.factorize(pd.Series([fingerprint(s) for s in strings]))
+    fingerprints = list(fingerprints)
+    weight = np.zeros(len(fingerprints))
+    np.add.at(weight, keys, [freqs.get(s, 0) for s in strings])
+
+    buckets = lsh_buckets(minhash_signatures(fingerprints, q=q, num_perm=num_perm), bands=bands)
+
+    # Most frequent fingerprints become centers first; members must be variants of the center itself
+    center = np.full(len(fingerprints), -1)
+    n_compared = 0
+    for i in sorted(range(len(fingerprints)), key=lambda i: (-weight[i], len(fingerprints[i]), fingerprints[i])):
+        if center[i] >= 0:
+            continue
+        center[i] = i
+        for j in lsh_candidates(buckets, i):
+            if center[j] >= 0:
+                continue
+            n_compared += 1
+            if near_duplicate(fingerprints[i], fingerprints[j]):
+                center[j] = i
+    print(f"{len(strings)} strings, {len(fingerprints)} fingerprints, {n_compared} pairs compared")
+
+    clusters = {}
+    for s, key in zip(strings, keys):
+        clusters.setdefault(center[key], []).append(s)
+    return [sorted(members, key=lambda s: (-freqs.get(s, 0), len(s), s)) for members in clusters.values()]
+
+
+def mass_edit_operations(clusters, column='normalized_string'):
+    """OpenRefine mass-edit operation mapping every member of a cluster to its representative"""
+    return [{
+        'op': 'core/mass-edit',
+        'engineConfig': {'facets': [], 'mode': 'row-based'},
+        'columnName': column,
+        'expression': 'value',
+        'edits': [{
+            'from': members,
+            'fromBlank': False,
+            'fromError': False,
+            'to': members[0],
+        } for members in clusters if len(members) > 1],
+        'description': f"Mass edit cells in column {column}",
+    }]
+
+
+def main(extracted=False):
+    # All strings of the stage-1 sources with their summed frequencies
+    with stage('load'):
+        theoriesof = merge_sources(load_sources(extracted))
+    freqs = dict(zip(theoriesof['normalized_string'], theoriesof['freq_total']))
+
+    with stage('cluster'):
+        clusters = cluster_strings(theoriesof['normalized_string'].tolist(), freqs=freqs)
+    merged = [members for members in clusters if len(members) > 1]
+    record(rows_in=len(theoriesof), clusters=len(clusters), merged_clusters=len(merged))
+    print(f"{len(theoriesof)} strings in {len(clusters)} clusters; "
+          f"{sum(len(m) for m in merged)} strings in {len(merged)} clusters of two or more")
+    for members in sorted(merged, key=len, reverse=True)[:10]:
+        print(f"  {members[0]!r} <- {members[1:6]}")
+
+    output_file = get_file_path("1_theoryof_transformations_rerun.json")
+    with open(output_file, 'w') as f:
+        json.dump(mass_edit_operations(clusters), f, indent=2)
+    print(f"Saved to {output_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cluster near-duplicate theory strings with MinHash-LSH")
+    parser.add_argument('--extracted', action='store_true',
+                        help="cluster the files written by extract_theories.py instead of the original ones")
+    add_arguments(parser)
+    args = parser.parse_args()
+    with from_args('cluster_theories', args):
+        main(extracted=args.extracted)
@@ -0,0 +1,167 @@
+"""
+Enrich Wikidata - Python replacement of the OpenRefine reconciliation step of 4search_wikidata.R
+
+Fetches date of birth (P569), sex or gender (P21), country of citizenship (P27)
+and the English description of every unique human found by search_wikidata.py.
+Items are sent ITEMS_PER_QUERY at a time in a VALUES block, several queries in
+parallel, and multi-valued properties are merged with "|", giving
+4_theorystrings_humans_extended.csv and its _withcategories variant.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import requests
+
+from api_client import make_session
+from catalog import get_file_path, load
+from instrumentation import add_arguments, from_args, record, stage
+from request_scheduler import RequestScheduler
+from response_cache import ResponseCache
+from search_wikidata import MAX_IN_FLIGHT, TIMEOUT_STATUSES, WIKIDATA_SPARQL_URL, fetch_bindings
+
+# Number of items sent together in one SPARQL query
+ITEMS_PER_QUERY = 100
+
+# Columns of 4_theorystrings_humans_extended.csv, and the query variable filling each one
+EXTENDED_COLUMNS = ['item', 'itemLabel', 'q_id', 'date of birth', 'description', 'sex_gender', 'country_citizenship']
+PROPERTY_VARIABLES = {
+    'date of birth': 'dob',
+    'description': 'description',
+    'sex_gender': 'sexGenderLabel',
+    'country_citizenship': 'countryLabel',
+}
+
+# Separator of multi-valued properties, as in the OpenRefine export
+MULTI_VALUE_SEPARATOR = "|"
+
+
+def enrich_query(qids):
+    """Create one SPARQL query fetching P569, P21, P27 and the description of several items"""
+    values = " ".join(f"wd:{qid}" for qid in qids)
+    return f'''SELECT ?item ?dob ?description ?sexGenderLabel ?countryLabel WHERE {{
+  VALUES ?item {{ {values} }}
+  OPTIONAL {{ ?item wdt:P569 ?dob. }}
+  OPTIONAL {{ ?item schema:description ?description. FILTER(LANG(?description) = "en") }}
+  OPTIONAL {{ ?item wdt:P21 ?sexGender. ?sexGender rdfs:label ?sexGenderLabel. FILTER(LANG(?sexGenderLabel) = "en") }}
+  OPTIONAL {{ ?item wdt:P27 ?country. ?country rdfs:label ?countryLabel. FILTER(LANG(?countryLabel) = "en") }}
+}}'''
+
+
+def qid(item):
+    """Q-identifier of a Wikidata entity URI"""
+    return item.rsplit('/', 1)[-1]
+
+
+def merge_properties(bindings):
+    """Collapse the rows of an enrichment query into one record per item, joining repeated values with "|".
+
+    Optional properties multiply into one row per combination of values, so
+    every column keeps each distinct value once, in order of appearance.
+    """
+    values = {}
+    for row in bindings:
+        record = values.setdefault(qid(row['item']), {column: [] for column in PROPERTY_VARIABLES})
+        for column, var in PROPERTY_VARIABLES.items():
+            value = row.get(var)
+            if value is not None and value not in record[column]:
+                record[column].append(value)
+    return {item: {column: MULTI_VALUE_SEPARATOR.join(v) if v else None for column, v in record.items()}
+            for item, record in values.items()}
+
+
+def enrich_batch(qids, cache=None, url=WIKIDATA_SPARQL_URL, scheduler=None, session=None):
+    """Fetch the properties of several items with one query.
+
+    Returns a dict mapping each QID to its properties. When the endpoint times
+    out, the batch is split in half and each half is retried. Items that still
+    fail are added to the scheduler's dead letters.
+    """
+    try:
+        bindings = fetch_bindings(enrich_query(qids), cache=cache, url=url, scheduler=scheduler, session=session)
+    except (requests.Timeout, requests.HTTPError, ValueError) as e:
+        timed_out = not isinstance(e, requests.HTTPError) or e.response.status_code in TIMEOUT_STATUSES
+        if timed_out and len(qids) > 1:
+            half = len(qids) // 2
+            print(f"Query for {len(qids)} items timed out, splitting into {half} + {len(qids) - half}")
+            merged = enrich_batch(qids[:half], cache=cache, url=url, scheduler=scheduler, session=session)
+            merged.update(enrich_batch(qids[half:], cache=cache, url=url, scheduler=scheduler, session=session))
+            return merged
+        return failed_batch(qids, e, scheduler)
+    except Exception as e:
+        return failed_batch(qids, e, scheduler)
+    return merge_properties(bindings)
+
+
+def failed_batch(qids, error, scheduler):
+    print(f"Query error for {len(qids)} items: {error}")
+    if scheduler is not None:
+        for item in qids:
+            scheduler.dead_letter(item, error)
+    return {}
+
+
+def main(use_cache=True, items_per_query=ITEMS_PER_QUERY, max_in_flight=MAX_IN_FLIGHT, unique_file=None,
+         humans_file=None, output_file=None, categories_file=None):
+    # Unique humans and (category, human) rows found by search_wikidata.py
+    unique_file = unique_file or get_file_path("4_theorystrings_categories_humans_unique.csv")
+    humans_file = humans_file or get_file_path("4_theorystrings_categories_humans.csv")
+    with stage('load'):
+        humans = load(unique_file, columns=['item', 'itemLabel'])
+    humans = humans.dropna(subset=['item']).drop_duplicates(subset=['item'])
+    qids = [qid(item) for item in humans['item']]
+    print(f"Enriching {len(qids)} items, {items_per_query} per query")
+
+    cache = ResponseCache() if use_cache else None
+    scheduler = RequestScheduler(max_concurrency=max_in_flight)
+    session = make_session(max_in_flight)
+
+    batches = [qids[k:k + items_per_query] for k in range(0, len(qids), items_per_query)]
+
+    def query(batch):
+        return enrich_batch(batch, cache=cache, scheduler=scheduler, session=session)
+
+    properties = {}
+    with stage('query'), ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for i, result in enumerate(executor.map(query, batches)):
+            properties.update(result)
+            print(f"Processed {min((i + 1) * items_per_query, len(qids))}/{len(qids)}...")
+    record(rows_in=len(qids), rows_out=len(properties), requests=scheduler.stats())
+
+    print(f"Requests: {scheduler.stats()}")
+    if scheduler.dead_letters:
+        print(f"{len(scheduler.dead_letters)} items failed and are left without properties")
+    if cache is not None:
+        print(f"Cache: {cache.stats()}")
+        record(cache=cache.stats())
+
+    # One row per person, in the order of the unique humans file
+    extended = humans[['item', 'itemLabel']].reset_index(drop=True)
+    extended['q_id'] = qids
+    details = pd.DataFrame([properties.get(q, {}) for q in qids], columns=list(PROPERTY_VARIABLES))
+    extended = pd.concat([extended, details], axis=1)[EXTENDED_COLUMNS]
+
+    output_file = output_file or get_file_path("4_theorystrings_humans_extended_rerun.csv")
+    extended.to_csv(output_file, index=False)
+    print(f"Saved {len(extended)} enriched items to {output_file}")
+
+    # Add the categories back, one row per (category, person) as in the R script's right join
+    categories = load(humans_file)
+    with_categories = categories.merge(extended, on=['itemLabel', 'item'], how='right')
+    with_categories = with_categories[['category'] + EXTENDED_COLUMNS]
+
+    categories_file = categories_file or get_file_path("4_theorystrings_humans_extended_withcategories_rerun.csv")
+    with_categories.to_csv(categories_file, index=False)
+    print(f"Saved {len(with_categories)} rows with categories to {categories_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add birth date, gender, citizenship and description to the humans")
+    parser.add_argument('--items-per-query', type=int, default=ITEMS_PER_QUERY,
+                        help="items sent together in one SPARQL query")
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT, help="most queries in flight at once")
+    parser.add_argument('--no-cache', action='store_true', help="ignore the on-disk response cache")
+    add_arguments(parser)
+    args = parser.parse_args()
+    with from_args('enrich_wikidata', args):
+        main(use_cache=not args.no_cache, items_per_query=args.items_per_query, max_in_flight=args.max_in_flight)
@@ -3,21 +3,10 @@ Explore Theorists - Python replication of 5explore_theorists.R
 """
 import pandas as pd
 import os
+import argparse
+from catalog import get_file_path, load
+from instrumentation import add_arguments, from_args
 
-def get_file_path(filename):
-    """Get path to data file. Rerun files stay in replication_code/data, others prefer original_project/data"""
-    original_data = os.path.join(os.path.dirname(__file__), "original_project", "data")
-    rerun_data = os.path.join(os.path.dirname(__file__), "data")
-
-    # If filename contains "rerun", use replication_code/data
-    if "rerun" in filename.lower():
-        return os.path.join(rerun_data, filename)
-
-    # Otherwise, prefer original_project/data, fall back to replication_code/data
-    original_path = os.path.join(original_data, filename)
-    if os.path.exists(original_path):
-        return original_path
-    return os.path.join(rerun_data, filename)
 
 # For backwards compatibility, set DATA_DIR to the base directory we'll use
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
@@ -30,19 +19,32 @@ def clean_names(df):
     return df
 
 
-def main():
-    # Check if extended data exists
-    extended_file = get_file_path("4_theory_dictionary_wikidata_extended.csv")
+# Extended tables in order of preference: enrich_wikidata.py's output, the original
+# project's OpenRefine export, and the R script's theory dictionary
+EXTENDED_FILES = [
+    "4_theorystrings_humans_extended_withcategories_rerun.csv",
+    "4_theorystrings_humans_extended_withcategories.csv",
+    "4_theory_dictionary_wikidata_extended.csv",
+]
 
-    if os.path.exists(extended_file):
-        data = pd.read_csv(extended_file)
-        data = clean_names(data)
-        print(f"Loaded extended data with {len(data)} rows")
+# Column names of the enriched tables, as named in the theory dictionary
+EXTENDED_COLUMNS = {'q_id': 'wikidata_id', 'sex_gender': 'sex_or_gender', 'country_citizenship': 'country_of_citizenship'}
+
+
+def main(extended_file=None):
+    # Check if extended data exists (the pipeline passes the table enrich_wikidata.py wrote)
+    if extended_file is None:
+        extended_file = next((get_file_path(f) for f in EXTENDED_FILES if os.path.exists(get_file_path(f))), None)
+
+    if extended_file is not None:
+        data = load(extended_file)
+        data = clean_names(data).rename(columns=EXTENDED_COLUMNS)
+        print(f"Loaded extended data with {len(data)} rows from {extended_file}")
         print(f"Columns: {data.columns.tolist()}")
     else:
         # Use the humans data we have
         humans_file = get_file_path("4_theorystrings_categories_humans.csv")
-        data = pd.read_csv(humans_file)
+        data = load(humans_file)
         data = clean_names(data)
         print(f"Using humans data with {len(data)} rows")
         print(f"Columns: {data.columns.tolist()}")
@@ -80,8 +82,12 @@ def main():
 
         # Top categories by number of persons
         print("\nTop categories by person count:")
-        print(data.groupby('category').size().sort_values(ascending=False).head(10))
+        print(data.groupby('category', observed=True).size().sort_values(ascending=False).head(10))
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Summarize the theorists found in Wikidata")
+    add_arguments(parser)
+    args = parser.parse_args()
+    with from_args('explore_theorists', args):
+        main()
@@ -0,0 +1,224 @@
+"""
+Extract Theories - build the stage-1 "theor* of" inputs from a plain-text corpus
+
+Streams .txt files in byte-range chunks through a process pool. Every worker
+counts "theory/theories of X" phrases and adjective/noun + theory phrases in its
+chunk, and the chunk counters are merged as they come back (map-reduce), so
+memory is bounded by the number of distinct phrases rather than by the corpus size.
+Writes the three files preprocessingdata.py starts from, with a _rerun suffix:
+1_theor_of_normalized_rerun.csv, 1_JJ_theor_rerun.csv and 1_NN_theor_rerun.csv.
+
+There is no POS tagger: the word before "theory"/"theories" counts as JJ when
+it is a common adjective or ends in an adjective suffix, and as NN otherwise.
+"""
+import argparse
+import os
+import re
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from catalog import get_file_path
+from instrumentation import add_arguments, from_args, record, stage
+
+# Corpus files are split into chunks of about this many bytes
+CHUNK_BYTES = 32 * 1024 * 1024
+
+# Most words kept after "theory of", as in the original query strings
+OF_WINDOW = 3
+
+TOKEN_PATTERN = re.compile(r"\w[\w'-]*|[^\w\s]")
+
+THEORY_HEADS = ('theory', 'theories')
+
+# Words before "theory" that are not modifiers, and that do not end a "theory of" phrase
+STOPWORDS = {
+    'a', 'an', 'the', 'this', 'that', 'these', 'those', 'of', 'in', 'on', 'to', 'for', 'and', 'or', 'with',
+    'by', 'as', 'at', 'from', 'into', 'its', 'their', 'his', 'her', 'our', 'my', 'your', 'is', 'are', 'was',
+    'were', 'be', 'been', 'no', 'not', 'than', 'which', 'what', 'whose', 'whether', 'if',
+}
+
+# Adjectives without a telling suffix that often modify "theory"
+ADJECTIVES = {
+    'new', 'old', 'such', 'other', 'many', 'various', 'same', 'own', 'recent', 'current', 'modern', 'high',
+    'grand', 'big', 'broad', 'good', 'bad', 'main', 'major', 'minor', 'key', 'late', 'early', 'true', 'whole',
+}
+
+ADJECTIVE_SUFFIXES = ('al', 'ic', 'ive', 'ous', 'ary', 'ory', 'ful', 'less', 'able', 'ible', 'ant', 'ent',
+                      'ar', 'ern', 'ish')
+
+
+def is_adjective(word):
+    """Guess whether the word before "theory" is an adjective (JJ) rather than a noun (NN)"""
+    if word[0].isupper():
+        # Capitalized modifiers are mostly names (Marlovian theory, Music Theory)
+        return False
+    lower = word.lower()
+    return lower in ADJECTIVES or (len(lower) > 4 and lower.endswith(ADJECTIVE_SUFFIXES))
+
+
+def is_word(token):
+    return token[:1].isalpha()
+
+
+def count_theories(lines):
+    """Count "theory/theories of" phrases and modifier + theory phrases in a stream of lines.
+
+    Returns three Counters: (query_string, normalized_string) pairs for
+    "theory of X" (cut at punctuation, without trailing stopwords), and the JJ
+    and NN + theory phrases.
+    """
+    of_counts, jj_counts, nn_counts = Counter(), Counter(), Counter()
+    window = deque(maxlen=OF_WINDOW + 3)
+
+    def check(window):
+        # window[1] is the token under inspection, window[0] the one before it
+        token = window[1].lower()
+        if token in THEORY_HEADS and len(window) > 2 and window[2].lower() == 'of':
+            # The phrase ends at the first punctuation mark and loses trailing stopwords
+            words = []
+            for t in list(window)[3:]:
+                if not is_word(t):
+                    break
+                words.append(t)
+            while words and words[-1].lower() in STOPWORDS:
+                words.pop()
+            if words:
+                query_string = " ".join([window[1], window[2]] + words).lower()
+                normalized = " ".join([token, 'of'] + [w.lower() for w in words])
+                of_counts[(query_string, normalized)] += 1
+        if token in THEORY_HEADS:
+            previous = window[0]
+            if is_word(previous) and previous.lower() not in STOPWORDS:
+                phrase = f"{previous} {window[1]}"
+                (jj_counts if is_adjective(previous) else nn_counts)[phrase] += 1
+
+    def push(token):
+        window.append(token)
+        if len(window) == window.maxlen:
+            check(window)
+
+    # Empty tokens pad the stream at both ends, so every token gets inspected
+    push('')
+    for line in lines:
+        for token in TOKEN_PATTERN.findall(line):
+            push(token)
+    for _ in range(window.maxlen - 2):
+        push('')
+    return of_counts, jj_counts, nn_counts
+
+
+def file_chunks(paths, chunk_bytes=CHUNK_BYTES):
+    """Split files into (path, start, end) byte ranges"""
+    for path in paths:
+        size = os.path.getsize(path)
+        for start in range(0, max(size, 1), chunk_bytes):
+            yield path, start, min(start + chunk_bytes, size)
+
+
+def read_chunk(path, start, end):
+    """Yield the lines that begin inside [start, end) of a file"""
+    with open(path, 'rb') as f:
+        if start > 0:
+            # Skip the line that began in the previous chunk
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line.decode('utf-8', errors='replace')
+
+
+def count_chunk(chunk):
+    """Worker: count the phrases of one byte range"""
+    return count_theories(read_chunk(*chunk))
+
+
+def corpus_files(paths):
+    """Expand directories into the .txt files they contain"""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.endswith('.txt'):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def extract(paths, processes=None, chunk_bytes=CHUNK_BYTES):
+    """Count the phrases of a corpus in parallel and merge the chunk counters"""
+    of_counts, jj_counts, nn_counts = Counter(), Counter(), Counter()
+    chunks = file_chunks(corpus_files(paths), chunk_bytes)
+    processes = processes or os.cpu_count() or 1
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # Keep only a couple of chunks per worker pending, so results never pile up
+        pending = set()
+        n_chunks = 0
+        for chunk in chunks:
+            pending.add(executor.submit(count_chunk, chunk))
+            if len(pending) < 2 * processes:
+                continue
+            done = next(as_completed(pending))
+            pending.remove(done)
+            for total, counts in zip((of_counts, jj_counts, nn_counts), done.result()):
+                total.update(counts)
+            n_chunks += 1
+        for done in as_completed(pending):
+            for total, counts in zip((of_counts, jj_counts, nn_counts), done.result()):
+                total.update(counts)
+            n_chunks += 1
+
+    print(f"Counted {n_chunks} chunks")
+    return of_counts, jj_counts, nn_counts
+
+
+def write_outputs(of_counts, jj_counts, nn_counts, min_freq=1):
+    """Write the three stage-1 files in the layout of the original project's files"""
+    theory = pd.DataFrame(
+        [(q, n, f) for (q, n), f in of_counts.items() if f >= min_freq],
+        columns=['query_string', 'normalized_string', 'freq']
+    ).sort_values(['freq', 'query_string'], ascending=[False, True], ignore_index=True)
+    # R's write.csv row names
+    theory.insert(0, '.', range(1, len(theory) + 1))
+
+    outputs = {
+        "1_theor_of_normalized_rerun.csv": theory,
+        "1_JJ_theor_rerun.csv": phrase_table(jj_counts, 'clustered_JJ_theor*', min_freq),
+        "1_NN_theor_rerun.csv": phrase_table(nn_counts, 'clustered_NN_theor*', min_freq),
+    }
+    for filename, df in outputs.items():
+        output_file = get_file_path(filename)
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        df.to_csv(output_file, index=False)
+        print(f"Saved {len(df)} rows to {output_file}")
+
+
+def phrase_table(counts, column, min_freq=1):
+    df = pd.DataFrame([(p, f) for p, f in counts.items() if f >= min_freq], columns=[column, 'token_count'])
+    return df.sort_values(['token_count', column], ascending=[False, True], ignore_index=True)
+
+
+def main(paths, processes=None, min_freq=1, chunk_bytes=CHUNK_BYTES):
+    with stage('extract'):
+        of_counts, jj_counts, nn_counts = extract(paths, processes=processes, chunk_bytes=chunk_bytes)
+    print(f"Distinct phrases: {len(of_counts)} theor* of, {len(jj_counts)} JJ theory, {len(nn_counts)} NN theory")
+    record(theor_of=len(of_counts), jj_theory=len(jj_counts), nn_theory=len(nn_counts))
+    with stage('write'):
+        write_outputs(of_counts, jj_counts, nn_counts, min_freq=min_freq)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract \"theor* of\" and JJ/NN + theory phrases from a text corpus")
+    parser.add_argument('corpus', nargs='+', help="plain-text files or directories of .txt files")
+    parser.add_argument('--processes', type=int, default=None, help="worker processes (default: all CPUs)")
+    parser.add_argument('--min-freq', type=int, default=1, help="drop phrases seen fewer times than this")
+    parser.add_argument('--chunk-mb', type=int, default=CHUNK_BYTES // (1024 * 1024),
+                        help="size of the byte ranges handed to the workers")
+    add_arguments(parser)
+    args = parser.parse_args()
+    with from_args('extract_theories', args):
+        main(args.corpus, processes=args.processes, min_freq=args.min_freq, chunk_bytes=args.chunk_mb * 1024 * 1024)
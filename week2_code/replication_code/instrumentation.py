@@ -0,0 +1,213 @@
+"""
+Instrumentation - per-stage timings, HTTP latency and counters, written as a JSON run report
+
+Every script opens a RunReport around its main() unless run with --no-report.
+Inside it, stage() blocks record wall and CPU time and peak RSS,
+instrument_session() records the latency and status code of every response of
+a requests session, and record() adds counters such as rows in/out or cache
+statistics. Outside a RunReport all of these are no-ops, so library code can
+call them unconditionally. With --profile, the named stage (or the whole run)
+is also run under cProfile.
+"""
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from catalog import CATALOG
+
+# Directory of the JSON reports and cProfile dumps
+REPORT_DIR = os.path.join(os.path.dirname(__file__), "data", "reports")
+
+# Upper bounds (ms) of the HTTP latency histogram buckets; the last bucket is open
+LATENCY_BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+_current = None
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process and of its finished children, in MB"""
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    scale = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) * scale / 2 ** 20, 1)
+
+
+def cpu_seconds():
+    """CPU time (user + system) of this process and of its finished children"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.statuses = {}
+
+    def add(self, ms, status):
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if ms <= bound), len(LATENCY_BUCKETS_MS))
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+
+    def to_dict(self):
+        labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        return {
+            'requests': self.count,
+            'mean_ms': round(self.total_ms / self.count, 1) if self.count else None,
+            'max_ms': round(self.max_ms, 1),
+            'histogram': dict(zip(labels, self.buckets)),
+            'status_codes': self.statuses,
+        }
+
+
+class RunReport:
+    """Collects stage timings, HTTP latencies and counters of one run and writes them as JSON"""
+
+    def __init__(self, name, profile=None, report_dir=REPORT_DIR):
+        self.name = name
+        self.profile = profile
+        self.report_dir = report_dir
+        self.started = time.strftime('%Y%m%d-%H%M%S')
+        self.path = os.path.join(report_dir, f"{name}-{self.started}.json")
+        self.stages = []
+        self.http = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._stack = []
+
+    def __enter__(self):
+        global _current
+        _current = self
+        self._run = self.stage('total', profile=self.profile is True)
+        self._run.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        global _current
+        # Hits and misses of the in-process artifact catalog over the whole run
+        self.record(catalog=CATALOG.stats())
+        self._run.__exit__(exc_type, exc, tb)
+        _current = None
+        if exc_type is not None:
+            self.counters['error'] = f"{exc_type.__name__}: {exc}"
+        self.write()
+        return False
+
+    @contextmanager
+    def stage(self, name, profile=False):
+        """Time a block: wall and CPU seconds and peak RSS, optionally under cProfile"""
+        profiler = cProfile.Profile() if profile or name == self.profile else None
+        entry = {'stage': name, 'parent': self._stack[-1] if self._stack else None}
+        self._stack.append(name)
+        wall, cpu = time.perf_counter(), cpu_seconds()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield entry
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                entry['profile'] = self.dump_profile(profiler, name)
+            self._stack.pop()
+            entry.update({
+                'wall_s': round(time.perf_counter() - wall, 3),
+                'cpu_s': round(cpu_seconds() - cpu, 3),
+                'peak_rss_mb': peak_rss_mb(),
+            })
+            with self._lock:
+                self.stages.append(entry)
+
+    def dump_profile(self, profiler, stage):
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = os.path.join(self.report_dir, f"{self.name}-{self.started}-{stage}.prof")
+        profiler.dump_stats(path)
+        print(f"Saved cProfile output of '{stage}' to {path} (view with: python -m pstats {path})")
+        return path
+
+    def observe_response(self, response, *args, **kwargs):
+        """requests response hook: record latency and status code per host"""
+        host = urlparse(response.url).netloc
+        with self._lock:
+            self.http.setdefault(host, LatencyHistogram()).add(
+                response.elapsed.total_seconds() * 1000, response.status_code)
+
+    def record(self, **counters):
+        """Set counters (numbers or dicts such as cache.stats()) of the current stage"""
+        stage = self._stack[-1] if self._stack else 'total'
+        with self._lock:
+            self.counters.setdefault(stage, {}).update(counters)
+
+    def to_dict(self):
+        return {
+            'run': self.name,
+            'started': self.started,
+            'argv': sys.argv,
+            'stages': self.stages,
+            'http': {host: histogram.to_dict() for host, histogram in self.http.items()},
+            'counters': self.counters,
+        }
+
+    def write(self):
+        os.makedirs(self.report_dir, exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+        print(f"Saved run report to {self.path}")
+
+
+def current():
+    """The RunReport of the running script, or None"""
+    return _current
+
+
+@contextmanager
+def stage(name):
+    """Time a block as a stage of the current run report (no-op without one)"""
+    if _current is None:
+        yield None
+    else:
+        with _current.stage(name) as entry:
+            yield entry
+
+
+def record(**counters):
+    """Record counters in the current run report (no-op without one)"""
+    if _current is not None:
+        _current.record(**counters)
+
+
+def instrument_session(session):
+    """Record the latency and status of every response of a requests session in the current run report"""
+    if _current is not None:
+        session.hooks['response'].append(_current.observe_response)
+    return session
+
+
+def add_arguments(parser):
+    """Add the --no-report and --profile options to a script's argument parser"""
+    parser.add_argument('--no-report', action='store_true',
+                        help="do not write the JSON run report (timings, HTTP latency, counters)")
+    parser.add_argument('--profile', nargs='?', const=True, default=None, metavar='STAGE',
+                        help="also write cProfile output of a stage (default: the whole run)")
+
+
+@contextmanager
+def from_args(name, args, report_dir=REPORT_DIR):
+    """Open a RunReport unless the script was started with --no-report"""
+    if args.no_report:
+        yield None
+        return
+    with RunReport(name, profile=args.profile, report_dir=report_dir) as report:
+        yield report
@@ -5,32 +5,103 @@ import pandas as pd
 import numpy as np
 import textdistance
 import os
+import argparse
+from collections import Counter
+from scipy import sparse
+from artifacts import FORMATS, convert_artifact, schema_for, write_artifact
+from catalog import get_file_path, load
+from instrumentation import add_arguments, from_args, record, stage
 
-def get_file_path(filename):
-    """Get path to data file. Rerun files stay in replication_code/data, others prefer original_project/data"""
-    original_data = os.path.join(os.path.dirname(__file__), "original_project", "data")
-    rerun_data = os.path.join(os.path.dirname(__file__), "data")
-
-    # If filename contains "rerun", use replication_code/data
-    if "rerun" in filename.lower():
-        return os.path.join(rerun_data, filename)
-
-    # Otherwise, prefer original_project/data, fall back to replication_code/data
-    original_path = os.path.join(original_data, filename)
-    if os.path.exists(original_path):
-        return original_path
-    return os.path.join(rerun_data, filename)
 
 # For backwards compatibility, set DATA_DIR to the base directory we'll use
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 
 
+# Number of string pairs scored per sparse block in jaccard_qgram_distances
+PAIR_BLOCK_SIZE = 200000
+
+# Keep categories whose Jaccard distance to their query string is below this
+JAC_THRESHOLD = 0.6
+
+# Rows the Jaccard filter drops are never written, so their Levenshtein distance
+# is only computed up to this bound (further pairs get LEV_BOUND + 1)
+LEV_BOUND = 10
+
+# Strange keywords found in the wordcloud, excluded from categories and snippets
+EXCLUDE_PATTERN = r'WikiProject|Wikipedia|[C|c]onspiracy|Christ|[M|m]ilitary|articles|journals|missing|Satanic|[T|t]errorism|abuse|backlog|Lists|albums'
+SNIPPET_EXCLUDE = r'[C|c]onspiracy|[T|t]elevision|Nazis'
+
+
+def qgram_set(s, q=3):
+    """Return the set of q-grams (substrings of length q) of a string"""
+    return {s[i:i + q] for i in range(len(s) - q + 1)}
+
+
 def calculate_jaccard_qgram(s1, s2, q=3):
-    """Calculate Jaccard distance using q-grams (similar to R stringdist with method='jaccard')"""
+    """Calculate Jaccard distance using q-grams (same as R stringdist with method='jaccard')"""
     if pd.isna(s1) or pd.isna(s2):
         return np.nan
-    s1, s2 = str(s1).lower(), str(s2).lower()
-    return 1 - textdistance.jaccard.normalized_similarity(s1, s2)
+    a, b = qgram_set(str(s1), q), qgram_set(str(s2), q)
+    # Two strings without any q-grams count as identical, as in stringdist
+    if not a and not b:
+        return 0.0
+    return 1 - len(a & b) / len(a | b)
+
+
+def qgram_matrix(strings, q=3):
+    """Encode strings as rows of a sparse binary matrix over their q-grams"""
+    vocabulary = {}
+    rows, cols = [], []
+    for row, s in enumerate(strings):
+        for gram in qgram_set(s, q):
+            rows.append(row)
+            cols.append(vocabulary.setdefault(gram, len(vocabulary)))
+    data = np.ones(len(rows), dtype=np.int32)
+    return sparse.csr_matrix((data, (rows, cols)), shape=(len(strings), max(len(vocabulary), 1)))
+
+
+def jaccard_qgram_distances(strings1, strings2, q=3):
+    """Calculate Jaccard q-gram distances for two aligned sequences of strings at once.
+
+    Each unique string is turned into a q-gram set only once, and each unique pair
+    is scored once, by sparse row products. Gives the same values as calling
+    calculate_jaccard_qgram on every pair.
+    """
+    s1 = pd.Series(strings1, dtype=object).reset_index(drop=True)
+    s2 = pd.Series(strings2, dtype=object).reset_index(drop=True)
+    n = len(s1)
+
+    # One code per unique string across both sides; missing values get -1
+    codes, uniques = pd.factorize(pd.concat([s1, s2], ignore_index=True))
+    uniques = [str(u) for u in uniques]
+    left, right = codes[:n], codes[n:]
+    missing = (left < 0) | (right < 0)
+
+    distances = np.full(n, np.nan)
+    if missing.all():
+        return distances
+
+    matrix = qgram_matrix(uniques, q)
+    sizes = np.asarray(matrix.getnnz(axis=1))
+
+    # Score each unique (left, right) pair once
+    pairs = np.stack([left[~missing], right[~missing]], axis=1)
+    unique_pairs, pair_index = np.unique(pairs, axis=0, return_inverse=True)
+
+    pair_distances = np.empty(len(unique_pairs))
+    for start in range(0, len(unique_pairs), PAIR_BLOCK_SIZE):
+        block = unique_pairs[start:start + PAIR_BLOCK_SIZE]
+        i, j = block[:, 0], block[:, 1]
+        intersection = np.asarray(matrix[i].multiply(matrix[j]).sum(axis=1)).ravel()
+        union = sizes[i] + sizes[j] - intersection
+        with np.errstate(invalid='ignore', divide='ignore'):
+            block_distances = 1 - intersection / union
+        # Two strings without any q-grams count as identical, as in stringdist
+        block_distances[union == 0] = 0.0
+        pair_distances[start:start + len(block)] = block_distances
+
+    distances[~missing] = pair_distances[pair_index.ravel()]
+    return distances
 
 
 def calculate_levenshtein(s1, s2):
@@ -40,64 +111,197 @@ def calculate_levenshtein(s1, s2):
     return textdistance.levenshtein.distance(str(s1), str(s2))
 
 
-def main():
+def bounded_levenshtein(s1, s2, max_distance=None):
+    """Calculate Levenshtein distance, stopping early once it must exceed max_distance.
+
+    Pairs further apart than max_distance get max_distance + 1.
+    """
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    if max_distance is not None and len(s1) - len(s2) > max_distance:
+        return max_distance + 1
+
+    previous = list(range(len(s2) + 1))
+    for i, c1 in enumerate(s1, 1):
+        current = [i]
+        for j, c2 in enumerate(s2, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (c1 != c2)))
+        # Distances never shrink from one row to the next
+        if max_distance is not None and min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+
+    if max_distance is not None and previous[-1] > max_distance:
+        return max_distance + 1
+    return previous[-1]
+
+
+def levenshtein_distances(strings1, strings2, max_distance=None):
+    """Calculate Levenshtein distances for two aligned sequences of strings.
+
+    Repeated pairs are scored once. With max_distance, pairs further apart get
+    max_distance + 1.
+    """
+    s1 = pd.Series(strings1, dtype=object).reset_index(drop=True)
+    s2 = pd.Series(strings2, dtype=object).reset_index(drop=True)
+    missing = (s1.isna() | s2.isna()).to_numpy()
+
+    distances = np.full(len(s1), np.nan)
+    if missing.all():
+        return distances
+
+    # One code per unique (s1, s2) pair
+    pairs = pd.MultiIndex.from_arrays([s1[~missing].astype(str), s2[~missing].astype(str)])
+    codes, unique_pairs = pairs.factorize()
+    unique_distances = np.array([bounded_levenshtein(a, b, max_distance) for a, b in unique_pairs], dtype=float)
+    distances[~missing] = unique_distances[codes]
+    return distances
+
+
+def add_distances(categories_wikipedia, max_distance=LEV_BOUND):
+    """Add the category, jac and lev columns to a frame of category search results.
+
+    lev is exact for the rows the Jaccard filter keeps; for the others it stops
+    at max_distance (None computes it exactly everywhere).
+    """
+    # Delete "Category:" string to match and compare with query string
+    categories_wikipedia['category'] = categories_wikipedia['title'].str.replace('Category:', '', regex=False)
+
+    categories_wikipedia['jac'] = jaccard_qgram_distances(
+        categories_wikipedia['category'], categories_wikipedia['query_string'], q=3
+    )
+
+    close = (categories_wikipedia['jac'] < JAC_THRESHOLD).to_numpy()
+    lev = np.empty(len(categories_wikipedia))
+    lev[close] = levenshtein_distances(categories_wikipedia['category'][close],
+                                       categories_wikipedia['query_string'][close])
+    lev[~close] = levenshtein_distances(categories_wikipedia['category'][~close],
+                                        categories_wikipedia['query_string'][~close], max_distance=max_distance)
+    categories_wikipedia['lev'] = pd.array(lev, dtype='Int64')
+    return categories_wikipedia
+
+
+def filter_categories(categories_wikipedia):
+    """Keep close categories (jac < JAC_THRESHOLD) without strange keywords"""
+    return categories_wikipedia[
+        (categories_wikipedia['jac'] < JAC_THRESHOLD) &
+        (~categories_wikipedia['category'].str.contains(EXCLUDE_PATTERN, regex=True, na=False)) &
+        (~categories_wikipedia['snippet'].str.contains(SNIPPET_EXCLUDE, regex=True, na=False))
+    ].copy()
+
+
+def main(chunksize=None, fmt='csv', input_file=None, output_file=None):
+    if input_file is None:
+        input_file = get_file_path("2_wikipediacategoriesfromquery.csv")
+    if chunksize is not None:
+        return main_chunked(chunksize, fmt=fmt, input_file=input_file, output_file=output_file)
+
     # Read categories retrieved from matching with "theory of" strings
-    categories_wikipedia = pd.read_csv(get_file_path("2_wikipediacategoriesfromquery.csv"))
+    with stage('load'):
+        categories_wikipedia = load(input_file)
+    record(rows_in=len(categories_wikipedia))
 
     print(f"Columns: {categories_wikipedia.columns.tolist()}")
     print(f"Unique titles: {categories_wikipedia['title'].nunique()}")
     print(f"Unique query strings: {categories_wikipedia['query_string'].nunique()}")
 
     # Count number of categories by each "theory of" string
-    catcountbystring = categories_wikipedia.groupby('query_string')['title'].nunique().reset_index()
+    catcountbystring = categories_wikipedia.groupby('query_string', observed=True)['title'].nunique().reset_index()
     catcountbystring.columns = ['query_string', 'count']
 
     print("\nCategories count by query string:")
     print(catcountbystring.describe())
 
-    # Delete "Category:" string to match and compare with query string
-    categories_wikipedia['category'] = categories_wikipedia['title'].str.replace('Category:', '', regex=False)
-
     # Calculate Jaccard and Levenshtein distances
     print("\nCalculating distances (this may take a moment)...")
-
-    categories_wikipedia['jac'] = categories_wikipedia.apply(
-        lambda row: calculate_jaccard_qgram(row['category'], row['query_string']), axis=1
-    )
-
-    categories_wikipedia['lev'] = categories_wikipedia.apply(
-        lambda row: calculate_levenshtein(row['category'], row['query_string']), axis=1
-    )
-
+    with stage('distances'):
+        add_distances(categories_wikipedia)
     print("Distance calculations complete")
 
     # Category count
-    cat_count = categories_wikipedia.groupby('category').size().reset_index(name='n')
+    cat_count = categories_wikipedia.groupby('category', observed=True).size().reset_index(name='n')
     print(f"\nUnique categories: {len(cat_count)}")
     print("\nTop 20 categories:")
     print(cat_count.nlargest(20, 'n'))
 
     # Filter categories by Jaccard distance
-    df_filtered = categories_wikipedia[categories_wikipedia['jac'] < 0.6].copy()
-    print(f"\nAfter jac < 0.6 filter: {len(df_filtered)} rows")
+    df_filtered = categories_wikipedia[categories_wikipedia['jac'] < JAC_THRESHOLD].copy()
+    print(f"\nAfter jac < {JAC_THRESHOLD} filter: {len(df_filtered)} rows")
 
     # Filter by strange keywords
-    exclude_pattern = r'WikiProject|Wikipedia|[C|c]onspiracy|Christ|[M|m]ilitary|articles|journals|missing|Satanic|[T|t]errorism|abuse|backlog|Lists|albums'
-    snippet_exclude = r'[C|c]onspiracy|[T|t]elevision|Nazis'
-
-    df_filtered = categories_wikipedia[
-        (categories_wikipedia['jac'] < 0.6) &
-        (~categories_wikipedia['category'].str.contains(exclude_pattern, regex=True, na=False)) &
-        (~categories_wikipedia['snippet'].str.contains(snippet_exclude, regex=True, na=False))
-    ].copy()
-
+    df_filtered = filter_categories(categories_wikipedia)
     print(f"After filtering: {len(df_filtered)} rows")
+    record(rows_out=len(df_filtered))
 
     # Save filtered categories
-    output_file = get_file_path("3_wikicategories_distances_filtered_rerun.csv")
-    df_filtered.to_csv(output_file, index=False)
+    output_file = output_file or get_file_path("3_wikicategories_distances_filtered_rerun.csv")
+    with stage('write'):
+        write_artifact(df_filtered, output_file, fmt)
+    print(f"Saved filtered categories to {output_file}")
+
+
+def main_chunked(chunksize, fmt='csv', input_file=None, output_file=None):
+    """Run the distance/filter pass over fixed-size chunks of the category file.
+
+    Only one chunk is held in memory at a time; survivors are appended to the
+    output and the category counts are kept as running aggregates.
+    """
+    if input_file is None:
+        input_file = get_file_path("2_wikipediacategoriesfromquery.csv")
+    output_file = output_file or get_file_path("3_wikicategories_distances_filtered_rerun.csv")
+
+    titles_by_string = {}
+    cat_count = Counter()
+    n_rows = n_close = n_kept = 0
+    header = True
+
+    print(f"Calculating distances in chunks of {chunksize} rows...")
+    with stage('distances'):
+        for chunk in pd.read_csv(input_file, chunksize=chunksize, dtype=schema_for(input_file) or None):
+            # Distinct titles per "theory of" string
+            titled = chunk.dropna(subset=['title'])
+            for query_string, titles in titled.groupby('query_string', observed=True)['title'].unique().items():
+                titles_by_string.setdefault(query_string, set()).update(titles)
+
+            add_distances(chunk)
+            cat_count.update(chunk['category'].dropna())
+
+            df_filtered = filter_categories(chunk)
+            df_filtered.to_csv(output_file, mode='w' if header else 'a', header=header, index=False)
+            header = False
+
+            n_rows += len(chunk)
+            n_close += int((chunk['jac'] < JAC_THRESHOLD).sum())
+            n_kept += len(df_filtered)
+            print(f"Processed {n_rows} rows...")
+    record(rows_in=n_rows, rows_out=n_kept)
+
+    catcountbystring = pd.DataFrame(
+        [(query_string, len(titles)) for query_string, titles in titles_by_string.items()],
+        columns=['query_string', 'count']
+    )
+    print(f"\nUnique query strings: {len(catcountbystring)}")
+    print("\nCategories count by query string:")
+    print(catcountbystring.describe())
+
+    cat_count = pd.DataFrame(list(cat_count.items()), columns=['category', 'n'])
+    print(f"\nUnique categories: {len(cat_count)}")
+    print("\nTop 20 categories:")
+    print(cat_count.nlargest(20, 'n'))
+
+    print(f"\nAfter jac < {JAC_THRESHOLD} filter: {n_close} rows")
+    print(f"After filtering: {n_kept} rows")
     print(f"Saved filtered categories to {output_file}")
+    convert_artifact(output_file, fmt)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Calculate distances and filter Wikipedia categories")
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help="stream the category file in chunks of this many rows")
+    parser.add_argument('--format', choices=FORMATS, default='csv',
+                        help="also write a typed columnar copy of the output (needs pyarrow)")
+    add_arguments(parser)
+    args = parser.parse_args()
+    with from_args('jac_distance_categories', args):
+        main(chunksize=args.chunksize, fmt=args.format)
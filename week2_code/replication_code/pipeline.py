@@ -0,0 +1,246 @@
+"""
+Pipeline - run the replication stages as a DAG, skipping stages whose inputs did not change
+
+Each stage records a content hash of its input files, its parameters (module
+constants such as JAC_THRESHOLD and the exclude patterns) and the source code
+of its module and the repo modules it imports in data/pipeline_state.json. A
+stage is re-executed only when that hash changes or one of its outputs is
+missing or was modified since it was written. Stages write _rerun files in
+replication_code/data, never into the original project's data.
+"""
+import argparse
+import ast
+import hashlib
+import importlib
+import json
+import os
+import time
+
+import instrumentation
+from catalog import file_hash, get_file_path
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(CODE_DIR, "data")
+STATE_FILE = os.path.join(DATA_DIR, "pipeline_state.json")
+
+
+class Stage:
+    """One pipeline stage: a module whose main() turns input files into output files.
+
+    inputs maps keyword arguments of main() to the file (or tuple of files) passed
+    in them, so a stage always reads the outputs its dependencies just wrote;
+    outputs maps keyword arguments of main() to the files the stage writes.
+    """
+
+    def __init__(self, name, module, inputs, outputs, params=(), deps=()):
+        self.name = name
+        self.module = module
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params
+        self.deps = deps
+
+    def arguments(self):
+        """Keyword arguments of main(): the paths of the input and output files"""
+        arguments = {keyword: tuple(get_file_path(f) for f in entry) if isinstance(entry, tuple)
+                     else get_file_path(entry) for keyword, entry in self.inputs.items()}
+        arguments.update((keyword, get_file_path(f)) for keyword, f in self.outputs.items())
+        return arguments
+
+    def output_paths(self):
+        """Paths of the files the stage writes"""
+        return [get_file_path(f) for f in self.outputs.values()]
+
+
+STAGES = [
+    Stage('preprocess', 'preprocessingdata',
+          inputs={'files': ("1_JJ_theor_.csv", "1_NN_theor_.csv", "1_theor_of_normalized.csv")},
+          outputs={'output_file': "1_theoriesof_complete_rerun.csv"}),
+    Stage('query_wikipedia', 'query_wikipedia',
+          inputs={'strings_file': "1_theoriesof_complete_rerun.csv"},
+          outputs={'output_file': "2_wikipediacategoriesfromquery_rerun.csv"},
+          params=['WIKIPEDIA_API_URL'],
+          deps=['preprocess']),
+    Stage('jac_distance', 'jac_distance_categories',
+          inputs={'input_file': "2_wikipediacategoriesfromquery_rerun.csv"},
+          outputs={'output_file': "3_wikicategories_distances_filtered_rerun.csv"},
+          params=['JAC_THRESHOLD', 'EXCLUDE_PATTERN', 'SNIPPET_EXCLUDE'],
+          deps=['query_wikipedia']),
+    Stage('search_wikidata', 'search_wikidata',
+          inputs={'filtered_file': "3_wikicategories_distances_filtered_rerun.csv"},
+          outputs={'output_file': "4_theorystrings_categories_humans_rerun.csv",
+                   'unique_output_file': "4_theorystrings_categories_humans_unique_rerun.csv"},
+          params=['WIKIDATA_SPARQL_URL'],
+          deps=['jac_distance']),
+    Stage('enrich_wikidata', 'enrich_wikidata',
+          inputs={'unique_file': "4_theorystrings_categories_humans_unique_rerun.csv",
+                  'humans_file': "4_theorystrings_categories_humans_rerun.csv"},
+          outputs={'output_file': "4_theorystrings_humans_extended_rerun.csv",
+                   'categories_file': "4_theorystrings_humans_extended_withcategories_rerun.csv"},
+          params=['ITEMS_PER_QUERY'],
+          deps=['search_wikidata']),
+    Stage('explore_theorists', 'explore_theorists',
+          inputs={'extended_file': "4_theorystrings_humans_extended_withcategories_rerun.csv"},
+          outputs={},
+          deps=['enrich_wikidata']),
+]
+
+
+def check_wiring(stages):
+    """Make sure every input that a stage of the pipeline writes comes from one of the reader's deps.
+
+    Stages may only write into replication_code/data, so a run never overwrites the original project's files.
+    """
+    producers = {filename: stage.name for stage in stages for filename in stage.outputs.values()}
+    for stage in stages:
+        for path in stage.output_paths():
+            if os.path.dirname(path) != DATA_DIR:
+                raise ValueError(f"Stage '{stage.name}' would write {path} outside {DATA_DIR}; "
+                                 f"give its outputs _rerun names")
+        for entry in stage.inputs.values():
+            for filename in entry if isinstance(entry, tuple) else (entry,):
+                producer = producers.get(filename)
+                if producer is not None and producer != stage.name and producer not in stage.deps:
+                    raise ValueError(f"Stage '{stage.name}' reads {filename} from '{producer}' "
+                                     f"without depending on it")
+
+
+def local_imports(source):
+    """Names of the modules in replication_code that a piece of source code imports"""
+    names = set()
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.add(node.module.split('.')[0])
+    return {name for name in names if os.path.exists(os.path.join(CODE_DIR, name + ".py"))}
+
+
+def code_hashes(module_name):
+    """Hash the source of a module and of every replication_code module it imports, directly or not"""
+    hashes, pending = {}, [module_name]
+    while pending:
+        name = pending.pop()
+        if name in hashes:
+            continue
+        with open(os.path.join(CODE_DIR, name + ".py"), 'rb') as f:
+            source = f.read()
+        hashes[name] = hashlib.sha256(source).hexdigest()
+        pending.extend(local_imports(source))
+    return hashes
+
+
+def stage_hash(stage, memo):
+    """Hash everything a stage's result depends on: inputs, parameters and code"""
+    module = importlib.import_module(stage.module)
+    inputs = {}
+    for keyword, paths in stage.arguments().items():
+        if keyword in stage.outputs:
+            continue
+        for i, path in enumerate(paths if isinstance(paths, tuple) else (paths,)):
+            inputs[f"{keyword}[{i}]"] = file_hash(path, memo)
+    fingerprint = {
+        'inputs': inputs,
+        'params': {name: repr(getattr(module, name)) for name in stage.params},
+        'code': code_hashes(stage.module),
+    }
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def topological_order(stages):
+    """Order stages so that every stage comes after the stages it depends on"""
+    by_name = {stage.name: stage for stage in stages}
+    ordered, visiting, done = [], set(), set()
+
+    def visit(stage):
+        if stage.name in done:
+            return
+        if stage.name in visiting:
+            raise ValueError(f"Pipeline has a cycle through stage '{stage.name}'")
+        visiting.add(stage.name)
+        for dep in stage.deps:
+            visit(by_name[dep])
+        visiting.discard(stage.name)
+        done.add(stage.name)
+        ordered.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return ordered
+
+
+def load_state(path=STATE_FILE):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {'stages': {}, 'files': {}}
+
+
+def save_state(state, path=STATE_FILE):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(state, f, indent=2)
+
+
+def run(stages=STAGES, force=(), dry_run=False, state_file=STATE_FILE):
+    """Run the stages in dependency order, skipping the ones that are up to date"""
+    check_wiring(stages)
+    state = load_state(state_file)
+    memo = state['files']
+    skipped = []
+    rerun = set()
+
+    for stage in topological_order(stages):
+        current = stage_hash(stage, memo)
+        record = state['stages'].get(stage.name, {})
+        outputs = {path: file_hash(path, memo) for path in stage.output_paths()}
+        outputs_intact = all(h is not None and record.get('outputs', {}).get(p) == h for p, h in outputs.items())
+
+        # A dry run does not produce the new outputs of the stages it would rerun, so the
+        # stages downstream of them still hash the old files and have to be counted as dirty
+        stale_deps = [dep for dep in stage.deps if dep in rerun] if dry_run else []
+
+        if stage.name in force:
+            reason = "forced"
+        elif record.get('hash') != current:
+            reason = "inputs, parameters or code changed"
+        elif not outputs_intact:
+            reason = "outputs missing or modified"
+        elif stale_deps:
+            reason = f"upstream stage {', '.join(stale_deps)} reruns"
+        else:
+            print(f"[{stage.name}] up to date, skipping")
+            skipped.append(stage.name)
+            continue
+
+        print(f"[{stage.name}] {reason}, running {stage.module}.main()")
+        rerun.add(stage.name)
+        if dry_run:
+            continue
+
+        start = time.time()
+        # Each stage shows up in the run report with its own stages nested under it
+        with instrumentation.stage(stage.name):
+            importlib.import_module(stage.module).main(**stage.arguments())
+        print(f"[{stage.name}] finished in {time.time() - start:.1f}s")
+
+        state['stages'][stage.name] = {
+            'hash': current,
+            'outputs': {path: file_hash(path, memo) for path in stage.output_paths()},
+            'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        save_state(state, state_file)
+
+    instrumentation.record(skipped=skipped)
+    save_state(state, state_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the replication pipeline, re-executing only changed stages")
+    parser.add_argument('--force', nargs='*', default=[], metavar='STAGE',
+                        help="stages to run even if they are up to date")
+    parser.add_argument('--dry-run', action='store_true', help="only report which stages would run")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    with instrumentation.from_args('pipeline', args):
+        run(force=set(args.force), dry_run=args.dry_run)
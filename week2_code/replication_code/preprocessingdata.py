@@ -1,23 +1,14 @@
 """
 Preprocessing Data - Python replication of 1preprocessingdata.R
 """
+import numpy as np
 import pandas as pd
 import os
+import json
+import argparse
+from catalog import get_file_path, load
+from instrumentation import add_arguments, from_args, record, stage
 
-def get_file_path(filename):
-    """Get path to data file. Rerun files stay in replication_code/data, others prefer original_project/data"""
-    original_data = os.path.join(os.path.dirname(__file__), "original_project", "data")
-    rerun_data = os.path.join(os.path.dirname(__file__), "data")
-
-    # If filename contains "rerun", use replication_code/data
-    if "rerun" in filename.lower():
-        return os.path.join(rerun_data, filename)
-
-    # Otherwise, prefer original_project/data, fall back to replication_code/data
-    original_path = os.path.join(original_data, filename)
-    if os.path.exists(original_path):
-        return original_path
-    return os.path.join(rerun_data, filename)
 
 # For backwards compatibility, set DATA_DIR to the base directory we'll use
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
@@ -36,97 +27,135 @@ def clean_names(df):
     return df
 
 
-def main():
-    # Read data
-    jjtheory = pd.read_csv(get_file_path("1_JJ_theor_.csv"))
-    nntheory = pd.read_csv(get_file_path("1_NN_theor_.csv"))
-    theory = pd.read_csv(get_file_path("1_theor_of_normalized.csv"))
+def merge_sources(sources):
+    """Outer-join any number of (key, freq) frames on the key in one pass.
+
+    Returns one row per distinct key with a numeric freq_<name> column per
+    source (NA where the source lacks the key), their sum in freq_total, and a
+    bitmask of the sources that contain the key.
+    """
+    names = list(sources)
+    keys = pd.concat([df.iloc[:, 0] for df in sources.values()], ignore_index=True)
+    freqs = pd.concat([pd.to_numeric(df.iloc[:, 1], errors='coerce') for df in sources.values()],
+                      ignore_index=True).fillna(0).to_numpy()
+    source_ids = np.repeat(np.arange(len(names)), [len(df) for df in sources.values()])
+
+    present = keys.notna().to_numpy()
+    codes, uniques = pd.factorize(keys[present], sort=True)
+    source_ids = source_ids[present]
+
+    totals = np.zeros((len(uniques), len(names)))
+    np.add.at(totals, (codes, source_ids), freqs[present])
+    mask = np.zeros(len(uniques), dtype=np.int64)
+    np.bitwise_or.at(mask, codes, np.left_shift(1, source_ids))
+
+    merged = pd.DataFrame({'normalized_string': uniques})
+    for i, name in enumerate(names):
+        has_key = (mask & (1 << i)) != 0
+        merged[f'freq_{name}'] = pd.array(np.where(has_key, totals[:, i], np.nan)).astype('Int64')
+    merged['freq_total'] = totals.sum(axis=1).astype(np.int64)
+    merged['sources'] = mask
+    return merged
+
+
+def unique_to_each(merged, names):
+    """Return the keys found in exactly one source, per source, from the merge bitmask"""
+    # Keys that differ only by surrounding whitespace count as the same string
+    codes, stripped = pd.factorize(merged['normalized_string'].str.strip())
+    mask = np.zeros(len(stripped), dtype=np.int64)
+    np.bitwise_or.at(mask, codes, merged['sources'].to_numpy())
+    return {name: stripped[mask == (1 << i)] for i, name in enumerate(names)}
+
+
+def load_sources(extracted=False, files=None):
+    """Read the (key, frequency) columns of every "theor* of" source.
+
+    Reads the original project's files, or the ones written by extract_theories.py;
+    files, when given, are the paths of the JJ, NN and theory files to read instead.
+    """
+    if files is None:
+        if extracted:
+            names = ("1_JJ_theor_rerun.csv", "1_NN_theor_rerun.csv", "1_theor_of_normalized_rerun.csv")
+        else:
+            names = ("1_JJ_theor_.csv", "1_NN_theor_.csv", "1_theor_of_normalized.csv")
+        files = [get_file_path(name) for name in names]
+    jjtheory, nntheory, theory = (clean_names(load(f)) for f in files)
 
     print(f"JJ Theory shape: {jjtheory.shape}")
     print(f"NN Theory shape: {nntheory.shape}")
     print(f"Theory shape: {theory.shape}")
-
-    # Clean column names
-    jjtheory = clean_names(jjtheory)
-    nntheory = clean_names(nntheory)
-    theory = clean_names(theory)
-
-    print("After cleaning:")
     print(f"JJ Theory columns: {jjtheory.columns.tolist()}")
     print(f"NN Theory columns: {nntheory.columns.tolist()}")
     print(f"Theory columns: {theory.columns.tolist()}")
 
-    # Rename columns for consistency
-    jjtheory = jjtheory.rename(columns={'clustered_jj_theor': 'clustered_string', 'token_count': 'freq'})
-    nntheory = nntheory.rename(columns={'clustered_nn_theor': 'clustered_string', 'token_count': 'freq'})
-    theory = theory.rename(columns={'_': 'index'})
-
-    # Join all "theories of" strings using full outer join
-    theoriesof = pd.merge(
-        theory[['normalized_string', 'freq']],
-        jjtheory,
-        left_on='normalized_string',
-        right_on='clustered_string',
-        how='outer',
-        suffixes=('_theory', '_jj')
-    )
-
-    theoriesof = pd.merge(
-        theoriesof,
-        nntheory,
-        left_on='normalized_string',
-        right_on='clustered_string',
-        how='outer',
-        suffixes=('', '_nn')
-    )
-
-    # Fill normalized_string with values from clustered_string columns where null
-    theoriesof['normalized_string'] = (
-        theoriesof['normalized_string']
-        .fillna(theoriesof['clustered_string'])
-    )
-    if 'clustered_string_nn' in theoriesof.columns:
-        theoriesof['normalized_string'] = theoriesof['normalized_string'].fillna(theoriesof['clustered_string_nn'])
-
-    # Unite freq columns
-    freq_cols = [col for col in theoriesof.columns if 'freq' in col.lower()]
-    theoriesof['combined_freq'] = theoriesof[freq_cols].fillna('').astype(str).agg('|'.join, axis=1)
-    theoriesof['combined_freq'] = theoriesof['combined_freq'].str.replace(r'\|+', '|', regex=True).str.strip('|')
-
-    # Count normalized strings
-    print("\nCount of normalized strings:")
-    print(theoriesof['normalized_string'].value_counts().head(20))
+    return {
+        'theory': theory[['normalized_string', 'freq']],
+        'jj': jjtheory[['clustered_jj_theor', 'token_count']],
+        'nn': nntheory[['clustered_nn_theor', 'token_count']],
+    }
+
+
+def mass_edits(transformations, column='normalized_string'):
+    """Collect the from -> to mapping of the OpenRefine mass edits on a column"""
+    mapping = {}
+    for op in transformations:
+        if op.get('op') != 'core/mass-edit' or op.get('columnName') != column:
+            continue
+        for edit in op['edits']:
+            for value in edit['from']:
+                mapping[value] = edit['to']
+    return mapping
+
+
+def main(extracted=False, transformations=None, files=None, output_file=None):
+    with stage('load'):
+        sources = load_sources(extracted, files)
+    record(rows_in=sum(len(df) for df in sources.values()))
+
+    # Map string variants to their cluster representative (e.g. from cluster_theories.py)
+    if transformations is not None:
+        with open(transformations) as f:
+            mapping = mass_edits(json.load(f))
+        sources = {name: df.assign(**{df.columns[0]: df.iloc[:, 0].replace(mapping)})
+                   for name, df in sources.items()}
+        print(f"Applied {len(mapping)} mass edits from {transformations}")
+
+    # Join all "theories of" strings in a single outer join
+    with stage('merge'):
+        theoriesof = merge_sources(sources)
+    print(f"\nMerged {len(theoriesof)} distinct strings from {len(sources)} sources")
+
+    # Most frequent strings across all sources
+    print("\nMost frequent normalized strings:")
+    print(theoriesof.nlargest(20, 'freq_total')[['normalized_string', 'freq_total']].to_string(index=False))
 
     # Filter unique "theories of" strings
-    unique_theoriesof = theoriesof[['normalized_string']].drop_duplicates()
+    unique_theoriesof = theoriesof[['normalized_string']]
     print(f"\nUnique theories of: {len(unique_theoriesof)}")
 
     # Write csv with unique "theor* of" strings
-    output_file = get_file_path("1_theoriesof_complete_rerun.csv")
-    unique_theoriesof.to_csv(output_file, index=False)
+    output_file = output_file or get_file_path("1_theoriesof_complete_rerun.csv")
+    with stage('write'):
+        unique_theoriesof.to_csv(output_file, index=False)
+    record(rows_out=len(unique_theoriesof))
     print(f"Saved to {output_file}")
 
-    # Compare different "theor* of" sets
-    jj_orig = pd.read_csv(get_file_path("1_JJ_theor_.csv"))
-    nn_orig = pd.read_csv(get_file_path("1_NN_theor_.csv"))
-    theory_orig = pd.read_csv(get_file_path("1_theor_of_normalized.csv"))
-
-    set_A = set(jj_orig.iloc[:, 0].dropna().str.strip())
-    set_B = set(nn_orig.iloc[:, 0].dropna().str.strip())
-    set_C = set(theory_orig['normalized_string'].dropna().str.strip())
-
-    myl = {'A (JJ)': set_A, 'B (NN)': set_B, 'C (theory)': set_C}
-
-    # Find differences - items unique to each set
-    differences = {}
-    for k, v in myl.items():
-        other_sets = [s for name, s in myl.items() if name != k]
-        differences[k] = v - set.union(*other_sets)
+    # Compare different "theor* of" sets: items unique to each set
+    differences = unique_to_each(theoriesof, list(sources))
+    labels = {'jj': 'A (JJ)', 'nn': 'B (NN)', 'theory': 'C (theory)'}
 
     print("\nSet differences:")
-    for k, v in differences.items():
-        print(f"Unique to {k}: {len(v)} items")
+    for name in ['jj', 'nn', 'theory']:
+        print(f"Unique to {labels[name]}: {len(differences[name])} items")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Merge the \"theor* of\" strings of all stage-1 sources")
+    parser.add_argument('--extracted', action='store_true',
+                        help="start from the files written by extract_theories.py instead of the original ones")
+    parser.add_argument('--transformations', default=None,
+                        help="OpenRefine JSON whose normalized_string mass edits are applied before merging")
+    add_arguments(parser)
+    args = parser.parse_args()
+    with from_args('preprocessingdata', args):
+        main(extracted=args.extracted, transformations=args.transformations)
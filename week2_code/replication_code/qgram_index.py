@@ -0,0 +1,128 @@
+"""
+Q-gram Index - local similarity join between "theory of" strings and category titles
+
+Instead of searching Wikipedia and filtering by Jaccard distance afterwards, the
+categories are matched directly: an inverted index over the q-grams of the
+category titles finds every title with jac < JAC_THRESHOLD for a string, and
+prefix and length filtering keep it from scoring every pair.
+"""
+import argparse
+import heapq
+import math
+import os
+from collections import Counter
+
+import pandas as pd
+
+from catalog import get_file_path, load
+from instrumentation import add_arguments, from_args
+from jac_distance_categories import JAC_THRESHOLD, qgram_set
+
+
+class QgramIndex:
+    """Inverted index over the q-grams of category titles.
+
+    Every title is indexed only by the prefix of its q-grams (rarest first) that
+    any match closer than max_distance must share with the query string.
+    """
+
+    def __init__(self, titles, q=3, max_distance=JAC_THRESHOLD):
+        if not 0 < max_distance <= 1:
+            raise ValueError("max_distance must be in (0, 1]")
+        self.q = q
+        self.max_distance = max_distance
+        self.min_similarity = 1 - max_distance
+
+        # Titles without any q-grams (shorter than q) cannot be matched
+        self.titles = [t for t in dict.fromkeys(titles) if isinstance(t, str) and len(t) >= q]
+        self.grams = [qgram_set(t, q) for t in self.titles]
+        self.sizes = [len(g) for g in self.grams]
+
+        # Global q-gram order: rarest first, so prefixes hold the most selective q-grams
+        frequency = Counter(gram for grams in self.grams for gram in grams)
+        self.rank = {gram: r for r, (gram, _) in enumerate(
+            sorted(frequency.items(), key=lambda item: (item[1], item[0]))
+        )}
+
+        self.inverted = {}
+        for record, grams in enumerate(self.grams):
+            for gram in self._prefix(grams):
+                self.inverted.setdefault(gram, []).append(record)
+
+    def _prefix(self, grams):
+        """Return the q-grams a set must share with any set similar enough to it"""
+        ordered = sorted(grams, key=lambda gram: (self.rank.get(gram, -1), gram))
+        length = len(ordered) - math.ceil(self.min_similarity * len(ordered)) + 1
+        return ordered[:length]
+
+    def search(self, query_string, k=10):
+        """Return up to k (title, jac) pairs with jac < max_distance, closest first"""
+        grams = qgram_set(query_string, self.q)
+        if not grams:
+            return []
+        size = len(grams)
+
+        # Length filter: similar sets cannot differ too much in size
+        min_size = self.min_similarity * size
+        max_size = size / self.min_similarity
+
+        candidates = set()
+        for gram in self._prefix(grams):
+            for record in self.inverted.get(gram, ()):
+                if min_size <= self.sizes[record] <= max_size:
+                    candidates.add(record)
+
+        matches = []
+        for record in candidates:
+            intersection = len(grams & self.grams[record])
+            distance = 1 - intersection / (size + self.sizes[record] - intersection)
+            if distance < self.max_distance:
+                matches.append((distance, self.titles[record]))
+
+        return [(title, distance) for distance, title in heapq.nsmallest(k, matches)]
+
+
+def similarity_join(query_strings, titles, k=10, q=3, max_distance=JAC_THRESHOLD):
+    """Match every query string to its top-k category titles with jac < max_distance"""
+    index = QgramIndex(titles, q=q, max_distance=max_distance)
+    rows = []
+    for query_string in dict.fromkeys(query_strings):
+        for title, distance in index.search(query_string, k=k):
+            rows.append({'query_string': query_string, 'category': title, 'jac': distance})
+    return pd.DataFrame(rows, columns=['query_string', 'category', 'jac'])
+
+
+def main(titles_file=None, k=10):
+    # Get file with all "theory of strings"
+    if os.path.exists(get_file_path("1_theoriesof_complete.csv")):
+        string_filename = get_file_path("1_theoriesof_complete.csv")
+    else:
+        string_filename = get_file_path("1_theoriesof_complete_rerun.csv")
+    query_strings = load(string_filename, columns=["normalized_string"])["normalized_string"].dropna().tolist()
+    print(f"Loaded {len(query_strings)} theory strings from {string_filename}")
+
+    # Category titles: a one-column list, or the categories found by the Wikipedia search
+    if titles_file is not None:
+        titles = pd.read_csv(titles_file).iloc[:, 0]
+    else:
+        titles = load(get_file_path("2_wikipediacategoriesfromquery.csv"), columns=['title'])['title']
+    titles = titles.dropna().str.replace('Category:', '', regex=False).tolist()
+    print(f"Indexing {len(titles)} category titles")
+
+    matches = similarity_join(query_strings, titles, k=k)
+    print(f"Found {len(matches)} matches with jac < {JAC_THRESHOLD} "
+          f"for {matches['query_string'].nunique()} strings")
+
+    output_file = get_file_path("3_qgram_join_rerun.csv")
+    matches.to_csv(output_file, index=False)
+    print(f"Saved to {output_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Match theory strings to category titles by q-gram Jaccard distance")
+    parser.add_argument('--titles', default=None, help="CSV with category titles in its first column")
+    parser.add_argument('-k', type=int, default=10, help="number of categories kept per string")
+    add_arguments(parser)
+    args = parser.parse_args()
+    with from_args('qgram_index', args):
+        main(titles_file=args.titles, k=args.k)
@@ -4,30 +4,39 @@ Query Wikipedia - Python replication of 2_query_wikipedia.py (updated)
 import requests
 import pandas as pd
 import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from api_client import WIKIPEDIA_API_URL, api_get, make_session
+from artifacts import FORMATS, convert_artifact
+from catalog import get_file_path, load
+from category_search_index import open_index
+from instrumentation import add_arguments, from_args, record, stage
+from request_scheduler import RequestScheduler
+from response_cache import ResponseCache
+from result_writer import ResultWriter
 
-def get_file_path(filename):
-    """Get path to data file. Rerun files stay in replication_code/data, others prefer original_project/data"""
-    original_data = os.path.join(os.path.dirname(__file__), "original_project", "data")
-    rerun_data = os.path.join(os.path.dirname(__file__), "data")
-
-    # If filename contains "rerun", use replication_code/data
-    if "rerun" in filename.lower():
-        return os.path.join(rerun_data, filename)
-
-    # Otherwise, prefer original_project/data, fall back to replication_code/data
-    original_path = os.path.join(original_data, filename)
-    if os.path.exists(original_path):
-        return original_path
-    return os.path.join(rerun_data, filename)
 
 # For backwards compatibility, set DATA_DIR to the base directory we'll use
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 
 
-def query_wikipedia_categories(query_string):
-    """Query Wikipedia API for categories matching the query string"""
-    url = "https://en.wikipedia.org/w/api.php"
-    params = {
+# Number of requests kept in flight at once in the concurrent mode
+MAX_IN_FLIGHT = 8
+
+# Number of query strings handled per streamed batch
+BATCH_SIZE = 200
+
+# Largest page the search API returns (srlimit=max) and cap on pages followed per string
+MAX_PAGE_SIZE = 500
+MAX_PAGES = 10
+
+# Columns of 2_wikipediacategoriesfromquery.csv
+RESULT_COLUMNS = ['ns', 'title', 'pageid', 'size', 'wordcount', 'snippet', 'timestamp', 'query_string', 'category']
+
+
+def search_params(query_string):
+    """Build the API parameters for a category search"""
+    return {
         'action': 'query',
         'format': 'json',
         'list': 'search',
@@ -36,55 +45,194 @@ def query_wikipedia_categories(query_string):
         'srnamespace': 14  # Category namespace
     }
 
+
+def query_wikipedia_categories(query_string, session=None, url=WIKIPEDIA_API_URL, cache=None, backend=None,
+                               all_pages=False, max_pages=MAX_PAGES, scheduler=None):
+    """Query Wikipedia API for categories matching the query string.
+
+    By default only the API's first page of results is returned; with all_pages,
+    every page up to max_pages is collected (see iter_wikipedia_category_pages).
+    With a backend (such as category_search_index.LocalCategoryIndex), the search
+    is answered by backend.search instead of the API. With a scheduler
+    (request_scheduler.RequestScheduler), throttled requests are retried and
+    strings that still fail are added to its dead letters.
+    """
+    if backend is not None:
+        limit = MAX_PAGE_SIZE * max_pages if all_pages else 10
+        return backend.search(query_string, limit=limit)
+
+    if all_pages:
+        return [result
+                for page in iter_wikipedia_category_pages(query_string, max_pages=max_pages, session=session,
+                                                          url=url, cache=cache, scheduler=scheduler)
+                for result in page]
+
+    params = search_params(query_string)
+
+    # Answer from the on-disk cache when this request was already made
+    if cache is not None:
+        cached = cache.get(url, params)
+        if cached is not None:
+            return cached
+
+    # Reuse pooled connections when a session is given
+    http = session if session is not None else requests
+
     try:
-        r = requests.get(url, params=params, timeout=30)
-        r.raise_for_status()
+        r = api_get(http, url, params, scheduler=scheduler)
         data = r.json()
         search_results = data.get('query', {}).get('search', [])
+        if cache is not None:
+            cache.set(url, params, search_results)
         return search_results
     except Exception as e:
         print(f"Error querying '{query_string}': {e}")
+        if scheduler is not None:
+            scheduler.dead_letter(query_string, e)
         return []
 
 
-def main():
-    # Get file with all "theory of strings"
-    if os.path.exists(get_file_path("1_theoriesof_complete.csv")):
+def iter_wikipedia_category_pages(query_string, max_pages=MAX_PAGES, session=None, url=WIKIPEDIA_API_URL,
+                                  cache=None, scheduler=None):
+    """Yield pages of category search results for a query string.
+
+    Pages are requested at the largest size the API allows, and the API's
+    continue token is followed until the results run out or max_pages is reached.
+    A request that fails mid-way adds the string to the scheduler's dead letters,
+    or is raised without a scheduler, so a partial result is never taken as complete.
+    """
+    params = dict(search_params(query_string), srlimit='max')
+    http = session if session is not None else requests
+
+    for _ in range(max_pages):
+        page = cache.get(url, params) if cache is not None else None
+        if page is None:
+            try:
+                r = api_get(http, url, params, scheduler=scheduler)
+                data = r.json()
+            except Exception as e:
+                print(f"Error querying '{query_string}' (sroffset={params.get('sroffset', 0)}): {e}")
+                if scheduler is None:
+                    raise
+                scheduler.dead_letter(query_string, e)
+                return
+            page = {'search': data.get('query', {}).get('search', []), 'continue': data.get('continue')}
+            if cache is not None:
+                cache.set(url, params, page)
+
+        yield page['search']
+
+        if not page['continue']:
+            return
+        params = dict(params, **page['continue'])
+
+    print(f"Warning: stopped after {max_pages} pages for '{query_string}'; more results remain (see --max-pages)")
+
+
+def query_wikipedia_categories_concurrent(query_strings, max_in_flight=MAX_IN_FLIGHT, session=None,
+                                          url=WIKIPEDIA_API_URL, cache=None, backend=None,
+                                          all_pages=False, max_pages=MAX_PAGES, scheduler=None):
+    """Query Wikipedia for many strings with at most max_in_flight requests at once.
+
+    Yields one list of search results per query string, in the same order as query_strings.
+    """
+    if session is None:
+        session = make_session(max_in_flight)
+
+    def query(query_string):
+        return query_wikipedia_categories(query_string, session=session, url=url, cache=cache, backend=backend,
+                                          all_pages=all_pages, max_pages=max_pages, scheduler=scheduler)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        yield from executor.map(query, query_strings)
+
+
+def main(max_in_flight=MAX_IN_FLIGHT, use_cache=True, resume=False, offline_index=None,
+         all_pages=False, max_pages=MAX_PAGES, fmt='csv', strings_file=None, output_file=None):
+    # Get file with all "theory of strings" (the pipeline passes the one preprocessingdata.py wrote)
+    if strings_file is not None:
+        string_filename = strings_file
+    elif os.path.exists(get_file_path("1_theoriesof_complete.csv")):
         string_filename = get_file_path("1_theoriesof_complete.csv")
     else:
         string_filename = get_file_path("1_theoriesof_complete_rerun.csv")
 
     # Read with pandas
-    df = pd.read_csv(string_filename)
+    with stage('load'):
+        df = load(string_filename, columns=["normalized_string"])
     print(f"Loaded {len(df)} theory strings from {string_filename}")
 
     # Get all strings as a list
     query_strings = df["normalized_string"].dropna().tolist()
 
-    # Query Wikipedia and collect results
-    all_results = []
-    for i, query_string in enumerate(query_strings):
-        if i % 100 == 0:
-            print(f"Processing {i}/{len(query_strings)}...")
-
-        results = query_wikipedia_categories(query_string)
-        for result in results:
-            result['query_string'] = query_string
-            all_results.append(result)
-
-    # Create DataFrame from results
-    all_results_df = pd.DataFrame(all_results)
-    print(f"Retrieved {len(all_results_df)} category matches")
-
-    # Create column "category" with category name without "Category:" string
-    if 'title' in all_results_df.columns:
-        all_results_df["category"] = all_results_df["title"].str.replace("Category:", "", regex=False)
-
-    # Save results in csv
-    output_file = get_file_path("2_wikipediacategoriesfromquery.csv")
-    all_results_df.to_csv(output_file, index=False)
+    # Search a local category index instead of the API when one is given
+    backend = open_index(offline_index) if offline_index is not None else None
+    if backend is not None:
+        print(f"Searching {backend.count()} categories in {offline_index}")
+        use_cache = False
+
+    # Reruns only send the strings that are not cached yet
+    cache = ResponseCache() if use_cache else None
+    session = make_session(max_in_flight)
+
+    # Adapt the request rate to throttling; max_in_flight is the upper bound
+    scheduler = RequestScheduler(max_concurrency=max_in_flight)
+
+    # Stream results to disk in batches; with resume, skip strings already written
+    output_file = output_file or get_file_path("2_wikipediacategoriesfromquery.csv")
+    with stage('query'):
+        with ResultWriter(output_file, RESULT_COLUMNS, resume=resume) as writer:
+            pending = [s for s in query_strings if s not in writer.done]
+            print(f"{len(query_strings) - len(pending)} strings already done, {len(pending)} to query")
+
+            for start in range(0, len(pending), BATCH_SIZE):
+                print(f"Processing {start}/{len(pending)}...")
+                batch = pending[start:start + BATCH_SIZE]
+
+                # Query Wikipedia concurrently; results come back in input order
+                batch_results = query_wikipedia_categories_concurrent(batch, max_in_flight=max_in_flight,
+                                                                      session=session, cache=cache, backend=backend,
+                                                                      all_pages=all_pages, max_pages=max_pages,
+                                                                      scheduler=scheduler)
+                batch_results = list(batch_results)
+
+                # Strings that failed for good are not marked done, so --resume retries them
+                failed = {d['key'] for d in scheduler.dead_letters}
+                for query_string, results in zip(batch, batch_results):
+                    if query_string in failed:
+                        continue
+                    for result in results:
+                        result['query_string'] = query_string
+                        # Create column "category" with category name without "Category:" string
+                        result['category'] = result.get('title', '').replace("Category:", "")
+                    writer.add(query_string, results)
+
+    print(f"Retrieved {writer.rows_written} category matches")
+    record(rows_in=len(query_strings), rows_out=writer.rows_written, requests=scheduler.stats())
+    print(f"Requests: {scheduler.stats()}")
+    if scheduler.dead_letters:
+        print(f"{len(scheduler.dead_letters)} strings failed; rerun with --resume to retry them")
+    if cache is not None:
+        print(f"Cache: {cache.stats()}")
+        record(cache=cache.stats())
     print(f"Saved to {output_file}")
+    with stage('convert'):
+        convert_artifact(output_file, fmt)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Search Wikipedia categories for each theory string")
+    parser.add_argument('--resume', action='store_true', help="skip strings already written by an interrupted run")
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT, help="concurrent API requests")
+    parser.add_argument('--offline-index', default=None,
+                        help="search this local category index (see category_search_index.py) instead of the API")
+    parser.add_argument('--all-pages', action='store_true',
+                        help="follow the API's continuation to collect every page of results")
+    parser.add_argument('--max-pages', type=int, default=MAX_PAGES, help="most pages followed per string")
+    parser.add_argument('--format', choices=FORMATS, default='csv',
+                        help="also write a typed columnar copy of the output (needs pyarrow)")
+    add_arguments(parser)
+    args = parser.parse_args()
+    with from_args('query_wikipedia', args):
+        main(max_in_flight=args.max_in_flight, resume=args.resume, offline_index=args.offline_index,
+             all_pages=args.all_pages, max_pages=args.max_pages, fmt=args.format)
@@ -0,0 +1,145 @@
+"""
+Request Scheduler - adaptive rate control shared by the Wikipedia and Wikidata clients
+
+Requests go through RequestScheduler.get, which keeps the number of requests in
+flight under an AIMD limit: it grows by one request per window of successful
+requests and halves whenever the server throttles (HTTP 429/503 or a MediaWiki
+maxlag error). Throttled and dropped requests are retried with exponential
+backoff and jitter, waiting at least as long as the server's Retry-After.
+"""
+import email.utils
+import random
+import threading
+import time
+
+import requests
+
+# Responses that mean "slow down" rather than "this request is wrong"
+THROTTLE_STATUSES = (429, 503)
+
+# Replication lag (seconds) above which MediaWiki should refuse our requests
+MAXLAG = 5
+
+
+class RequestFailed(Exception):
+    """Raised when a request is still throttled or unreachable after every retry"""
+
+
+def parse_retry_after(value):
+    """Return the wait in seconds asked for by a Retry-After header, or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class RequestScheduler:
+    """Shared AIMD concurrency limit, retry policy and dead-letter list for API requests"""
+
+    def __init__(self, max_concurrency=8, min_concurrency=1, max_retries=5, base_delay=1.0, max_delay=60.0,
+                 maxlag=MAXLAG):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.maxlag = maxlag
+
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.dead_letters = []
+        self.counts = {'requests': 0, 'succeeded': 0, 'throttled': 0, 'retried': 0, 'failed': 0}
+        self._cond = threading.Condition()
+
+    def _acquire(self):
+        """Wait for a free slot under the current limit and any Retry-After pause"""
+        with self._cond:
+            while True:
+                wait = self.paused_until - time.time()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    self.counts['requests'] += 1
+                    return
+                self._cond.wait(timeout=wait if wait > 0 else None)
+
+    def _release(self, throttled=False, retry_after=None):
+        """Free a slot and adjust the limit: additive increase, multiplicative decrease"""
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.counts['throttled'] += 1
+                self.limit = max(float(self.min_concurrency), self.limit / 2)
+                if retry_after:
+                    self.paused_until = max(self.paused_until, time.time() + retry_after)
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def backoff(self, attempt):
+        """Exponential backoff with full jitter"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def get(self, session, url, params=None, headers=None, timeout=30, mediawiki=False):
+        """Send a GET through the scheduler and return the response.
+
+        Throttling responses and connection errors are retried; other HTTP errors
+        are raised at once. With mediawiki, the maxlag parameter is added and
+        maxlag errors count as throttling. Raises RequestFailed once retries run out.
+        """
+        params = dict(params or {})
+        if mediawiki and self.maxlag is not None:
+            params['maxlag'] = self.maxlag
+
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                with self._cond:
+                    self.counts['retried'] += 1
+
+            self._acquire()
+            try:
+                r = session.get(url, params=params, headers=headers, timeout=timeout)
+            except requests.ReadTimeout:
+                # A slow answer is the caller's business (e.g. splitting a SPARQL batch)
+                self._release()
+                raise
+            except requests.ConnectionError as e:
+                self._release()
+                error = e
+                time.sleep(self.backoff(attempt))
+                continue
+
+            retry_after = parse_retry_after(r.headers.get('Retry-After'))
+            maxlagged = mediawiki and r.headers.get('MediaWiki-API-Error') == 'maxlag'
+            if r.status_code in THROTTLE_STATUSES or maxlagged:
+                self._release(throttled=True, retry_after=retry_after)
+                error = requests.HTTPError(f"{r.status_code} throttled" + (" (maxlag)" if maxlagged else ""),
+                                           response=r)
+                time.sleep(max(retry_after or 0.0, self.backoff(attempt)))
+                continue
+
+            self._release()
+            r.raise_for_status()
+            with self._cond:
+                self.counts['succeeded'] += 1
+            return r
+
+        raise RequestFailed(f"Giving up on {url} after {self.max_retries + 1} attempts: {error}")
+
+    def dead_letter(self, key, error):
+        """Remember a request that failed for good, so it can be retried later"""
+        with self._cond:
+            self.counts['failed'] += 1
+            self.dead_letters.append({'key': key, 'error': str(error)})
+
+    def stats(self):
+        with self._cond:
+            return dict(self.counts, limit=round(self.limit, 2), dead_letters=len(self.dead_letters))
@@ -0,0 +1,97 @@
+"""
+Result Writer - streaming, resumable CSV output for the API stages
+"""
+import json
+import os
+import pandas as pd
+
+
+class ResultWriter:
+    """Append results to a CSV in batches and checkpoint which keys are done.
+
+    Rows are buffered per key (a query string or a category) and appended to
+    output_file once batch_size rows or keys are pending. After each append the
+    checkpoint file records the finished keys and the CSV size, so a resumed run
+    can drop any half-written batch and skip the keys that are already done.
+    """
+
+    def __init__(self, output_file, columns, resume=False, batch_size=500):
+        self.output_file = output_file
+        self.checkpoint_file = output_file + ".checkpoint"
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.done = set()
+        self.rows_written = 0
+        self._rows = []
+        self._keys = []
+
+        offset = None
+        if resume and os.path.exists(self.checkpoint_file) and os.path.exists(output_file):
+            offset = self._load_checkpoint()
+        if offset is not None:
+            # Anything after the last checkpoint belongs to a batch that never finished
+            with open(output_file, 'r+b') as f:
+                f.truncate(offset)
+            print(f"Resuming {output_file}: {len(self.done)} keys already done")
+        else:
+            # No checkpoint (or not even its first line survived): start a fresh file
+            if resume:
+                print(f"No usable checkpoint for {output_file}, starting from scratch")
+            os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+            pd.DataFrame(columns=self.columns).to_csv(output_file, index=False)
+            with open(self.checkpoint_file, 'w') as f:
+                f.write(json.dumps({'offset': os.path.getsize(output_file), 'rows': 0, 'keys': []}) + "\n")
+
+    def _load_checkpoint(self):
+        """Read finished keys from the checkpoint and return the last safe CSV offset (None if there is none)"""
+        offset = None
+        with open(self.checkpoint_file) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A checkpoint line cut off by a crash
+                    break
+                offset = entry['offset']
+                self.rows_written += entry['rows']
+                self.done.update(entry['keys'])
+        return offset
+
+    def add(self, key, rows):
+        """Queue the result rows for one key; flushes when the batch is full"""
+        self._keys.append(key)
+        self._rows.extend(rows)
+        if len(self._rows) >= self.batch_size or len(self._keys) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Append pending rows to the CSV, then checkpoint their keys"""
+        if not self._keys:
+            return
+        if self._rows:
+            pd.DataFrame(self._rows, columns=self.columns).to_csv(
+                self.output_file, mode='a', header=False, index=False
+            )
+        with open(self.checkpoint_file, 'a') as f:
+            entry = {
+                'offset': os.path.getsize(self.output_file),
+                'rows': len(self._rows),
+                'keys': self._keys,
+            }
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.done.update(self._keys)
+        self.rows_written += len(self._rows)
+        self._rows = []
+        self._keys = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
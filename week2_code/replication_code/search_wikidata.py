@@ -4,50 +4,137 @@ Search Wikidata - Python replication of 4search_wikidata.R
 import requests
 import pandas as pd
 import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from api_client import WIKIPEDIA_API_URL, api_get, make_session
+from artifacts import FORMATS, convert_artifact
+from catalog import get_file_path, load
+from instrumentation import add_arguments, from_args, record, stage
+from request_scheduler import RequestScheduler
+from response_cache import ResponseCache
+from result_writer import ResultWriter
 
-def get_file_path(filename):
-    """Get path to data file. Rerun files stay in replication_code/data, others prefer original_project/data"""
-    original_data = os.path.join(os.path.dirname(__file__), "original_project", "data")
-    rerun_data = os.path.join(os.path.dirname(__file__), "data")
-
-    # If filename contains "rerun", use replication_code/data
-    if "rerun" in filename.lower():
-        return os.path.join(rerun_data, filename)
-
-    # Otherwise, prefer original_project/data, fall back to replication_code/data
-    original_path = os.path.join(original_data, filename)
-    if os.path.exists(original_path):
-        return original_path
-    return os.path.join(rerun_data, filename)
 
 # For backwards compatibility, set DATA_DIR to the base directory we'll use
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 
 
-def query_wikidata(query):
-    """Query Wikidata SPARQL endpoint"""
-    url = "https://query.wikidata.org/sparql"
+WIKIDATA_SPARQL_URL = "https://query.wikidata.org/sparql"
+
+# Number of categories checkpointed per streamed batch
+BATCH_SIZE = 50
+
+# Columns of 4_theorystrings_categories_humans.csv
+RESULT_COLUMNS = ['item', 'itemLabel', 'category']
+
+# Number of categories sent together in one batched SPARQL query
+CATEGORIES_PER_QUERY = 25
+
+# Status codes WDQS answers with when a query runs out of time
+TIMEOUT_STATUSES = (500, 502, 504)
+
+# Most SPARQL queries in flight at once (WDQS allows 5 parallel queries per client)
+MAX_IN_FLIGHT = 5
+
+# Joins the categories of the path a crawled category was reached by
+PATH_SEPARATOR = " > "
+
+
+def fetch_bindings(query, cache=None, url=WIKIDATA_SPARQL_URL, scheduler=None, session=None):
+    """Send a SPARQL query and return its rows as {variable: value} dicts; errors are raised to the caller.
+
+    With a scheduler (request_scheduler.RequestScheduler), throttled requests are
+    retried with backoff before giving up.
+    """
     headers = {'Accept': 'application/json'}
 
-    try:
-        response = requests.get(url, params={'query': query}, headers=headers, timeout=60)
+    # Answer from the on-disk cache when this query was already sent
+    if cache is not None:
+        cached = cache.get(url, query)
+        if cached is not None:
+            return cached
+
+    http = session if session is not None else requests
+    if scheduler is not None:
+        response = scheduler.get(http, url, params={'query': query}, headers=headers, timeout=60)
+    else:
+        response = http.get(url, params={'query': query}, headers=headers, timeout=60)
         response.raise_for_status()
-        data = response.json()
+    data = response.json()
+
+    results = [{var: binding['value'] for var, binding in r.items()}
+               for r in data.get('results', {}).get('bindings', [])]
+
+    if cache is not None:
+        cache.set(url, query, results)
+    return results
+
 
-        results = data.get('results', {}).get('bindings', [])
-        return [{
-            'item': r.get('item', {}).get('value', ''),
-            'itemLabel': r.get('itemLabel', {}).get('value', '')
-        } for r in results]
+def fetch_wikidata(query, cache=None, url=WIKIDATA_SPARQL_URL, scheduler=None, session=None):
+    """Send a category search query and return its item/itemLabel rows; errors are raised to the caller"""
+    results = []
+    for r in fetch_bindings(query, cache=cache, url=url, scheduler=scheduler, session=session):
+        row = {'item': r.get('item', ''), 'itemLabel': r.get('itemLabel', '')}
+        # Batched queries also bind the category each row came from
+        if 'category' in r:
+            row['category'] = r['category']
+        results.append(row)
+    return results
+
+
+def query_wikidata(query, cache=None, url=WIKIDATA_SPARQL_URL, scheduler=None, session=None):
+    """Query Wikidata SPARQL endpoint"""
+    try:
+        return fetch_wikidata(query, cache=cache, url=url, scheduler=scheduler, session=session)
     except Exception as e:
         print(f"Query error: {e}")
+        if scheduler is not None:
+            scheduler.dead_letter(query, e)
         return []
 
 
-def cat_query(category):
-    """Create SPARQL query to search humans inside a Wikipedia category"""
-    return f'''SELECT ?item ?itemLabel WHERE {{
-  BIND("{category}" as ?category)
+def query_wikidata_batch(categories, cache=None, url=WIKIDATA_SPARQL_URL, scheduler=None, session=None):
+    """Search humans in several categories with one query.
+
+    Returns a dict mapping each category to its list of results. When the
+    endpoint times out, the batch is split in half and each half is retried.
+    Categories that still fail are added to the scheduler's dead letters.
+    """
+    def failed(e):
+        print(f"Query error for {len(categories)} categories: {e}")
+        if scheduler is not None:
+            for category in categories:
+                scheduler.dead_letter(category, e)
+        return {category: [] for category in categories}
+
+    try:
+        results = fetch_wikidata(cat_query_batch(categories), cache=cache, url=url, scheduler=scheduler,
+                                 session=session)
+    except (requests.Timeout, requests.HTTPError, ValueError) as e:
+        # ValueError covers a response body that was cut off mid-stream
+        timed_out = not isinstance(e, requests.HTTPError) or e.response.status_code in TIMEOUT_STATUSES
+        if not timed_out or len(categories) == 1:
+            return failed(e)
+        half = len(categories) // 2
+        print(f"Query for {len(categories)} categories timed out, splitting into {half} + {len(categories) - half}")
+        grouped = query_wikidata_batch(categories[:half], cache=cache, url=url, scheduler=scheduler,
+                                       session=session)
+        grouped.update(query_wikidata_batch(categories[half:], cache=cache, url=url, scheduler=scheduler,
+                                            session=session))
+        return grouped
+    except Exception as e:
+        return failed(e)
+
+    grouped = {category: [] for category in categories}
+    for r in results:
+        grouped.setdefault(r['category'], []).append(r)
+    return grouped
+
+
+# SPARQL search for humans inside Wikipedia categories; {select} and {binding} are filled in by
+# cat_query (one category) and cat_query_batch (several categories, each bound as ?category)
+CATEGORY_QUERY = '''SELECT {select} WHERE {{
+  {binding}
   SERVICE wikibase:mwapi {{
      bd:serviceParam wikibase:endpoint "en.wikipedia.org";
                      wikibase:api "Generator";
@@ -64,12 +151,123 @@ SERVICE wikibase:label {{ bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en"
 }}'''
 
 
-def main():
-    # Load filtered data
-    if os.path.exists(get_file_path("3_wikicategories_distances_filtered.csv")):
-        data = pd.read_csv(get_file_path("3_wikicategories_distances_filtered.csv"))
-    else:
-        data = pd.read_csv(get_file_path("3_wikicategories_distances_filtered_rerun.csv"))
+def cat_query(category):
+    """Create SPARQL query to search humans inside a Wikipedia category"""
+    return CATEGORY_QUERY.format(select='?item ?itemLabel', binding=f'BIND("{category}" as ?category)')
+
+
+def sparql_string(value):
+    """Quote a Python string as a SPARQL string literal"""
+    escaped = value.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+def cat_query_batch(categories):
+    """Create one SPARQL query to search humans inside several Wikipedia categories"""
+    values = " ".join(sparql_string(category) for category in categories)
+    return CATEGORY_QUERY.format(select='?category ?item ?itemLabel', binding=f'VALUES ?category {{ {values} }}')
+
+
+def fetch_subcategories(category, cache=None, url=WIKIPEDIA_API_URL, scheduler=None, session=None):
+    """Return the titles of a category's direct subcategories, following the API's continue token"""
+    params = {
+        'action': 'query',
+        'list': 'categorymembers',
+        'cmtitle': category,
+        'cmtype': 'subcat',
+        'cmlimit': 'max',
+        'format': 'json',
+    }
+    http = session if session is not None else requests
+
+    subcategories = []
+    while True:
+        page = cache.get(url, params) if cache is not None else None
+        if page is None:
+            data = api_get(http, url, params, scheduler=scheduler).json()
+            members = data.get('query', {}).get('categorymembers', [])
+            page = {'titles': [m['title'] for m in members], 'continue': data.get('continue')}
+            if cache is not None:
+                cache.set(url, params, page)
+        subcategories.extend(page['titles'])
+        if not page['continue']:
+            return subcategories
+        params = dict(params, **page['continue'])
+
+
+def crawl_categories(roots, max_depth, max_in_flight=MAX_IN_FLIGHT, cache=None, url=WIKIPEDIA_API_URL,
+                     scheduler=None, session=None):
+    """Walk the category tree breadth-first from the root categories down to max_depth levels.
+
+    Yields (category, path) pairs, the roots first, where path is the tuple of
+    categories leading from a root to the category. A category below several
+    roots is yielded once per root, with its shortest path from that root; the
+    category graph has cycles and shared subcategories, so a category reached
+    again from the same root is not followed a second time. Every level's
+    categories are expanded concurrently, and each category is listed once.
+    """
+    def expand(category):
+        try:
+            return fetch_subcategories(category, cache=cache, url=url, scheduler=scheduler, session=session)
+        except Exception as e:
+            print(f"Error listing subcategories of '{category}': {e}")
+            if scheduler is not None:
+                scheduler.dead_letter(f"subcategories:{category}", e)
+            return []
+
+    frontier = [(root, (root,)) for root in dict.fromkeys(roots)]
+    # (category, root) pairs already reached, and the subcategories of every category listed so far
+    visited = {(category, path[0]) for category, path in frontier}
+    children = {}
+    yield from frontier
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for depth in range(1, max_depth + 1):
+            unlisted = list(dict.fromkeys(category for category, _ in frontier if category not in children))
+            children.update(zip(unlisted, executor.map(expand, unlisted)))
+            next_frontier = []
+            for category, path in frontier:
+                for subcategory in children[category]:
+                    if (subcategory, path[0]) in visited:
+                        continue
+                    visited.add((subcategory, path[0]))
+                    next_frontier.append((subcategory, path + (subcategory,)))
+            print(f"Depth {depth}: {len(next_frontier)} new (subcategory, root) pairs")
+            yield from next_frontier
+            frontier = next_frontier
+            if not frontier:
+                return
+
+
+def write_unique_humans(output_file, unique_output_file, chunksize=10000):
+    """Write the first row of each human in output_file, without its category, and return how many there are.
+
+    The header is written first, so a run without results never leaves an earlier run's file in place.
+    """
+    unique_columns = [c for c in RESULT_COLUMNS if c != 'category']
+    pd.DataFrame(columns=unique_columns).to_csv(unique_output_file, index=False)
+    seen = set()
+    n_unique = 0
+    for chunk in pd.read_csv(output_file, chunksize=chunksize):
+        chunk = chunk.drop_duplicates(subset=['itemLabel'])
+        chunk = chunk[~chunk['itemLabel'].isin(seen)][unique_columns]
+        seen.update(chunk['itemLabel'])
+        chunk.to_csv(unique_output_file, mode='a', header=False, index=False)
+        n_unique += len(chunk)
+    return n_unique
+
+
+def main(use_cache=True, resume=False, categories_per_query=CATEGORIES_PER_QUERY, max_in_flight=MAX_IN_FLIGHT,
+         fmt='csv', crawl_depth=0, filtered_file=None, output_file=None, unique_output_file=None):
+    # Load filtered data (the pipeline passes the file jac_distance_categories.py wrote);
+    # only the category titles are needed
+    if filtered_file is None:
+        if os.path.exists(get_file_path("3_wikicategories_distances_filtered.csv")):
+            filtered_file = get_file_path("3_wikicategories_distances_filtered.csv")
+        else:
+            filtered_file = get_file_path("3_wikicategories_distances_filtered_rerun.csv")
+    with stage('load'):
+        data = load(filtered_file, columns=['title'])
 
     print(f"Loaded {len(data)} filtered categories")
 
@@ -77,38 +275,90 @@ def main():
     queries_titles = data['title'].unique().tolist()
     print(f"Querying {len(queries_titles)} unique categories")
 
-    # Query Wikidata
-    all_results = []
-    for i, title in enumerate(queries_titles):
-        if i % 50 == 0:
-            print(f"Processing {i}/{len(queries_titles)}...")
+    # Reruns only send the categories that are not cached yet
+    cache = ResponseCache() if use_cache else None
+
+    # Adapt the request rate to throttling; max_in_flight is the upper bound
+    scheduler = RequestScheduler(max_concurrency=max_in_flight)
+    session = make_session(max_in_flight)
+
+    # Crawl mode: also search the subcategories, tagging humans with the paths that led to them
+    paths = None
+    if crawl_depth > 0:
+        with stage('crawl'):
+            crawled = list(crawl_categories(queries_titles, crawl_depth, max_in_flight=max_in_flight, cache=cache,
+                                            scheduler=scheduler, session=session))
+        paths = {}
+        for category, path in crawled:
+            paths.setdefault(category, []).append(path)
+        print(f"Crawled {len(paths)} categories, {len(paths) - len(queries_titles)} of them subcategories, "
+              f"along {len(crawled)} paths")
+        queries_titles = list(paths)
+    columns = RESULT_COLUMNS + ['path'] if paths is not None else RESULT_COLUMNS
+
+    # Stream results to disk in batches; with resume, skip categories already written
+    output_file = output_file or get_file_path("4_theorystrings_categories_humans.csv")
+    with stage('query'):
+        with ResultWriter(output_file, columns, resume=resume, batch_size=BATCH_SIZE) as writer:
+            pending = [t for t in queries_titles if t not in writer.done]
+            print(f"{len(queries_titles) - len(pending)} categories already done, {len(pending)} to query")
+
+            # Query Wikidata with several categories per query, several queries at a time
+            batches = [pending[k:k + categories_per_query] for k in range(0, len(pending), categories_per_query)]
 
-        query = cat_query(title)
-        results = query_wikidata(query)
+            def query(batch):
+                return query_wikidata_batch(batch, cache=cache, scheduler=scheduler, session=session)
 
-        for r in results:
-            r['category'] = title
-            all_results.append(r)
+            with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+                for i, (batch, grouped) in enumerate(zip(batches, executor.map(query, batches))):
+                    print(f"Processing {i * categories_per_query}/{len(pending)}...")
 
-    df_humans = pd.DataFrame(all_results)
+                    # Categories that failed for good are not marked done, so --resume retries them
+                    failed = {d['key'] for d in scheduler.dead_letters}
 
-    # Save results
-    output_file = get_file_path("4_theorystrings_categories_humans.csv")
-    df_humans.to_csv(output_file, index=False)
-    print(f"Saved {len(df_humans)} results to {output_file}")
+                    # Write in category order, as the one-query-per-category loop did
+                    for title in batch:
+                        if title in failed:
+                            continue
+                        results = grouped[title]
+                        if paths is None:
+                            for r in results:
+                                r['category'] = title
+                        else:
+                            # One row per root the category was reached from, keeping the
+                            # filtered category the crawl started from and the path below it
+                            results = [dict(r, category=path[0], path=PATH_SEPARATOR.join(path))
+                                       for r in results for path in paths[title]]
+                        writer.add(title, results)
 
-    # Get unique humans
-    df_unique = df_humans.drop_duplicates(subset=['itemLabel']).copy()
-    if 'category' in df_unique.columns:
-        df_unique = df_unique.drop(columns=['category'])
+    record(rows_in=len(queries_titles), rows_out=writer.rows_written, requests=scheduler.stats())
+    print(f"Requests: {scheduler.stats()}")
+    if scheduler.dead_letters:
+        print(f"{len(scheduler.dead_letters)} categories failed; rerun with --resume to retry them")
+    if cache is not None:
+        print(f"Cache: {cache.stats()}")
+        record(cache=cache.stats())
+    print(f"Saved {writer.rows_written} results to {output_file}")
+    convert_artifact(output_file, fmt)
 
-    print(f"Unique humans: {len(df_unique)}")
+    # Get unique humans, reading the results back in chunks
+    unique_output_file = unique_output_file or get_file_path("4_theorystrings_categories_humans_unique.csv")
+    with stage('unique'):
+        n_unique = write_unique_humans(output_file, unique_output_file)
 
-    # Save unique humans
-    unique_output_file = get_file_path("4_theorystrings_categories_humans_unique.csv")
-    df_unique.to_csv(unique_output_file, index=False)
+    print(f"Unique humans: {n_unique}")
+    record(unique_humans=n_unique)
     print(f"Saved unique humans to {unique_output_file}")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Search Wikidata for humans in the filtered categories")
+    parser.add_argument('--resume', action='store_true', help="skip categories already written by an interrupted run")
+    parser.add_argument('--format', choices=FORMATS, default='csv',
+                        help="also write a typed columnar copy of the output (needs pyarrow)")
+    parser.add_argument('--crawl-depth', type=int, default=0,
+                        help="also search subcategories down to this many levels below each category")
+    add_arguments(parser)
+    args = parser.parse_args()
+    with from_args('search_wikidata', args):
+        main(resume=args.resume, fmt=args.format, crawl_depth=args.crawl_depth)
@@ -0,0 +1,36 @@
+"""
+Tests for the offline category index of category_search_index.py on a small in-memory dump
+"""
+import pandas as pd
+
+from category_search_index import LocalCategoryIndex
+
+DUMP = pd.DataFrame({
+    'title': ['Category:Theory of mind', 'Category:Literary theory', 'Category:Critical theory'],
+    'pageid': [101, 102, 103],
+    'size': [10, 20, 30],
+    'description': ['Mind and other minds', 'Theories of literature', None],
+})
+
+
+def test_search_returns_the_api_schema():
+    index = LocalCategoryIndex(':memory:')
+    index.ingest(DUMP)
+    results = index.search('theory of mind')
+    assert [r['title'] for r in results] == ['Category:Theory of mind']
+    assert results[0]['pageid'] == 101
+    assert results[0]['ns'] == 14
+
+
+def test_ingesting_a_dump_twice_keeps_one_row_per_category():
+    index = LocalCategoryIndex(':memory:')
+    index.ingest(DUMP)
+    index.ingest(DUMP)
+    assert index.count() == len(DUMP)
+    assert len(index.search('theory', limit=10)) == len(DUMP)
+
+    # A newer dump replaces the categories it shares with the index
+    update = DUMP.iloc[[0]].assign(title='Category:Theory of mind (philosophy)')
+    index.ingest(update)
+    assert index.count() == len(DUMP)
+    assert [r['title'] for r in index.search('philosophy')] == ['Category:Theory of mind (philosophy)']
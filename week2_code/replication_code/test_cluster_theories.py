@@ -0,0 +1,36 @@
+"""
+Tests for the near-duplicate clustering of cluster_theories.py on small lists of theory strings
+"""
+from cluster_theories import cluster_strings, near_duplicate
+
+
+def cluster_of(clusters, s):
+    return next(members for members in clusters if s in members)
+
+
+def test_plurals_share_a_cluster():
+    clusters = cluster_strings(["theory of mind", "theories of mind", "theory of art"],
+                               freqs={"theory of mind": 5, "theories of mind": 2, "theory of art": 1})
+    assert cluster_of(clusters, "theories of mind") == ["theory of mind", "theories of mind"]
+    assert cluster_of(clusters, "theory of art") == ["theory of art"]
+
+
+def test_one_letter_misspelling_joins_the_frequent_spelling():
+    clusters = cluster_strings(["theory of relativity", "theory of relatvity", "theory of evolution"],
+                               freqs={"theory of relativity": 9, "theory of relatvity": 1})
+    assert cluster_of(clusters, "theory of relatvity") == ["theory of relativity", "theory of relatvity"]
+    assert cluster_of(clusters, "theory of evolution") == ["theory of evolution"]
+
+
+def test_spacing_and_hyphen_variants_share_a_cluster():
+    clusters = cluster_strings(["post-structuralist theory", "poststructuralist theory"])
+    assert len(clusters) == 1
+
+
+def test_different_words_stay_apart():
+    assert not near_duplicate("theory of mind", "theory of kind")
+    assert not near_duplicate("theory of evolution", "theory of revolution")
+    assert not near_duplicate("strong theory", "string theory")
+    assert not near_duplicate("theory of relativity", "theory of relativity and gravity")
+    clusters = cluster_strings(["theory of mind", "theory of kind", "theory of evolution", "theory of revolution"])
+    assert len(clusters) == 4
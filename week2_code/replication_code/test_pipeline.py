@@ -0,0 +1,40 @@
+"""
+Tests for the stage hashing and output wiring of pipeline.py
+"""
+import pytest
+
+import pipeline
+from pipeline import STAGES, Stage, check_wiring, code_hashes
+
+
+def test_code_hash_covers_the_modules_a_stage_imports(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'CODE_DIR', str(tmp_path))
+    (tmp_path / 'stage.py').write_text("import os\nfrom helper import clean\n")
+    (tmp_path / 'helper.py').write_text("import shared\n\ndef clean(s):\n    return s\n")
+    (tmp_path / 'shared.py').write_text("LIMIT = 1\n")
+    before = code_hashes('stage')
+    assert sorted(before) == ['helper', 'shared', 'stage']
+
+    (tmp_path / 'shared.py').write_text("LIMIT = 2\n")
+    after = code_hashes('stage')
+    assert after['shared'] != before['shared']
+    assert after['stage'] == before['stage']
+
+
+def test_stages_hash_the_shared_helpers():
+    for stage in STAGES:
+        assert {stage.module, 'catalog'} <= set(code_hashes(stage.module))
+
+
+def test_stages_only_write_rerun_files_in_the_local_data_dir(monkeypatch):
+    check_wiring(STAGES)
+    for stage in STAGES:
+        for path in stage.output_paths():
+            assert path.startswith(pipeline.DATA_DIR) and '_rerun' in path
+
+    # A file of the original project resolves into original_project/data when it exists there
+    monkeypatch.setattr(pipeline, 'get_file_path', lambda f: f"/elsewhere/original_project/data/{f}")
+    stage = Stage('query_wikipedia', 'query_wikipedia', inputs={},
+                  outputs={'output_file': "2_wikipediacategoriesfromquery.csv"})
+    with pytest.raises(ValueError, match="outside"):
+        check_wiring([stage])
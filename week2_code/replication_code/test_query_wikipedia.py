@@ -0,0 +1,101 @@
+"""
+Tests for the concurrent category search of query_wikipedia.py against a local stub API
+"""
+import random
+import threading
+import time
+
+import pytest
+import requests
+
+from query_wikipedia import iter_wikipedia_category_pages, query_wikipedia_categories_concurrent
+from request_scheduler import RequestScheduler
+
+
+class StubResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class StubSession:
+    """Answers each search after a random delay and records the most requests in flight at once"""
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_seen = 0
+
+    def get(self, url, params=None, timeout=None):
+        with self.lock:
+            self.in_flight += 1
+            self.max_seen = max(self.max_seen, self.in_flight)
+            delay = self.random.uniform(0, 0.02)
+        time.sleep(delay)
+        with self.lock:
+            self.in_flight -= 1
+        return StubResponse({'query': {'search': [{'title': f"Category:{params['srsearch']}"}]}})
+
+
+class PagedSession:
+    """Answers a search with one result per page over pages pages, failing at the page numbered fail_at"""
+
+    def __init__(self, pages, fail_at=None):
+        self.pages = pages
+        self.fail_at = fail_at
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        offset = int(params.get('sroffset', 0))
+        if offset == self.fail_at:
+            raise requests.HTTPError("400 bad request")
+        data = {'query': {'search': [{'title': f"Category:Page {offset}"}]}}
+        if offset + 1 < self.pages:
+            data['continue'] = {'sroffset': offset + 1, 'continue': '-||'}
+        return StubResponse(data)
+
+
+QUERY_STRINGS = [f"theory of item {i}" for i in range(40)]
+
+
+def test_results_come_back_in_input_order():
+    results = query_wikipedia_categories_concurrent(QUERY_STRINGS, max_in_flight=8, session=StubSession())
+    assert [result[0]['title'] for result in results] == [f"Category:{s}" for s in QUERY_STRINGS]
+
+
+def test_requests_in_flight_never_exceed_the_bound():
+    session = StubSession()
+    results = list(query_wikipedia_categories_concurrent(QUERY_STRINGS, max_in_flight=3, session=session))
+    assert len(results) == len(QUERY_STRINGS)
+    assert 1 < session.max_seen <= 3
+
+
+def test_failed_page_is_raised_without_a_scheduler():
+    pages = iter_wikipedia_category_pages('theory of mind', session=PagedSession(5, fail_at=2))
+    with pytest.raises(requests.HTTPError):
+        list(pages)
+
+
+def test_failed_page_is_dead_lettered_with_a_scheduler():
+    scheduler = RequestScheduler()
+    pages = iter_wikipedia_category_pages('theory of mind', session=PagedSession(5, fail_at=2), scheduler=scheduler)
+    assert len(list(pages)) == 2
+    assert [d['key'] for d in scheduler.dead_letters] == ['theory of mind']
+
+
+def test_page_cap_is_reported(capsys):
+    pages = list(iter_wikipedia_category_pages('theory of mind', max_pages=3, session=PagedSession(5)))
+    assert len(pages) == 3
+    assert "stopped after 3 pages for 'theory of mind'" in capsys.readouterr().out
+
+    pages = list(iter_wikipedia_category_pages('theory of mind', max_pages=5, session=PagedSession(5)))
+    assert len(pages) == 5
+    assert "stopped after" not in capsys.readouterr().out
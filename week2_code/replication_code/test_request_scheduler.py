@@ -0,0 +1,113 @@
+"""
+Tests for the adaptive rate control of request_scheduler.py against a local stub API
+"""
+import pytest
+
+import request_scheduler
+from query_wikipedia import query_wikipedia_categories
+from request_scheduler import MAXLAG, RequestFailed, RequestScheduler
+
+
+class StubResponse:
+    def __init__(self, data=None, status_code=200, headers=None):
+        self.data = data or {}
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise request_scheduler.requests.HTTPError(f"{self.status_code} error", response=self)
+
+    def json(self):
+        return self.data
+
+
+class StubSession:
+    """Plays back a list of responses, then answers every further request with the last one"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        self.requests.append(params)
+        return self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+
+
+OK = StubResponse({'query': {'search': [{'title': 'Category:Theory'}]}})
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record the waits between retries instead of sleeping"""
+    waits = []
+    monkeypatch.setattr(request_scheduler.time, 'sleep', waits.append)
+    return waits
+
+
+def test_retry_after_is_honoured_before_retrying(sleeps):
+    session = StubSession([StubResponse(status_code=429, headers={'Retry-After': '0.05'}), OK])
+    scheduler = RequestScheduler(base_delay=0)
+    assert scheduler.get(session, 'http://stub') is OK
+    assert len(session.requests) == 2
+    assert sleeps == [0.05]
+    assert scheduler.stats()['throttled'] == 1
+    assert scheduler.stats()['retried'] == 1
+    assert scheduler.stats()['succeeded'] == 1
+
+
+def test_maxlag_errors_count_as_throttling(sleeps):
+    maxlagged = StubResponse({'error': {'code': 'maxlag'}}, headers={'MediaWiki-API-Error': 'maxlag'})
+    session = StubSession([maxlagged, OK])
+    scheduler = RequestScheduler(base_delay=0)
+    assert scheduler.get(session, 'http://stub', params={'action': 'query'}, mediawiki=True) is OK
+    assert [params['maxlag'] for params in session.requests] == [MAXLAG, MAXLAG]
+    assert scheduler.stats()['throttled'] == 1
+
+    # Outside MediaWiki the header means nothing and no maxlag is sent
+    session = StubSession([maxlagged])
+    assert scheduler.get(session, 'http://stub', params={'action': 'query'}) is maxlagged
+    assert 'maxlag' not in session.requests[0]
+
+
+def test_limit_halves_on_throttling_and_recovers_additively(sleeps):
+    scheduler = RequestScheduler(max_concurrency=8, base_delay=0)
+    throttled = StubResponse(status_code=503)
+
+    scheduler.get(StubSession([throttled, throttled, OK]), 'http://stub')
+    assert scheduler.limit == pytest.approx(2 + 1 / 2)
+
+    limits = []
+    for _ in range(30):
+        scheduler.get(StubSession([OK]), 'http://stub')
+        limits.append(scheduler.limit)
+    assert limits == sorted(limits)
+    # Additive increase: one request per window of limit successes
+    assert int(limits[4]) == 4
+    assert limits[-1] == 8
+
+
+def test_limit_never_drops_below_the_minimum(sleeps):
+    scheduler = RequestScheduler(max_concurrency=4, min_concurrency=2, max_retries=3, base_delay=0)
+    with pytest.raises(RequestFailed):
+        scheduler.get(StubSession([StubResponse(status_code=429)]), 'http://stub')
+    assert scheduler.limit == 2
+
+
+def test_other_http_errors_are_not_retried(sleeps):
+    session = StubSession([StubResponse(status_code=404)])
+    scheduler = RequestScheduler(base_delay=0)
+    with pytest.raises(request_scheduler.requests.HTTPError):
+        scheduler.get(session, 'http://stub')
+    assert len(session.requests) == 1
+    assert sleeps == []
+
+
+def test_strings_are_dead_lettered_once_retries_run_out(sleeps):
+    session = StubSession([StubResponse(status_code=429)])
+    scheduler = RequestScheduler(max_retries=2, base_delay=0)
+    assert query_wikipedia_categories('theory of mind', session=session, scheduler=scheduler) == []
+    assert len(session.requests) == 3
+    assert [d['key'] for d in scheduler.dead_letters] == ['theory of mind']
+    assert scheduler.stats()['failed'] == 1
+    assert scheduler.stats()['dead_letters'] == 1
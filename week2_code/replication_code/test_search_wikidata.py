@@ -0,0 +1,101 @@
+"""
+Tests for the subcategory crawl of search_wikidata.py against a local stub category graph
+"""
+import search_wikidata
+from search_wikidata import crawl_categories
+
+# Category -> direct subcategories. A -> B -> C -> A is a cycle, E sits below both
+# roots A and D, and F is only reachable three levels below A.
+GRAPH = {
+    'A': ['B', 'E'],
+    'B': ['C'],
+    'C': ['A', 'F'],
+    'D': ['E'],
+    'E': [],
+    'F': [],
+}
+
+
+class StubResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class StubSession:
+    """Answers categorymembers requests from GRAPH, one subcategory per page to exercise continuation"""
+
+    def __init__(self, graph=GRAPH):
+        self.graph = graph
+        self.requests = []
+
+    def get(self, url, params=None, timeout=None):
+        category = params['cmtitle']
+        offset = int(params.get('cmcontinue', 0))
+        if offset == 0:
+            self.requests.append(category)
+        members = self.graph[category]
+        data = {'query': {'categorymembers': [{'title': title} for title in members[offset:offset + 1]]}}
+        if offset + 1 < len(members):
+            data['continue'] = {'cmcontinue': str(offset + 1), 'continue': '-||'}
+        return StubResponse(data)
+
+
+def crawl(roots, max_depth, session=None):
+    return list(crawl_categories(roots, max_depth, max_in_flight=2, session=session or StubSession()))
+
+
+def test_fetch_subcategories_follows_continuation():
+    assert search_wikidata.fetch_subcategories('A', session=StubSession()) == ['B', 'E']
+
+
+def test_crawl_stops_at_cycles():
+    crawled = crawl(['A'], max_depth=10)
+    assert [category for category, _ in crawled] == ['A', 'B', 'E', 'C', 'F']
+
+
+def test_crawl_lists_each_category_once():
+    session = StubSession()
+    crawl(['A', 'D'], max_depth=10, session=session)
+    assert sorted(session.requests) == sorted(set(session.requests))
+
+
+def test_crawl_respects_depth_limit():
+    assert [category for category, _ in crawl(['A'], max_depth=0)] == ['A']
+    assert [category for category, _ in crawl(['A'], max_depth=1)] == ['A', 'B', 'E']
+    assert 'F' not in dict(crawl(['A'], max_depth=2))
+    assert 'F' in dict(crawl(['A'], max_depth=3))
+
+
+def test_crawl_tags_shortest_path_from_root():
+    paths = dict(crawl(['A'], max_depth=3))
+    assert paths['A'] == ('A',)
+    assert paths['C'] == ('A', 'B', 'C')
+    assert paths['F'] == ('A', 'B', 'C', 'F')
+
+
+def test_crawl_records_every_root_of_a_shared_subcategory():
+    crawled = crawl(['A', 'D'], max_depth=1)
+    assert sorted(path for category, path in crawled if category == 'E') == [('A', 'E'), ('D', 'E')]
+
+
+def test_unique_humans_keep_the_first_row_per_human(tmp_path):
+    output_file = tmp_path / 'humans.csv'
+    output_file.write_text("item,itemLabel,category\nQ1,Ann,A\nQ2,Bob,A\nQ1,Ann,B\nQ3,Cy,B\n")
+    unique_output_file = tmp_path / 'humans_unique.csv'
+    assert search_wikidata.write_unique_humans(output_file, unique_output_file, chunksize=2) == 3
+    assert unique_output_file.read_text() == "item,itemLabel\nQ1,Ann\nQ2,Bob\nQ3,Cy\n"
+
+
+def test_unique_humans_replace_an_earlier_file_when_there_are_no_results(tmp_path):
+    output_file = tmp_path / 'humans.csv'
+    output_file.write_text("item,itemLabel,category\n")
+    unique_output_file = tmp_path / 'humans_unique.csv'
+    unique_output_file.write_text("item,itemLabel\nQ1,Stale\n")
+    assert search_wikidata.write_unique_humans(output_file, unique_output_file) == 0
+    assert unique_output_file.read_text() == "item,itemLabel\n"
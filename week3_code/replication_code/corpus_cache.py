@@ -0,0 +1,239 @@
+"""
+Corpus Cache - compile the Chapter 2 word-count files into a sparse document-term matrix
+
+Parses every volume in data/sourcefiles/ once and saves its counts as a CSR
+matrix (data, indices, indptr) together with the global vocabulary, the volume
+ids and the word total of every volume, as .npy files under
+data/compiled/<corpus hash>/. The hash covers the names, sizes and modification
+times of the source files, so a changed corpus is compiled again. The arrays
+are loaded memory-mapped: later runs start in milliseconds, and processes that
+load the same corpus share its pages instead of copying them.
+
+Code that parses the source files itself, like horizon's versatiletrainer, can
+read them from the cache inside serve_from_cache(): opening a source file then
+returns its lines rebuilt from the matrix, limited to the model's vocabulary.
+
+Usage:
+    python corpus_cache.py
+    python corpus_cache.py --sourcefolder path/to/sourcefiles
+"""
+
+import argparse
+import builtins
+import hashlib
+import io
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from scipy import sparse
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCEFOLDER = os.path.join(SCRIPT_DIR, 'data', 'sourcefiles')
+COMPILED_DIR = os.path.join(SCRIPT_DIR, 'data', 'compiled')
+EXTENSION = '.tsv'
+
+# Features such as #wordlength are stored in the source files next to the words;
+# they are used as they are and do not count towards a volume's word total
+SPECIAL_PREFIX = '#'
+
+ARRAYS = ('data', 'indices', 'indptr', 'totals')
+
+# Served in place of the words left out of a volume, with their summed count, so that
+# a reader adding up every line still gets the volume's total
+REST_WORD = '#corpus_cache_rest'
+
+
+def source_files(sourcefolder=SOURCEFOLDER, extension=EXTENSION):
+    return sorted(name for name in os.listdir(sourcefolder) if name.endswith(extension))
+
+
+def corpus_hash(sourcefolder=SOURCEFOLDER, extension=EXTENSION):
+    """Hash the names, sizes and modification times of the source files"""
+    digest = hashlib.sha256()
+    for name in source_files(sourcefolder, extension):
+        stat = os.stat(os.path.join(sourcefolder, name))
+        digest.update(f"{name}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def read_counts(path):
+    """Yield (word, count) pairs from a word \\t count file, skipping malformed lines"""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 2:
+                continue
+            try:
+                yield fields[0], float(fields[1])
+            except ValueError:
+                continue
+
+
+def compile_corpus(sourcefolder=SOURCEFOLDER, extension=EXTENSION, compiled_dir=COMPILED_DIR):
+    """Parse all source files into a CSR matrix and save it; returns the cache directory"""
+    names = source_files(sourcefolder, extension)
+    target = os.path.join(compiled_dir, corpus_hash(sourcefolder, extension))
+    print(f"Compiling {len(names)} volumes from {sourcefolder}...")
+    start = time.time()
+
+    vocabulary = {}
+    data, indices, indptr, totals = [], [], [0], []
+    for i, name in enumerate(names):
+        counts = {}
+        total = 0
+        for word, count in read_counts(os.path.join(sourcefolder, name)):
+            column = vocabulary.setdefault(word, len(vocabulary))
+            counts[column] = counts.get(column, 0) + count
+            if not word.startswith(SPECIAL_PREFIX):
+                total += count
+        columns = sorted(counts)
+        indices.extend(columns)
+        data.extend(counts[column] for column in columns)
+        indptr.append(len(indices))
+        totals.append(total)
+        if (i + 1) % 100 == 0:
+            print(f"Parsed {i + 1}/{len(names)} volumes...")
+
+    index_dtype = np.int32 if len(indices) < 2 ** 31 and len(vocabulary) < 2 ** 31 else np.int64
+    arrays = {
+        'data': np.asarray(data, dtype=np.float64),
+        'indices': np.asarray(indices, dtype=index_dtype),
+        'indptr': np.asarray(indptr, dtype=index_dtype),
+        'totals': np.asarray(totals, dtype=np.float64),
+    }
+
+    # Write to a temporary directory first, so an interrupted compile is never picked up
+    partial = target + '.partial'
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    for key, array in arrays.items():
+        np.save(os.path.join(partial, key + '.npy'), array)
+    with open(os.path.join(partial, 'corpus.json'), 'w') as f:
+        json.dump({
+            'sourcefolder': sourcefolder,
+            'volids': [name[:-len(extension)] for name in names],
+            'vocabulary': list(vocabulary),
+        }, f)
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(partial, target)
+
+    print(f"Compiled {len(names)} volumes x {len(vocabulary)} words ({len(data)} nonzero counts) "
+          f"in {time.time() - start:.1f}s to {target}")
+    return target
+
+
+class CompiledCorpus:
+    """Memory-mapped document-term matrix of a compiled corpus"""
+
+    def __init__(self, path):
+        self.path = path
+        arrays = {key: np.load(os.path.join(path, key + '.npy'), mmap_mode='r') for key in ARRAYS}
+        with open(os.path.join(path, 'corpus.json')) as f:
+            info = json.load(f)
+        self.volids = info['volids']
+        self.vocabulary = info['vocabulary']
+        self.totals = arrays['totals']
+        self.matrix = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                                        shape=(len(self.volids), len(self.vocabulary)), copy=False)
+        self.row = {volid: i for i, volid in enumerate(self.volids)}
+        self.column = {word: j for j, word in enumerate(self.vocabulary)}
+
+    def rows(self, volids):
+        return np.array([self.row[volid] for volid in volids], dtype=np.int64)
+
+    def document_frequencies(self, volids):
+        """Number of the given volumes each word occurs in"""
+        counts = self.matrix[self.rows(volids)]
+        return np.bincount(counts.indices, minlength=len(self.vocabulary))
+
+    def features(self, volids, words):
+        """Dense (volumes x words) feature array: word frequencies per 100 words, special features as stored"""
+        rows = self.rows(volids)
+        columns = np.array([self.column.get(word, -1) for word in words])
+        present = columns >= 0
+        values = np.zeros((len(rows), len(words)))
+        values[:, present] = self.matrix[rows][:, columns[present]].toarray()
+        regular = np.array([not word.startswith(SPECIAL_PREFIX) for word in words], dtype=bool)
+        totals = np.asarray(self.totals[rows])[:, None]
+        values[:, regular] = 100 * values[:, regular] / np.maximum(totals, 1)
+        return values
+
+    def volume_text(self, row, columns=None):
+        """The word \\t count lines of a volume; with columns, only those words and a REST_WORD line"""
+        start, end = self.matrix.indptr[row], self.matrix.indptr[row + 1]
+        indices, counts = self.matrix.indices[start:end], self.matrix.data[start:end]
+        rest = 0
+        if columns is not None:
+            keep = np.isin(indices, columns)
+            rest = counts[~keep].sum()
+            indices, counts = indices[keep], counts[keep]
+        lines = [f"{self.vocabulary[j]}\t{format_count(count)}\n" for j, count in zip(indices, counts)]
+        if rest:
+            lines.append(f"{REST_WORD}\t{format_count(rest)}\n")
+        return ''.join(lines)
+
+
+def format_count(count):
+    # Counts are whole numbers in the source files, and readers may parse them with int()
+    return str(int(count)) if count == int(count) else str(count)
+
+
+@contextmanager
+def serve_from_cache(corpus, sourcefolder=SOURCEFOLDER, extension=EXTENSION, words=None):
+    """While active, opening a source file for reading returns its lines rebuilt from the corpus.
+
+    With words, only those words are served, plus one REST_WORD line with the
+    count of all the others. Yields a dict with the number of volumes served.
+    """
+    folder = os.path.realpath(sourcefolder)
+    columns = None if words is None else np.array(sorted({corpus.column[w] for w in words if w in corpus.column}))
+    served = {'volumes': 0}
+    original = builtins.open
+
+    def cached_open(file, mode='r', *args, **kwargs):
+        if isinstance(file, (str, os.PathLike)) and mode in ('r', 'rt'):
+            path = os.path.realpath(file)
+            name = os.path.basename(path)
+            row = corpus.row.get(name[:-len(extension)]) if name.endswith(extension) else None
+            if row is not None and os.path.dirname(path) == folder:
+                served['volumes'] += 1
+                return io.StringIO(corpus.volume_text(row, columns))
+        return original(file, mode, *args, **kwargs)
+
+    builtins.open = cached_open
+    try:
+        yield served
+    finally:
+        builtins.open = original
+
+
+def load_corpus(sourcefolder=SOURCEFOLDER, extension=EXTENSION, compiled_dir=COMPILED_DIR):
+    """Load the compiled corpus of the source folder, compiling it first if needed"""
+    path = os.path.join(compiled_dir, corpus_hash(sourcefolder, extension))
+    if not os.path.exists(os.path.join(path, 'corpus.json')):
+        path = compile_corpus(sourcefolder, extension, compiled_dir)
+    return CompiledCorpus(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile the Chapter 2 source files into a sparse matrix cache")
+    parser.add_argument('--sourcefolder', default=SOURCEFOLDER, help="folder of word \\t count files")
+    parser.add_argument('--extension', default=EXTENSION, help="extension of the source files")
+    parser.add_argument('--compiled-dir', default=COMPILED_DIR, help="where compiled corpora are kept")
+    parser.add_argument('--force', action='store_true', help="compile again even if the cache is current")
+    args = parser.parse_args()
+
+    if args.force:
+        compile_corpus(args.sourcefolder, args.extension, args.compiled_dir)
+    start = time.time()
+    corpus = load_corpus(args.sourcefolder, args.extension, args.compiled_dir)
+    print(f"Loaded {len(corpus.volids)} volumes x {len(corpus.vocabulary)} words "
+          f"from {corpus.path} in {(time.time() - start) * 1000:.0f} ms")
+
+
+if __name__ == '__main__':
+    main()
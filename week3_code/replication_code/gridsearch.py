@@ -0,0 +1,487 @@
+"""
+Grid Search - Chapter 2 genre models trained from the compiled corpus
+
+A replacement for versatiletrainer.tune_a_model that reads its features from
+the sparse matrix built by corpus_cache.py instead of parsing every source file
+again. Volumes are selected from the metadata by genre tags and date, with
+sizecap positives and as many negatives. The features are the special
+#-features plus the words found in the most volumes, and each feature count is
+sliced from the compiled matrix. Every (feature count, C) cell of the grid is
+scored by cross-validation with each author's volumes held out together. The
+best cell is refit on all volumes and written in the layout of the original
+output, next to it: {modelname}.compiled.csv with the cross-validated
+probabilities, {modelname}.compiled.coefs.csv and {modelname}.compiled.pkl,
+whose dict has the keys of horizon's model pickles.
+
+It is not yet a verified replacement: the samples are drawn with a fixed seed
+rather than versatiletrainer's, allwords is computed here from the compiled
+word totals, and C comes only from the grid, so a fixed regularization or
+test-only volumes (testconditions) are rejected. The outputs get their own
+names so they are never mistaken for horizon's. run_chapter2.py uses it only with
+--engine compiled until its outputs have been checked against horizon's; the
+default engine runs horizon's own trainer on the same compiled corpus (see
+corpus_cache.serve_from_cache).
+"""
+
+import csv
+import math
+import os
+import pickle
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import GroupKFold
+from sklearn.preprocessing import StandardScaler
+from threadpoolctl import threadpool_limits
+
+from corpus_cache import SPECIAL_PREFIX, load_corpus
+
+# Seed of the sizecap and class-balancing samples, so reruns select the same volumes
+SAMPLE_SEED = 0
+
+# Successive halving: cells start on HALVING_MIN_FOLDS folds, and after each rung
+# the best 1/HALVING_ETA of them go on to HALVING_ETA times as many folds
+HALVING_ETA = 3
+HALVING_MIN_FOLDS = 2
+
+# Iteration cap and stopping tolerance of the logistic regression solver
+MAX_ITER = 1000
+TOL = 1e-4
+
+# Inserted before the extensions of the output files, which sit next to horizon's
+OUTPUT_SUFFIX = '.compiled'
+
+OUTPUT_COLUMNS = ['volid', 'dateused', 'pubdate', 'birthdate', 'firstpub', 'gender', 'nation', 'allwords',
+                  'logistic', 'realclass', 'trainflag', 'author', 'title', 'genretags']
+
+
+def read_metadata(metadatapath):
+    """Read the metadata CSV indexed by docid, with genretags as a set per volume"""
+    meta = pd.read_csv(metadatapath, dtype={'docid': str}).drop_duplicates('docid').set_index('docid')
+    meta['tagset'] = meta['genretags'].fillna('').map(lambda tags: {t.strip() for t in tags.split('|') if t.strip()})
+    return meta
+
+
+def select_volumes(meta, volids, positive_tags, negative_tags, exclusions, datetype='firstpub', seed=SAMPLE_SEED):
+    """Pick the positive and negative volumes of a model, as versatiletrainer does.
+
+    Volumes must be in the corpus and pass the exclusions. At most sizecap
+    positives are kept, and negatives are sampled down to the same number.
+    Returns the selected metadata rows with a realclass column.
+    """
+    excludeif, excludeifnot, excludebelow, excludeabove, sizecap = exclusions
+    meta = meta[meta.index.isin(set(volids))]
+    for field, value in excludeif.items():
+        meta = meta[meta[field] != value]
+    for field, value in excludeifnot.items():
+        meta = meta[meta[field] == value]
+    for field, bound in excludebelow.items():
+        meta = meta[pd.to_numeric(meta[field], errors='coerce') >= bound]
+    for field, bound in excludeabove.items():
+        meta = meta[pd.to_numeric(meta[field], errors='coerce') <= bound]
+
+    positive_tags, negative_tags = set(positive_tags), set(negative_tags)
+    is_positive = meta['tagset'].map(lambda tags: bool(tags & positive_tags))
+    is_negative = ~is_positive & meta['tagset'].map(lambda tags: bool(tags & negative_tags))
+    positives, negatives = meta[is_positive], meta[is_negative]
+
+    if len(positives) > sizecap:
+        positives = positives.sample(sizecap, random_state=seed)
+    if len(negatives) > len(positives):
+        negatives = negatives.sample(len(positives), random_state=seed)
+
+    selected = pd.concat([positives.assign(realclass=1), negatives.assign(realclass=0)])
+    selected['dateused'] = pd.to_numeric(selected[datetype], errors='coerce')
+    return selected
+
+
+def ranked_vocabulary(corpus, volids, vocabpath=None, numfeatures=None):
+    """Special features first, then words by the number of selected volumes they occur in.
+
+    An existing vocabulary file is used as it is (first column of each line);
+    otherwise the ranking is written to vocabpath for the next run.
+    """
+    if vocabpath is not None and os.path.exists(vocabpath):
+        return read_vocabulary(vocabpath)
+
+    docfreq = corpus.document_frequencies(volids)
+    special = [j for j, word in enumerate(corpus.vocabulary) if word.startswith(SPECIAL_PREFIX)]
+    is_special = set(special)
+    order = [j for j in np.argsort(-docfreq, kind='stable') if docfreq[j] > 0 and j not in is_special]
+    words = [corpus.vocabulary[j] for j in special + order][:numfeatures]
+
+    if vocabpath is not None:
+        os.makedirs(os.path.dirname(vocabpath), exist_ok=True)
+        with open(vocabpath, 'w', encoding='utf-8') as f:
+            for word in words:
+                f.write(f"{word}\t{docfreq[corpus.column[word]]}\n")
+    return words
+
+
+def read_vocabulary(vocabpath):
+    """The words of a vocabulary file, the first column of each line"""
+    with open(vocabpath, encoding='utf-8') as f:
+        return [line.split('\t')[0].strip() for line in f if line.strip()]
+
+
+def author_folds(authors, k):
+    """Cross-validation folds that keep all volumes of an author on the same side"""
+    groups = pd.factorize(pd.Series(authors).fillna('').astype(str))[0]
+    return list(GroupKFold(n_splits=min(k, len(set(groups)))).split(np.zeros(len(groups)), groups=groups))
+
+
+def standardized(values):
+    scaler = StandardScaler()
+    return scaler.fit_transform(values), scaler
+
+
+def new_model(c):
+    return LogisticRegression(C=c, max_iter=MAX_ITER, tol=TOL)
+
+
+def cross_validate(X, y, folds, c):
+    """Out-of-fold probabilities of the positive class, and the solver iterations spent"""
+    probabilities = np.zeros(len(y))
+    iterations = 0
+    for train, test in folds:
+        model = new_model(c).fit(X[train], y[train])
+        probabilities[test] = model.predict_proba(X[test])[:, 1]
+        iterations += int(model.n_iter_[0])
+    return probabilities, iterations
+
+
+def accuracy(probabilities, y):
+    return float(np.mean((probabilities > 0.5) == (y == 1)))
+
+
+def sequential_grid(corpus, volids, vocabulary, y, folds, featurecounts, c_range):
+    """Out-of-fold probabilities of every (feature count, C) cell, one cell after another"""
+    probabilities = {}
+    iterations = 0
+    for i, count in enumerate(featurecounts):
+        X, _ = standardized(corpus.features(volids, vocabulary[:count]))
+        for j, c in enumerate(c_range):
+            probabilities[i, j], n_iter = cross_validate(X, y, folds, c)
+            iterations += n_iter
+        print(f"Scored {count} features...")
+    return probabilities, iterations
+
+
+# Read-only state of a grid worker process, set by init_grid_worker
+_worker = {}
+
+
+def init_grid_worker(matrixpath, y, folds):
+    # Memory-mapped: every worker reads the same pages of the standardized matrix
+    set_worker_state(np.load(matrixpath, mmap_mode='r'), y, folds)
+    # The pool already uses every core; threaded BLAS in each worker would oversubscribe them
+    threadpool_limits(1)
+
+
+def set_worker_state(X, y, folds):
+    _worker['X'] = X
+    _worker['y'] = y
+    _worker['folds'] = folds
+
+
+def fit_cell(task):
+    """Worker: fit one fold of one (feature count, C) cell; returns its test probabilities and solver iterations"""
+    count, c, fold = task
+    train, test = _worker['folds'][fold]
+    X, y = _worker['X'], _worker['y']
+    model = new_model(c).fit(X[train, :count], y[train])
+    return model.predict_proba(X[test, :count])[:, 1], int(model.n_iter_[0])
+
+
+def parallel_grid(values, y, folds, featurecounts, c_range, workers):
+    """Out-of-fold probabilities of every (feature count, C) cell, with the fits spread over a process pool.
+
+    values holds the features of the largest feature count. Standardization is
+    per column, so the first count columns of the standardized matrix are the
+    standardized features of a smaller count. The matrix is written once to a
+    temporary .npy file that every worker memory-maps, and each task fits one
+    fold of one cell.
+    """
+    X, _ = standardized(values)
+    tasks = [(i, j, fold) for i in range(len(featurecounts)) for j in range(len(c_range)) for fold in range(len(folds))]
+    probabilities = {(i, j): np.zeros(len(y)) for i in range(len(featurecounts)) for j in range(len(c_range))}
+    iterations = 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        matrixpath = os.path.join(tmp, 'standardized.npy')
+        np.save(matrixpath, X)
+        del X
+        print(f"Fitting {len(tasks)} (features, C, fold) tasks on {workers} workers...")
+        chunksize = max(1, len(tasks) // (workers * 8))
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_grid_worker,
+                                 initargs=(matrixpath, y, folds)) as executor:
+            cells = ((featurecounts[i], c_range[j], fold) for i, j, fold in tasks)
+            results = executor.map(fit_cell, cells, chunksize=chunksize)
+            for n, ((i, j, fold), (result, n_iter)) in enumerate(zip(tasks, results)):
+                probabilities[i, j][folds[fold][1]] = result
+                iterations += n_iter
+                if (n + 1) % (len(folds) * len(c_range)) == 0:
+                    print(f"Scored {featurecounts[i]} features...")
+    return probabilities, iterations
+
+
+def fit_path(fold, featurecounts, c_range):
+    """Worker: fit one fold over the whole grid along warm-started regularization paths.
+
+    For every feature count, C runs from the smallest to the largest value and
+    each fit starts from the coefficients of the previous C. The first C of a
+    feature count starts from the previous count's coefficients for that C,
+    padded with zeros for the added columns. Returns the test probabilities of
+    every cell and the solver iterations spent.
+    """
+    train, test = _worker['folds'][fold]
+    X, y = _worker['X'], _worker['y']
+    probabilities = {}
+    iterations = 0
+    first = None
+    for i, count in enumerate(featurecounts):
+        Xtrain, Xtest = X[train, :count], X[test, :count]
+        model = LogisticRegression(max_iter=MAX_ITER, tol=TOL, warm_start=True)
+        for step, j in enumerate(np.argsort(c_range, kind='stable')):
+            model.set_params(C=c_range[j])
+            if step == 0 and first is not None:
+                coef, intercept = first
+                model.coef_ = np.pad(coef, ((0, 0), (0, Xtrain.shape[1] - coef.shape[1])))
+                model.intercept_ = intercept
+            model.fit(Xtrain, y[train])
+            iterations += int(model.n_iter_[0])
+            if step == 0:
+                first = (model.coef_.copy(), model.intercept_.copy())
+            probabilities[i, j] = model.predict_proba(Xtest)[:, 1]
+    return probabilities, iterations
+
+
+def path_grid(values, y, folds, featurecounts, c_range, workers=1):
+    """Out-of-fold probabilities of every (feature count, C) cell from warm-started paths (see fit_path).
+
+    The features of the largest count are standardized once and smaller counts
+    take column prefixes of that matrix. With workers > 1 each fold's path runs
+    in its own process on a memory-mapped copy, as in parallel_grid.
+    """
+    X, _ = standardized(values)
+    probabilities = {(i, j): np.zeros(len(y)) for i in range(len(featurecounts)) for j in range(len(c_range))}
+    iterations = 0
+
+    def collect(fold, result):
+        nonlocal iterations
+        cells, n_iter = result
+        for cell, p in cells.items():
+            probabilities[cell][folds[fold][1]] = p
+        iterations += n_iter
+        print(f"Finished fold {fold + 1}/{len(folds)}...")
+
+    if workers > 1:
+        with tempfile.TemporaryDirectory() as tmp:
+            matrixpath = os.path.join(tmp, 'standardized.npy')
+            np.save(matrixpath, X)
+            del X
+            with ProcessPoolExecutor(max_workers=min(workers, len(folds)), initializer=init_grid_worker,
+                                     initargs=(matrixpath, y, folds)) as executor:
+                futures = [executor.submit(fit_path, fold, featurecounts, c_range) for fold in range(len(folds))]
+                for fold, future in enumerate(futures):
+                    collect(fold, future.result())
+    else:
+        set_worker_state(X, y, folds)
+        for fold in range(len(folds)):
+            collect(fold, fit_path(fold, featurecounts, c_range))
+    return probabilities, iterations
+
+
+def halving_grid(values, y, folds, featurecounts, c_range, workers=1, eta=HALVING_ETA, min_folds=HALVING_MIN_FOLDS):
+    """Successive halving over the (feature count, C) cells.
+
+    Every cell is first scored on min_folds folds. The best 1/eta of the cells
+    go on to eta times as many folds, and so on until the survivors have been
+    cross-validated on all folds. Fits from earlier rungs are kept, so no cell
+    is fit twice on the same fold. Returns the out-of-fold probabilities of the
+    surviving cells, which reached every fold, the number of fits and the
+    solver iterations.
+    """
+    X, _ = standardized(values)
+    cells = [(i, j) for i in range(len(featurecounts)) for j in range(len(c_range))]
+    probabilities = {cell: np.zeros(len(y)) for cell in cells}
+    scores = {}
+    fitted = 0
+    fits = iterations = 0
+
+    with ExitStack() as stack:
+        if workers > 1:
+            tmp = stack.enter_context(tempfile.TemporaryDirectory())
+            matrixpath = os.path.join(tmp, 'standardized.npy')
+            np.save(matrixpath, X)
+            del X
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers, initializer=init_grid_worker,
+                                                               initargs=(matrixpath, y, folds)))
+
+            def run(tasks):
+                return executor.map(fit_cell, tasks, chunksize=max(1, len(tasks) // (workers * 8)))
+        else:
+            set_worker_state(X, y, folds)
+
+            def run(tasks):
+                return map(fit_cell, tasks)
+
+        alive = cells
+        n_folds = min(min_folds, len(folds))
+        while True:
+            tasks = [(cell, fold) for cell in alive for fold in range(fitted, n_folds)]
+            results = run([(featurecounts[i], c_range[j], fold) for (i, j), fold in tasks])
+            for (cell, fold), (result, n_iter) in zip(tasks, results):
+                probabilities[cell][folds[fold][1]] = result
+                iterations += n_iter
+            fits += len(tasks)
+            fitted = n_folds
+
+            tested = np.concatenate([folds[fold][1] for fold in range(n_folds)])
+            for cell in alive:
+                scores[cell] = accuracy(probabilities[cell][tested], y[tested])
+            print(f"Scored {len(alive)} cells on {n_folds}/{len(folds)} folds...")
+            if n_folds == len(folds):
+                break
+            alive = sorted(alive, key=lambda cell: (-scores[cell], cell))[:max(1, math.ceil(len(alive) / eta))]
+            n_folds = min(n_folds * eta, len(folds))
+
+    return {cell: probabilities[cell] for cell in sorted(alive)}, fits, iterations
+
+
+def tune_a_model(paths, exclusions, classifyconditions, modelparams, corpus=None, workers=1, search='grid',
+                 compare=False, meta=None):
+    """Grid search over feature counts and C, then fit and write the best model.
+
+    Takes the arguments of versatiletrainer.tune_a_model and returns the same
+    (matrix, rawaccuracy, allvolumes, coefficientuples). With workers > 1 the
+    fits run in parallel (see parallel_grid) and give the same matrix. With
+    search='path' every fold is solved along warm-started paths (see path_grid),
+    which reach the same optima, up to the solver's tolerance, in far fewer
+    iterations; the chosen cell is then cross-validated again with cold fits,
+    so its written probabilities and accuracy match grid mode. With search='halving' only the most promising cells are
+    cross-validated on all folds (see halving_grid), and the matrix is NaN for
+    the cells dropped on the way; compare=True also runs the exhaustive grid
+    and reports how far the chosen cell is from its optimum.
+    An already loaded corpus and metadata table (read_metadata) can be passed
+    in, so that several models share them. regularization must be None and
+    testconditions empty, since neither is supported.
+    """
+    sourcefolder, extension, metadatapath, outputpath, vocabpath = paths
+    positive_tags, negative_tags, datetype, numfeatures, regularization, testconditions = classifyconditions
+    algorithm, k, ftstart, ftend, ftstep, c_range = modelparams
+    if regularization is not None:
+        raise ValueError(f"gridsearch picks C from c_range by cross-validation and cannot apply a fixed "
+                         f"regularization ({regularization}); pass None, or use versatiletrainer")
+    if testconditions:
+        raise ValueError(f"gridsearch cannot hold out test volumes ({', '.join(sorted(testconditions))}); "
+                         f"use versatiletrainer")
+
+    if corpus is None:
+        corpus = load_corpus(sourcefolder, extension)
+    if meta is None:
+        meta = read_metadata(metadatapath)
+    selected = select_volumes(meta, corpus.volids, positive_tags, negative_tags, exclusions, datetype)
+    volids = selected.index.tolist()
+    y = selected['realclass'].to_numpy()
+    print(f"Selected {int(y.sum())} positive and {int(len(y) - y.sum())} negative volumes")
+
+    featurecounts = list(range(ftstart, ftend, ftstep)) or [ftstart]
+    vocabulary = ranked_vocabulary(corpus, volids, vocabpath, max(max(featurecounts), numfeatures))
+    folds = author_folds(selected['author'], k)
+
+    def exhaustive():
+        if workers > 1:
+            values = corpus.features(volids, vocabulary[:max(featurecounts)])
+            return parallel_grid(values, y, folds, featurecounts, c_range, workers)
+        return sequential_grid(corpus, volids, vocabulary, y, folds, featurecounts, c_range)
+
+    n_fits = len(featurecounts) * len(c_range) * len(folds)
+    if search == 'halving':
+        values = corpus.features(volids, vocabulary[:max(featurecounts)])
+        grid, n_fits, iterations = halving_grid(values, y, folds, featurecounts, c_range, workers)
+    elif search == 'path':
+        values = corpus.features(volids, vocabulary[:max(featurecounts)])
+        grid, iterations = path_grid(values, y, folds, featurecounts, c_range, workers)
+    else:
+        grid, iterations = exhaustive()
+    print(f"Fits: {n_fits}, solver iterations: {iterations}")
+
+    # Cells that successive halving dropped before the last rung were not scored on every fold and stay NaN
+    matrix = np.full((len(featurecounts), len(c_range)), np.nan)
+    for (i, j), p in grid.items():
+        matrix[i, j] = accuracy(p, y)
+    for i, count in enumerate(featurecounts):
+        if np.isnan(matrix[i]).all():
+            print(f"{count} features: dropped before the last rung")
+            continue
+        best = int(np.nanargmax(matrix[i]))
+        print(f"{count} features: best accuracy {matrix[i, best]:.4f} at C={c_range[best]}")
+
+    # The first fully cross-validated cell with the highest accuracy wins, in (feature count, C) order
+    i, j = max(sorted(grid), key=lambda cell: matrix[cell])
+    rawaccuracy, count, c, probabilities = float(matrix[i, j]), featurecounts[i], c_range[j], grid[i, j]
+    if search == 'path':
+        # Cross-validate the chosen cell again from scratch, so its probabilities and accuracy
+        # are the ones grid mode would have written for it
+        X, _ = standardized(corpus.features(volids, vocabulary[:count]))
+        probabilities, _ = cross_validate(X, y, folds, c)
+        rawaccuracy = matrix[i, j] = accuracy(probabilities, y)
+    print(f"Best: {count} features, C={c}, accuracy {rawaccuracy:.4f}")
+
+    if search == 'halving' and compare:
+        full = {cell: accuracy(p, y) for cell, p in exhaustive()[0].items()}
+        optimum = max(sorted(full), key=full.get)
+        print(f"Exhaustive optimum: {featurecounts[optimum[0]]} features, C={c_range[optimum[1]]}, "
+              f"accuracy {full[optimum]:.4f} with {len(full) * len(folds)} fits; successive halving is "
+              f"{full[optimum] - full[i, j]:.4f} below it with {n_fits} fits")
+    return write_model(corpus, selected, vocabulary[:count], c, probabilities, outputpath,
+                       positive_tags, negative_tags, algorithm, matrix, rawaccuracy)
+
+
+def write_model(corpus, selected, vocabulary, c, probabilities, outputpath, positive_tags, negative_tags,
+                algorithm, matrix, rawaccuracy):
+    """Refit the chosen cell on all volumes and write the .compiled.csv, .coefs.csv and .pkl outputs"""
+    name = os.path.basename(outputpath).replace('.csv', '')
+    base = outputpath[:-len('.csv')] + OUTPUT_SUFFIX
+    volids = selected.index.tolist()
+    y = selected['realclass'].to_numpy()
+    X, scaler = standardized(corpus.features(volids, vocabulary))
+    model = new_model(c).fit(X, y)
+
+    # testconditions are rejected, so every selected volume is a training volume (trainflag 1)
+    allvolumes = []
+    for (volid, row), probability, total in zip(selected.iterrows(), probabilities, corpus.totals[corpus.rows(volids)]):
+        allvolumes.append([volid, row['dateused'], row.get('pubdate'), row.get('birthdate'), row.get('firstpub'),
+                           row.get('gender'), row.get('nation'), math.log(max(total, 1)), probability,
+                           row['realclass'], 1, row.get('author'), row.get('title'), " | ".join(sorted(row['tagset']))])
+    os.makedirs(os.path.dirname(outputpath), exist_ok=True)
+    pd.DataFrame(allvolumes, columns=OUTPUT_COLUMNS).to_csv(base + '.csv', index=False)
+
+    # Coefficients per 100 words, and divided by the feature's variance, from most negative to most positive
+    coefficients = model.coef_[0] * 100
+    normalized = coefficients / np.where(scaler.var_ > 0, scaler.var_, 1)
+    coefficientuples = sorted(zip(coefficients, normalized, vocabulary))
+    with open(base + '.coefs.csv', 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        for coefficient, norm, word in coefficientuples:
+            writer.writerow([word, coefficient, norm])
+
+    with open(base + '.pkl', 'wb') as f:
+        pickle.dump({
+            'vocabulary': list(vocabulary),
+            'itself': model,
+            'algorithm': algorithm,
+            'scaler': scaler,
+            'positivelabel': list(positive_tags),
+            'negativelabel': list(negative_tags),
+            'c': c,
+            'n': len(y),
+            'name': name,
+        }, f)
+    print(f"Saved {base}.csv and its .coefs.csv and .pkl")
+    return matrix, rawaccuracy, allvolumes, coefficientuples
@@ -10,9 +10,23 @@ Usage:
     python run_chapter2.py locdetective
     python run_chapter2.py allSF
     python run_chapter2.py detectnewgatesensation
+    python run_chapter2.py allSF --profile tune_a_model
+    python run_chapter2.py allSF --engine compiled  # gridsearch.py on the compiled corpus
+    python run_chapter2.py allSF --no-cache         # horizon reading the source files
+    python run_chapter2.py all                      # every model, sharing one loaded corpus
+    python run_chapter2.py locdetective,allSF
+
+Both engines read data/sourcefiles from a compiled sparse matrix (see
+corpus_cache.py), built on the first run. The default engine is horizon's
+versatiletrainer, whose reads of the source files are served from the matrix,
+limited to the model's lexicon (--no-cache reads the files instead).
+--engine compiled (gridsearch.py) slices its features from the matrix directly;
+it stays opt-in until its outputs have been checked against horizon's.
 """
 
-import csv, os, sys, pickle, math
+import argparse
+import csv, os, sys, pickle, math, time
+from functools import partial
 import pandas as pd
 
 # Get the directory where this script lives
@@ -27,7 +41,9 @@ LOGISTIC_DIR = os.path.join(HORIZON_DIR, 'logistic')
 sys.path.insert(0, ORIGINAL_PROJECT_DIR)  # for 'import horizon'
 sys.path.insert(0, LOGISTIC_DIR)  # for bare imports in logistic modules
 
-from horizon.logistic import versatiletrainer as train
+import corpus_cache
+import gridsearch
+from run_report import add_arguments, from_args, record, stage
 
 # Define paths relative to replication_code directory
 # Data sourcefiles are stored locally in this project
@@ -35,16 +51,33 @@ SOURCEFOLDER = os.path.join(SCRIPT_DIR, 'data', 'sourcefiles')
 # Metadata and lexicons come from Ted's horizon project
 METADATAPATH = os.path.join(HORIZON_DIR, 'chapter2', 'metadata', 'concatenatedmeta.csv')
 OUTPUTDIR = os.path.join(SCRIPT_DIR, 'model_output')
+REPORTDIR = os.path.join(OUTPUTDIR, 'reports')
 LEXICONDIR = os.path.join(HORIZON_DIR, 'lexicons')
 
+# Model options accepted on the command line; 'all' runs every one of them
+MODEL_OPTIONS = ['locdetective', 'alldetective', 'allSF', 'detectnewgatesensation', 'allgothic', 'sensation',
+                 'newgateonly']
+
 
 def genre_gridsearch(modelname, c_range, ftstart, ftend, ftstep, positive_tags,
                      negative_tags=['random', 'grandom', 'chirandom'],
                      excl_below=1700, excl_above=2000,
-                     metadatapath=None):
+                     metadatapath=None, engine='horizon', workers=None, search='grid', compare=False,
+                     corpus=None, meta=None, cache=True):
     """
     Perform grid search to find optimal feature count and regularization.
     Then produce that model and write it to disk.
+
+    engine='horizon' runs the original versatiletrainer.tune_a_model, reading
+    the volumes from the compiled corpus unless cache=False;
+    engine='compiled' trains from the compiled corpus cache (gridsearch.py),
+    which picks C by cross-validation instead of the fixed regularization.
+    With the compiled engine, the grid is fit on workers processes (default: all CPUs);
+    search='path' solves it along warm-started regularization paths instead, and
+    search='halving' cross-validates only the most promising cells on all folds
+    (compare=True also runs the full grid to measure the gap to its optimum).
+    corpus and meta, when given, are an already loaded compiled corpus and
+    metadata table, shared by several models.
     """
 
     if metadatapath is None:
@@ -75,7 +108,8 @@ def genre_gridsearch(modelname, c_range, ftstart, ftend, ftstep, positive_tags,
 
     datetype = "firstpub"
     numfeatures = ftend
-    regularization = .000075
+    # gridsearch.py only picks C from c_range and rejects a fixed regularization
+    regularization = .000075 if engine == 'horizon' else None
 
     paths = (sourcefolder, extension, metadatapath, outputpath, vocabpath)
     exclusions = (excludeif, excludeifnot, excludebelow, excludeabove, sizecap)
@@ -94,17 +128,48 @@ def genre_gridsearch(modelname, c_range, ftstart, ftend, ftstep, positive_tags,
     print(f"\nModel params: {modelparams}")
     print("\nStarting model training...")
 
-    matrix, rawaccuracy, allvolumes, coefficientuples = train.tune_a_model(paths, exclusions, classifyconditions, modelparams)
+    if engine == 'horizon':
+        from horizon.logistic import versatiletrainer as train
+        tune = train.tune_a_model
+        if cache and corpus is None:
+            with stage('load'):
+                corpus = corpus_cache.load_corpus(sourcefolder, extension)
+    else:
+        workers = workers or os.cpu_count() or 1
+        tune = partial(gridsearch.tune_a_model, workers=workers, search=search, compare=compare,
+                       corpus=corpus, meta=meta)
+
+    with stage('tune_a_model'):
+        if engine == 'horizon' and cache:
+            # versatiletrainer parses the volumes itself; serve them from the matrix, cut to the lexicon
+            words = gridsearch.read_vocabulary(vocabpath) if os.path.exists(vocabpath) else None
+            with corpus_cache.serve_from_cache(corpus, sourcefolder, extension, words) as served:
+                matrix, rawaccuracy, allvolumes, coefficientuples = tune(paths, exclusions, classifyconditions,
+                                                                         modelparams)
+            print(f"Served {served['volumes']} volume reads from the compiled corpus")
+        else:
+            matrix, rawaccuracy, allvolumes, coefficientuples = tune(paths, exclusions, classifyconditions,
+                                                                     modelparams)
+    record(volumes=len(allvolumes), accuracy=rawaccuracy)
 
     print(f'\nIf we divide the dataset with a horizontal line at 0.5, accuracy is: {rawaccuracy}')
     return rawaccuracy
 
 
 def main():
-    args = sys.argv
+    # --no-report and --profile may come anywhere; the model option stays the first other argument
+    parser = argparse.ArgumentParser(add_help=False)
+    add_arguments(parser)
+    parser.add_argument('--engine', choices=['compiled', 'horizon'], default='horizon')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--search', choices=['grid', 'path', 'halving'], default='grid')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--no-cache', action='store_true')
+    flags, rest = parser.parse_known_args(sys.argv[1:])
+    args = [sys.argv[0]] + rest
 
     if len(args) < 2:
-        print("Usage: python run_chapter2.py <model_option>")
+        print("Usage: python run_chapter2.py <model_option>[,<model_option>...] | all")
         print("\nAvailable options:")
         print("  locdetective      - Library of Congress detective fiction")
         print("  alldetective      - All detective fiction sources")
@@ -113,17 +178,97 @@ def main():
         print("  allgothic         - All gothic fiction")
         print("  sensation         - Sensation fiction only")
         print("  newgateonly       - Newgate fiction only")
+        print("  all               - every model above, loading the corpus once")
+        print("\nOptions:")
+        print("  --no-report       - do not write the JSON run report to model_output/reports")
+        print("  --profile [STAGE] - also write cProfile output (e.g. --profile tune_a_model)")
+        print("  --engine compiled - train from the compiled corpus (gridsearch.py) instead of versatiletrainer")
+        print("  --no-cache        - let versatiletrainer read the source files instead of the compiled corpus")
+        print("  --workers N       - with --engine compiled, processes fitting the grid (default: all CPUs)")
+        print("  --search path     - warm-start the fits along C and nested feature counts")
+        print("  --search halving  - successive halving: drop weak cells after a few folds")
+        print("  --compare         - with --search halving, also run the full grid and report the gap")
+        sys.exit(1)
+
+    if flags.engine == 'horizon' and (flags.workers or flags.search != 'grid' or flags.compare):
+        print("--workers, --search and --compare need --engine compiled")
+        sys.exit(1)
+    if flags.engine == 'compiled' and flags.no_cache:
+        print("--no-cache applies only to --engine horizon")
         sys.exit(1)
 
     option = args[1]
+    options = MODEL_OPTIONS if option == 'all' else option.split(',')
+    unknown = [o for o in options if o not in MODEL_OPTIONS]
+    if unknown:
+        print(f"Unknown option: {', '.join(unknown)}")
+        print("Run without arguments to see available options.")
+        sys.exit(1)
+
+    settings = dict(engine=flags.engine, workers=flags.workers, search=flags.search, compare=flags.compare,
+                    cache=not flags.no_cache)
+    failed = []
+    with from_args(f"run_chapter2-{option.replace(',', '-')}", flags, report_dir=REPORTDIR):
+        if len(options) == 1:
+            run_model(options[0], **settings)
+        else:
+            results = run_batch(options, **settings)
+            failed = [o for o, (accuracy, _) in results.items() if accuracy is None]
+    # Exit only after the run report is written, so it records the failed models too
+    if failed:
+        print(f"Failed: {', '.join(failed)}")
+        sys.exit(1)
 
+
+def run_batch(options, **settings):
+    """Run several model options back to back.
+
+    They share one loaded compiled corpus, which versatiletrainer reads its
+    volumes from (unless cache=False), and with the compiled engine also one
+    metadata table. Each model writes its
+    outputs as soon as it finishes; a model that fails is reported and
+    skipped, and its accuracy is None in the returned results. Ends with a
+    summary of the accuracies.
+    """
+    compiled = settings.get('engine', 'horizon') == 'compiled'
+    if compiled or settings.get('cache', True):
+        with stage('load'):
+            settings['corpus'] = corpus_cache.load_corpus(SOURCEFOLDER, '.tsv')
+            if compiled:
+                settings['meta'] = gridsearch.read_metadata(METADATAPATH)
+        print(f"Loaded {len(settings['corpus'].volids)} volumes for {len(options)} models")
+
+    results = {}
+    for n, option in enumerate(options):
+        print(f"\n=== [{n + 1}/{len(options)}] {option} ===")
+        start = time.time()
+        with stage(option):
+            try:
+                accuracy = run_model(option, **settings)
+            except Exception as e:
+                print(f"{option} failed: {e}")
+                record(error=f"{type(e).__name__}: {e}")
+                accuracy = None
+        results[option] = (accuracy, time.time() - start)
+
+    print("\n=== Summary ===")
+    print(f"{'model':<24}{'accuracy':>10}{'minutes':>10}")
+    for option, (accuracy, seconds) in results.items():
+        shown = f"{accuracy:.4f}" if accuracy is not None else "failed"
+        print(f"{option:<24}{shown:>10}{seconds / 60:>10.1f}")
+    return results
+
+
+def run_model(option, **settings):
+    """Set up the grid for one model option and run genre_gridsearch; settings are passed on to it"""
     if option == 'locdetective':
         positive_tags = ['locdetective', 'locdetmyst', 'chimyst']
         c_range = [.001, .003, .01, .03, .1, .3, 1, 8]
         featurestart = 2000
         featureend = 5250
         featurestep = 250
-        genre_gridsearch('locdetective', c_range, featurestart, featureend, featurestep, positive_tags)
+        return genre_gridsearch('locdetective', c_range, featurestart, featureend, featurestep, positive_tags,
+                                **settings)
 
     elif option == 'alldetective':
         positive_tags = ['locdetective', 'locdetmyst', 'chimyst', 'det100']
@@ -131,7 +276,8 @@ def main():
         featurestart = 3000
         featureend = 4400
         featurestep = 50
-        genre_gridsearch('alldetective', c_range, featurestart, featureend, featurestep, positive_tags)
+        return genre_gridsearch('alldetective', c_range, featurestart, featureend, featurestep, positive_tags,
+                                **settings)
 
     elif option == 'allSF':
         positive_tags = ['locscifi', 'anatscifi', 'femscifi', 'chiscifi']
@@ -139,7 +285,8 @@ def main():
         featurestart = 2000
         featureend = 6000
         featurestep = 100
-        genre_gridsearch('allSF', c_range, featurestart, featureend, featurestep, positive_tags)
+        return genre_gridsearch('allSF', c_range, featurestart, featureend, featurestep, positive_tags,
+                                **settings)
 
     elif option == 'detectnewgatesensation':
         positive_tags = ['locdetective', 'locdetmyst', 'chimyst', 'det100', 'newgate', 'sensation']
@@ -147,7 +294,8 @@ def main():
         featurestart = 2800
         featureend = 4400
         featurestep = 100
-        genre_gridsearch('detectnewgatesensation', c_range, featurestart, featureend, featurestep, positive_tags)
+        return genre_gridsearch('detectnewgatesensation', c_range, featurestart, featureend, featurestep, positive_tags,
+                                **settings)
 
     elif option == 'allgothic':
         positive_tags = ['stangothic', 'pbgothic', 'lochorror', 'locghost', 'chihorror']
@@ -155,7 +303,8 @@ def main():
         featurestart = 2500
         featureend = 5000
         featurestep = 250
-        genre_gridsearch('allgothic', c_range, featurestart, featureend, featurestep, positive_tags)
+        return genre_gridsearch('allgothic', c_range, featurestart, featureend, featurestep, positive_tags,
+                                **settings)
 
     elif option == 'sensation':
         positive_tags = ['sensation']
@@ -163,7 +312,8 @@ def main():
         featurestart = 2000
         featureend = 4800
         featurestep = 200
-        genre_gridsearch('sensation', c_range, featurestart, featureend, featurestep, positive_tags)
+        return genre_gridsearch('sensation', c_range, featurestart, featureend, featurestep, positive_tags,
+                                **settings)
 
     elif option == 'newgateonly':
         positive_tags = ['newgate']
@@ -171,7 +321,8 @@ def main():
         featurestart = 2000
         featureend = 4800
         featurestep = 200
-        genre_gridsearch('newgateonly', c_range, featurestart, featureend, featurestep, positive_tags)
+        return genre_gridsearch('newgateonly', c_range, featurestart, featureend, featurestep, positive_tags,
+                                **settings)
 
     else:
         print(f"Unknown option: {option}")
@@ -0,0 +1,147 @@
+"""
+Run Report - per-stage timings and counters of a Chapter 2 run, written as JSON
+
+run_chapter2.py opens a RunReport around each run unless started with
+--no-report. Inside it, stage() blocks record wall and CPU time and peak RSS
+(including the worker processes of the grid search) and record() adds counters
+such as the number of volumes or the accuracy. Outside a RunReport both are
+no-ops. With --profile, the named stage (or the whole run) is also run under
+cProfile. Uses only the standard library, so the report never adds to the
+dependencies of the training code.
+"""
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+_current = None
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process and of its finished children, in MB"""
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    scale = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) * scale / 2 ** 20, 1)
+
+
+def cpu_seconds():
+    """CPU time (user + system) of this process and of its finished children"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+class RunReport:
+    """Collects the stage timings and counters of one run and writes them as JSON"""
+
+    def __init__(self, name, report_dir, profile=None):
+        self.name = name
+        self.profile = profile
+        self.report_dir = report_dir
+        self.started = time.strftime('%Y%m%d-%H%M%S')
+        self.path = os.path.join(report_dir, f"{name}-{self.started}.json")
+        self.stages = []
+        self.counters = {}
+        self._stack = []
+
+    def __enter__(self):
+        global _current
+        _current = self
+        self._run = self.stage('total', profile=self.profile is True)
+        self._run.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        global _current
+        self._run.__exit__(exc_type, exc, tb)
+        _current = None
+        if exc_type is not None:
+            self.counters['error'] = f"{exc_type.__name__}: {exc}"
+        self.write()
+        return False
+
+    @contextmanager
+    def stage(self, name, profile=False):
+        """Time a block: wall and CPU seconds and peak RSS, optionally under cProfile"""
+        profiler = cProfile.Profile() if profile or name == self.profile else None
+        entry = {'stage': name, 'parent': self._stack[-1] if self._stack else None}
+        self._stack.append(name)
+        wall, cpu = time.perf_counter(), cpu_seconds()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield entry
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                entry['profile'] = self.dump_profile(profiler, name)
+            self._stack.pop()
+            entry.update({
+                'wall_s': round(time.perf_counter() - wall, 3),
+                'cpu_s': round(cpu_seconds() - cpu, 3),
+                'peak_rss_mb': peak_rss_mb(),
+            })
+            self.stages.append(entry)
+
+    def dump_profile(self, profiler, stage):
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = os.path.join(self.report_dir, f"{self.name}-{self.started}-{stage}.prof")
+        profiler.dump_stats(path)
+        print(f"Saved cProfile output of '{stage}' to {path} (view with: python -m pstats {path})")
+        return path
+
+    def record(self, **counters):
+        """Set counters of the current stage"""
+        stage = self._stack[-1] if self._stack else 'total'
+        self.counters.setdefault(stage, {}).update(counters)
+
+    def write(self):
+        os.makedirs(self.report_dir, exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({
+                'run': self.name,
+                'started': self.started,
+                'argv': sys.argv,
+                'stages': self.stages,
+                'counters': self.counters,
+            }, f, indent=2, default=str)
+        print(f"Saved run report to {self.path}")
+
+
+@contextmanager
+def stage(name):
+    """Time a block as a stage of the current run report (no-op without one)"""
+    if _current is None:
+        yield None
+    else:
+        with _current.stage(name) as entry:
+            yield entry
+
+
+def record(**counters):
+    """Record counters in the current run report (no-op without one)"""
+    if _current is not None:
+        _current.record(**counters)
+
+
+def add_arguments(parser):
+    """Add the --no-report and --profile options to a script's argument parser"""
+    parser.add_argument('--no-report', action='store_true',
+                        help="do not write the JSON run report (stage timings, peak memory, accuracy)")
+    parser.add_argument('--profile', nargs='?', const=True, default=None, metavar='STAGE',
+                        help="also write cProfile output of a stage (default: the whole run)")
+
+
+@contextmanager
+def from_args(name, args, report_dir):
+    """Open a RunReport unless the script was started with --no-report"""
+    if args.no_report:
+        yield None
+        return
+    with RunReport(name, report_dir, profile=args.profile) as report:
+        yield report
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# The Chapter 2 scripts are flat modules next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from corpus_cache import load_corpus
+
+
+@pytest.fixture(scope='session')
+def chapter2_data(tmp_path_factory):
+    """A small synthetic corpus and metadata table: 80 volumes, half of them tagged locdetective,
+    three volumes per author. Returns (sourcefolder, metadatapath, compiled corpus)."""
+    root = tmp_path_factory.mktemp('chapter2')
+    sourcefolder = root / 'sourcefiles'
+    sourcefolder.mkdir()
+    rng = np.random.default_rng(1)
+    words = [f"w{i}" for i in range(400)]
+    rows = []
+    for i in range(80):
+        positive = i % 2 == 0
+        p = rng.dirichlet(np.full(len(words), 0.3))
+        if positive:
+            p[:20] *= 3
+        counts = rng.multinomial(5000, p / p.sum())
+        volid = f"vol{i:03d}"
+        lines = [f"#wordlength\t{4 + rng.random():.3f}"] + [f"{w}\t{c}" for w, c in zip(words, counts) if c]
+        (sourcefolder / f"{volid}.tsv").write_text("\n".join(lines) + "\n", encoding='utf-8')
+        rows.append({'docid': volid, 'author': f"author{i // 3}", 'title': f"title {i}", 'firstpub': 1800 + i,
+                     'pubdate': 1800 + i, 'birthdate': 1770, 'gender': 'f', 'nation': 'uk',
+                     'genretags': 'locdetective | teamred' if positive else 'random'})
+    metadatapath = root / 'meta.csv'
+    pd.DataFrame(rows).to_csv(metadatapath, index=False)
+    corpus = load_corpus(str(sourcefolder), '.tsv', str(root / 'compiled'))
+    return str(sourcefolder), str(metadatapath), corpus
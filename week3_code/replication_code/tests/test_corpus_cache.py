@@ -0,0 +1,76 @@
+"""
+Tests for the compiled corpus and for serving source files from it, on a few synthetic volumes
+"""
+import os
+
+import pytest
+
+import corpus_cache
+from corpus_cache import REST_WORD, load_corpus, serve_from_cache
+
+VOLUMES = {
+    'vol1': {'#wordlength': 4, 'the': 120, 'murder': 3, 'inspector': 2, 'sea': 1},
+    'vol2': {'#wordlength': 5, 'the': 80, 'ship': 7, 'sea': 12},
+    'vol3': {'#wordlength': 4, 'the': 95, 'murder': 1, 'ghost': 4},
+}
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    sourcefolder = tmp_path / 'sourcefiles'
+    sourcefolder.mkdir()
+    for volid, counts in VOLUMES.items():
+        # A malformed line, skipped by every reader
+        lines = [f"{word}\t{count}" for word, count in counts.items()] + ["broken line"]
+        (sourcefolder / f"{volid}.tsv").write_text("\n".join(lines) + "\n", encoding='utf-8')
+    return load_corpus(str(sourcefolder), '.tsv', str(tmp_path / 'compiled')), str(sourcefolder)
+
+
+def read_like_versatiletrainer(path):
+    """Parse a source file the way horizon's versatiletrainer does: word counts and their total"""
+    counts, total = {}, 0
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            fields = line.strip().split('\t')
+            if len(fields) != 2:
+                continue
+            counts[fields[0]] = int(fields[1])
+            total += int(fields[1])
+    return counts, total
+
+
+def test_compiled_features_are_frequencies_per_100_words(corpus):
+    corpus, _ = corpus
+    values = corpus.features(['vol2'], ['#wordlength', 'sea', 'murder'])
+    assert values.tolist() == [[5, 100 * 12 / 99, 0]]
+
+
+def test_served_volumes_read_like_the_source_files(corpus):
+    corpus, sourcefolder = corpus
+    paths = [os.path.join(sourcefolder, f"{volid}.tsv") for volid in VOLUMES]
+    expected = [read_like_versatiletrainer(path) for path in paths]
+    with serve_from_cache(corpus, sourcefolder, '.tsv') as served:
+        assert [read_like_versatiletrainer(path) for path in paths] == expected
+    assert served['volumes'] == len(VOLUMES)
+
+
+def test_served_volumes_keep_their_total_when_cut_to_a_vocabulary(corpus):
+    corpus, sourcefolder = corpus
+    path = os.path.join(sourcefolder, 'vol1.tsv')
+    counts, total = read_like_versatiletrainer(path)
+    with serve_from_cache(corpus, sourcefolder, '.tsv', words=['#wordlength', 'murder', 'ship']):
+        served_counts, served_total = read_like_versatiletrainer(path)
+    assert served_total == total
+    assert served_counts == {'#wordlength': 4, 'murder': 3, REST_WORD: total - 7}
+
+
+def test_other_files_are_opened_as_usual(corpus, tmp_path):
+    corpus, sourcefolder = corpus
+    other = tmp_path / 'vol1.tsv'
+    other.write_text("elsewhere\t1\n", encoding='utf-8')
+    with serve_from_cache(corpus, sourcefolder, '.tsv') as served:
+        assert read_like_versatiletrainer(str(other)) == ({'elsewhere': 1}, 1)
+        with open(os.path.join(sourcefolder, 'vol1.tsv'), 'a', encoding='utf-8'):
+            pass
+    assert served['volumes'] == 0
+    assert open is corpus_cache.builtins.open
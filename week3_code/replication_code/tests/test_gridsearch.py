@@ -0,0 +1,88 @@
+"""
+Tests for the compiled training engine on the synthetic corpus of conftest.py
+"""
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import gridsearch
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+C_RANGE = [.001, .01, .1, 1]
+
+
+def tune(chapter2_data, tmp_path, **kwargs):
+    sourcefolder, metadatapath, corpus = chapter2_data
+    paths = (sourcefolder, '.tsv', metadatapath, str(tmp_path / 'locdetective.csv'), str(tmp_path / 'vocab.txt'))
+    exclusions = ({}, {}, {'firstpub': 1700}, {'firstpub': 2000}, 400)
+    classifyconditions = (['locdetective'], ['random'], 'firstpub', 200, None, set())
+    modelparams = ('logistic', 5, 50, 250, 50, C_RANGE)
+    return gridsearch.tune_a_model(paths, exclusions, classifyconditions, modelparams, corpus=corpus, **kwargs)
+
+
+def chosen_model(tmp_path):
+    """Feature count and C of the written model"""
+    with open(tmp_path / 'locdetective.compiled.pkl', 'rb') as f:
+        model = pickle.load(f)
+    return len(model['vocabulary']), model['c']
+
+
+@pytest.fixture(scope='module')
+def sequential(chapter2_data, tmp_path_factory):
+    """The reference run: every cell fit one after another in this process"""
+    tmp_path = tmp_path_factory.mktemp('sequential')
+    matrix, rawaccuracy, allvolumes, _ = tune(chapter2_data, tmp_path, workers=1)
+    return matrix, rawaccuracy, allvolumes, chosen_model(tmp_path)
+
+
+def test_parallel_grid_matches_the_sequential_grid(chapter2_data, tmp_path, sequential):
+    matrix, rawaccuracy, allvolumes, _ = tune(chapter2_data, tmp_path, workers=2)
+    assert np.array_equal(matrix, sequential[0])
+    assert rawaccuracy == sequential[1]
+    assert allvolumes == sequential[2]
+    assert chosen_model(tmp_path) == sequential[3]
+
+
+def test_path_search_chooses_and_writes_what_the_grid_does(chapter2_data, tmp_path, sequential):
+    matrix, rawaccuracy, allvolumes, _ = tune(chapter2_data, tmp_path, search='path')
+    # Warm-started cells stop within the solver's tolerance of the cold fits
+    assert np.abs(matrix - sequential[0]).max() <= 0.05
+    assert chosen_model(tmp_path) == sequential[3]
+    # The chosen cell is cross-validated again from scratch before it is written
+    assert rawaccuracy == sequential[1]
+    assert allvolumes == sequential[2]
+
+
+def test_halving_keeps_only_fully_cross_validated_cells(chapter2_data, tmp_path, sequential):
+    matrix, rawaccuracy, allvolumes, _ = tune(chapter2_data, tmp_path, workers=2, search='halving')
+    full = ~np.isnan(matrix)
+    # Dropped cells are NaN; the survivors score exactly as in the full grid, the best one included
+    assert 0 < full.sum() < matrix.size
+    assert np.array_equal(matrix[full], sequential[0][full])
+    assert np.nanmax(matrix) == sequential[0].max()
+    assert chosen_model(tmp_path) == sequential[3]
+    assert rawaccuracy == sequential[1]
+    assert allvolumes == sequential[2]
+
+
+def test_outputs_are_written_under_their_own_names(chapter2_data, tmp_path):
+    tune(chapter2_data, tmp_path)
+    assert sorted(os.listdir(tmp_path)) == ['locdetective.compiled.coefs.csv', 'locdetective.compiled.csv',
+                                            'locdetective.compiled.pkl', 'vocab.txt']
+
+
+def test_outputs_have_the_layout_of_horizons(chapter2_data, tmp_path):
+    tune(chapter2_data, tmp_path)
+    published = os.path.join(SCRIPT_DIR, 'model_output', 'detectnewgatesensation')
+    with open(published + '.pkl', 'rb') as f:
+        horizon_model = pickle.load(f)
+    with open(tmp_path / 'locdetective.compiled.pkl', 'rb') as f:
+        model = pickle.load(f)
+    assert sorted(model) == sorted(horizon_model)
+    assert model['name'] == 'locdetective'
+    written = pd.read_csv(tmp_path / 'locdetective.compiled.csv')
+    assert list(written.columns) == list(pd.read_csv(published + '.csv', nrows=1).columns)
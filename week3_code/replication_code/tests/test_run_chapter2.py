@@ -0,0 +1,72 @@
+"""
+Tests for batch runs of run_chapter2.py, with a stub in place of horizon's versatiletrainer
+"""
+import os
+import sys
+import types
+
+import pytest
+
+import corpus_cache
+import run_chapter2
+
+
+class StubTrainer(types.ModuleType):
+    """Reads every source file like versatiletrainer does and reports the summed word totals"""
+
+    def __init__(self):
+        super().__init__('horizon.logistic.versatiletrainer')
+        self.models = []
+
+    def tune_a_model(self, paths, exclusions, classifyconditions, modelparams):
+        sourcefolder, extension, metadatapath, outputpath, vocabpath = paths
+        if 'allSF' in outputpath:
+            raise ValueError("no science fiction in the stub corpus")
+        total = 0
+        for name in sorted(os.listdir(sourcefolder)):
+            with open(os.path.join(sourcefolder, name), encoding='utf-8') as f:
+                for line in f:
+                    fields = line.strip().split('\t')
+                    if len(fields) == 2:
+                        total += float(fields[1])
+        self.models.append(outputpath)
+        return None, total, [], []
+
+
+@pytest.fixture
+def trainer(chapter2_data, tmp_path, monkeypatch):
+    sourcefolder, metadatapath, corpus = chapter2_data
+    stub = StubTrainer()
+    logistic = types.ModuleType('horizon.logistic')
+    logistic.versatiletrainer = stub
+    monkeypatch.setitem(sys.modules, 'horizon', types.ModuleType('horizon'))
+    monkeypatch.setitem(sys.modules, 'horizon.logistic', logistic)
+    monkeypatch.setitem(sys.modules, 'horizon.logistic.versatiletrainer', stub)
+    monkeypatch.setattr(run_chapter2, 'SOURCEFOLDER', sourcefolder)
+    monkeypatch.setattr(run_chapter2, 'METADATAPATH', metadatapath)
+    monkeypatch.setattr(run_chapter2, 'OUTPUTDIR', str(tmp_path))
+    monkeypatch.setattr(run_chapter2, 'REPORTDIR', str(tmp_path / 'reports'))
+    monkeypatch.setattr(run_chapter2, 'LEXICONDIR', str(tmp_path))
+    loads = []
+    monkeypatch.setattr(corpus_cache, 'load_corpus', lambda *args: loads.append(args) or corpus)
+    stub.loads = loads
+    return stub
+
+
+def test_batch_shares_one_corpus_on_the_default_engine(trainer):
+    results = run_chapter2.run_batch(['locdetective', 'sensation'])
+    assert len(trainer.loads) == 1
+    assert len(trainer.models) == 2
+    cached = {option: accuracy for option, (accuracy, _) in results.items()}
+    uncached = run_chapter2.run_batch(['locdetective', 'sensation'], cache=False)
+    assert len(trainer.loads) == 1
+    assert {option: accuracy for option, (accuracy, _) in uncached.items()} == cached
+
+
+def test_failed_model_makes_the_batch_exit_1(trainer, monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['run_chapter2.py', 'locdetective,allSF'])
+    with pytest.raises(SystemExit) as exit:
+        run_chapter2.main()
+    assert exit.value.code == 1
+    assert trainer.models == [os.path.join(run_chapter2.OUTPUTDIR, 'locdetective.csv')]
+    assert len(os.listdir(run_chapter2.REPORTDIR)) == 1